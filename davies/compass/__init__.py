@@ -4,14 +4,17 @@ davies.compass: Module for parsing and working with Compass source files
 
 import os.path
 import logging
+import multiprocessing
 import datetime
 import codecs
-from collections import OrderedDict
+import io
+import shutil
+from collections import OrderedDict, namedtuple
 
 log = logging.getLogger(__name__)
 
 __all__ = 'Project', 'UTMLocation', 'UTMDatum', \
-          'DatFile', 'Survey', 'Shot', 'Exclude', \
+          'DatFile', 'Survey', 'Shot', 'Exclude', 'StationIndex', \
           'CompassProjectParser', 'CompassDatParser', 'ParseException'
 
 
@@ -21,6 +24,8 @@ __all__ = 'Project', 'UTMLocation', 'UTMDatum', \
 DEFAULT_HEADER = ['FROM', 'TO', 'LENGTH', 'BEARING', 'INC', 'LEFT', 'UP', 'DOWN', 'RIGHT', 'FLAGS', 'COMMENTS']
 DEFAULT_HEADER_BACKSIGHTS = ['FROM', 'TO', 'LENGTH', 'BEARING', 'INC', 'LEFT', 'UP', 'DOWN', 'RIGHT', 'AZM2', 'INC2', 'FLAGS', 'COMMENTS']
 
+_WRITE_BUFFER_SIZE = 256 * 1024  # bytes buffered by DatFile.write()
+
 
 class Exclude:
     """Shot flags"""
@@ -30,6 +35,43 @@ class Exclude:
     PLOT    = 'P'
 
 
+FLAG_BITS = {Exclude.LENGTH: 1, Exclude.TOTAL: 2, Exclude.CLOSURE: 4, Exclude.PLOT: 8}
+EXCLUDED_BITS = FLAG_BITS[Exclude.LENGTH] | FLAG_BITS[Exclude.TOTAL]
+
+
+def flag_bits(flags):
+    """Convert a collection of :class:`Exclude` flags to an integer bitmask of :data:`FLAG_BITS`"""
+    bits = 0
+    for flag in flags or '':
+        bits |= FLAG_BITS.get(flag, 0)
+    return bits
+
+
+def average_azm(azm1, azm2):
+    """
+    Combine a foresight and backsight azimuth, either of which may be `None`, into a single azimuth.
+    Readings which straddle north are averaged the short way around, so 359 and 1 average to 0.
+    """
+    if azm2 is None:
+        return azm1
+    back = (azm2 + 180) % 360
+    if azm1 is None:
+        return back
+    azm = (azm1 + back) / 2.0
+    if abs(azm1 - back) > 180:
+        azm = (azm + 180) % 360
+    return azm
+
+
+def average_inc(inc1, inc2):
+    """Combine a foresight and backsight inclination, either of which may be `None`, into a single inclination."""
+    if inc2 is None:
+        return inc1
+    if inc1 is None:
+        return -1 * inc2
+    return (inc1 - inc2) / 2.0
+
+
 class Shot(OrderedDict):
     """
     Representation of a single shot in a Compass Survey.
@@ -52,35 +94,77 @@ class Shot(OrderedDict):
         :kwarg declination: (float) magnetic declination in decimal degrees
 
         :ivar declination: (float) set or get magnetic declination adjustment
+        :ivar flag_bits: (int) bitmask of :data:`FLAG_BITS`, kept up to date as FLAGS is assigned
         """
+        if len(args) > 1:
+            raise TypeError('expected at most 1 arguments, got %d' % len(args))
         self.declination = kwargs.pop('declination', 0.0)
-        OrderedDict.__init__(self, *args, **kwargs)
+        self._survey = None  # the Survey which owns us, notified of changes
+        OrderedDict.__init__(self)
+        # bypass our own __setitem__, whose bookkeeping would otherwise run for every value of every parsed shot
+        items = args[0] if args else ()
+        if hasattr(items, 'keys'):
+            items = [(key, items[key]) for key in items.keys()]
+        setitem = OrderedDict.__setitem__
+        for key, value in items:
+            setitem(self, key, value)
+        for key, value in kwargs.items():
+            setitem(self, key, value)
+        flags = self.get('FLAGS', None)
+        self.flag_bits = flag_bits(flags) if flags else 0
+
+    def __reduce__(self):
+        # unpickle our values as a plain OrderedDict, rather than through our __setitem__ one at a time
+        return _unpickle_shot, (self.__class__, _ShotItems(self)), self.__dict__
+
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        if key == 'FLAGS':
+            self.flag_bits = flag_bits(value)
+        if self._survey is not None:
+            self._survey._shot_changed(self, key)
+
+    def __delitem__(self, key):
+        OrderedDict.__delitem__(self, key)
+        if key == 'FLAGS':
+            self.flag_bits = 0
+        if self._survey is not None:
+            self._survey._shot_changed(self, key)
+
+    # these OrderedDict methods don't remove items via __delitem__
+
+    def pop(self, key, *args):
+        value = OrderedDict.pop(self, key, *args)
+        self.flag_bits = flag_bits(self.get('FLAGS', ''))
+        if self._survey is not None:
+            self._survey._shot_changed(self, key)
+        return value
+
+    def popitem(self, *args, **kwargs):
+        item = OrderedDict.popitem(self, *args, **kwargs)
+        self.flag_bits = flag_bits(self.get('FLAGS', ''))
+        if self._survey is not None:
+            self._survey._shot_changed(self, item[0])
+        return item
+
+    def clear(self):
+        keys = list(self.keys())
+        OrderedDict.clear(self)
+        self.flag_bits = 0
+        if self._survey is not None:
+            for key in keys:
+                self._survey._shot_changed(self, key)
 
     @property
     def azm(self):
         """Corrected azimuth, taking into account backsight, declination, and compass corrections."""
-        azm1 = self.get('BEARING', None)
-        azm2 = self.get('AZM2', None)
-        if azm1 is None and azm2 is None:
-            return None
-        if azm2 is None:
-            return azm1 + self.declination
-        if azm1 is None:
-            return (azm2 + 180) % 360 + self.declination
-        return (azm1 + (azm2 + 180) % 360) / 2.0 + self.declination
+        azm = average_azm(self.get('BEARING', None), self.get('AZM2', None))
+        return azm + self.declination if azm is not None else None
 
     @property
     def inc(self):
         """Corrected inclination, taking into account backsight and clino corrections."""
-        inc1 = self.get('INC', None)
-        inc2 = self.get('INC2', None)
-        if inc1 is None and inc2 is None:
-            return None
-        if inc2 is None:
-            return inc1
-        if inc1 is None:
-            return -1 * inc2
-        return (inc1 - inc2) / 2.0
+        return average_inc(self.get('INC', None), self.get('INC2', None))
 
     @property
     def flags(self):
@@ -94,11 +178,11 @@ class Shot(OrderedDict):
 
     @property
     def is_included(self):
-        return Exclude.LENGTH not in self.flags and Exclude.TOTAL not in self.flags
+        return not self.flag_bits & EXCLUDED_BITS
 
     @property
     def is_excluded(self):
-        return Exclude.LENGTH in self.flags or Exclude.TOTAL in self.flags
+        return bool(self.flag_bits & EXCLUDED_BITS)
 
     def __str__(self):
         return ', '.join('%s=%s' % (k,v) for (k,v) in self.items())
@@ -107,7 +191,129 @@ class Shot(OrderedDict):
         return '%s(%s)' % (self.__class__.__name__, self)
 
 
-class Survey(object):
+class _ShotItems(OrderedDict):
+    """The values of a :class:`Shot`, filled without its change notifications and then promoted to a Shot"""
+    pass
+
+
+def _new_shot(items):
+    """Return a new :class:`Shot` of `(key, value)` items, built as quickly as a plain OrderedDict"""
+    shot = _ShotItems(items)
+    shot.__class__ = Shot
+    shot.declination = 0.0
+    shot._survey = None
+    flags = shot.get('FLAGS', None)
+    shot.flag_bits = flag_bits(flags) if flags else 0
+    return shot
+
+
+def _unpickle_shot(cls, items):
+    """Turn :class:`_ShotItems` into a :class:`Shot` of class `cls` in place"""
+    items.__class__ = cls
+    return items
+
+
+class _PackedShots(object):
+    """
+    Compact form of a list of :class:`Shot` for pickling: each distinct sequence of keys, and a tuple
+    of values per shot. These pickle and unpickle several times faster than the shots themselves.
+    """
+
+    def __init__(self, shots, declination):
+        """:param declination: (float) the declination of most shots, which needn't be stored per shot"""
+        layouts = {}  # tuple of keys -> layout id
+        layout_ids = [layouts.setdefault(tuple(shot), len(layouts)) for shot in shots]
+        self.layouts = sorted(layouts, key=layouts.get)
+        self.layout_ids = layout_ids if len(layouts) > 1 else None
+        self.rows = [tuple(shot.values()) for shot in shots]
+        declinations = [shot.declination for shot in shots]
+        self.declinations = declinations if any(d != declination for d in declinations) else None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def unpack(self):
+        """Return a new list of :class:`Shot`"""
+        if self.layout_ids is None:
+            keys = self.layouts[0] if self.layouts else ()
+            return [_new_shot(zip(keys, row)) for row in self.rows]
+        layouts = self.layouts
+        return [_new_shot(zip(layouts[i], row)) for (i, row) in zip(self.layout_ids, self.rows)]
+
+    def restore_declinations(self, shots):
+        """Restore the declinations of unpacked `shots` which differ from their survey's"""
+        if self.declinations is not None:
+            for shot, declination in zip(shots, self.declinations):
+                shot.declination = declination
+
+
+class _CachedLengths(object):
+    """
+    Mixin which caches aggregate `(count, total, included, excluded)` lengths. The cache is updated
+    incrementally as children are added and discarded when they are modified, and both updates are
+    propagated to the :attr:`_parent` container.
+
+    Classes using this mixin define `_child_count()`, returning their current number of children, and
+    `_compute_lengths()`, returning a fresh `(count, total, included, excluded)` tuple.
+    """
+    _lengths = None  # cached (child count, total length, included length, excluded length)
+    _parent = None
+    _transient_attrs = ('_lengths',)  # derived attributes which aren't pickled
+
+    def _cached_lengths(self):
+        lengths = self._lengths
+        # a differing count catches children appended or removed directly; replaced children invalidate explicitly
+        if lengths is None or lengths[0] != self._child_count():
+            lengths = self._lengths = self._compute_lengths()
+        return lengths
+
+    def _add_lengths(self, total, included, excluded):
+        """Incrementally account for one newly added child with the specified lengths"""
+        lengths = self._lengths
+        if lengths is None:
+            return self.invalidate_lengths()
+        self._lengths = (lengths[0] + 1, lengths[1] + total, lengths[2] + included, lengths[3] + excluded)
+        if self._parent is not None:
+            self._parent._update_lengths(total, included, excluded)
+
+    def _update_lengths(self, total, included, excluded):
+        """Incrementally account for a change in lengths of an existing child"""
+        lengths = self._lengths
+        if lengths is None:
+            return self.invalidate_lengths()
+        self._lengths = (lengths[0], lengths[1] + total, lengths[2] + included, lengths[3] + excluded)
+        if self._parent is not None:
+            self._parent._update_lengths(total, included, excluded)
+
+    def invalidate_lengths(self):
+        """Discard cached aggregate lengths. Only needed after modifying child lists directly."""
+        self._lengths = None
+        if self._parent is not None:
+            self._parent.invalidate_lengths()
+
+    @property
+    def length(self):
+        """Total surveyed length, regardless of exclusion flags."""
+        return self._cached_lengths()[1]
+
+    @property
+    def included_length(self):
+        """Surveyed length, not including "excluded" shots"""
+        return self._cached_lengths()[2]
+
+    @property
+    def excluded_length(self):
+        """Surveyed length which does not count toward the included total"""
+        return self._cached_lengths()[3]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in self._transient_attrs:
+            state.pop(attr, None)  # don't trust pickled aggregates and indexes, they're cheap to recompute
+        return state
+
+
+class Survey(_CachedLengths):
     """
     Representation of a Compass Survey object. A Survey is a container for :class:`Shot` objects.
 
@@ -124,7 +330,15 @@ class Survey(object):
     :ivar shot_item_order: (list of chr) 
     :ivar backsight: (chr) 
     :ivar lrud_association: (chr) 
+    :ivar shots: (list of :class:`Shot`) for surveys read in "lazy" mode, shots are only parsed \
+                 when this attribute is first accessed
     """
+    _stations = None  # set of FROM and TO stations
+    _stations_count = 0  # number of shots in the station set
+    _raw = None  # (_SourceFile, start, end) byte range of this survey's unmodified source text
+    _raw_header = None  # header values of the unmodified survey, see _header()
+    _raw_count = 0  # number of shots in the unmodified survey
+    _transient_attrs = ('_lengths', '_stations')
 
     def __init__(self, name='', date=None, comment='', team='', declination=0.0, file_format=None, corrections=(0.0,0.0,0.0), corrections2=(0.0,0.0), cave_name='', shot_header=(), shots=None):
         self.name = name
@@ -135,7 +349,8 @@ class Survey(object):
         self.corrections, self.corrections2 = corrections, corrections2  # TODO: instrument corrections not supported
         self.cave_name = cave_name
         self.shot_header = shot_header  # FIXME: this ordering is not optional!
-        self.shots = shots if shots else []
+        self._shot_block = None  # raw, unparsed shot lines when read in "lazy" mode, or _PackedShots when unpickled
+        self._set_shots(shots if shots else [])
 
         self.bearing_units = 'D'
         self.length_units = 'D'
@@ -148,6 +363,47 @@ class Survey(object):
         if file_format:
             self.file_format = file_format
 
+    def _header(self):
+        """Return a tuple of every value which is serialized in our header"""
+        return (self.cave_name, self.name, self.date, self.comment, tuple(self.team or ()), self.declination,
+                self.file_format, tuple(self.corrections), tuple(self.corrections2), tuple(self.shot_header))
+
+    def _set_raw(self, source, start, end):
+        """Record that we're unmodified with respect to bytes `start` to `end` of :class:`_SourceFile` `source`"""
+        self._raw = (source, start, end)
+        self._raw_header = self._header()
+        if self._shot_block is None:
+            self._raw_count = len(self._shots)
+
+    @property
+    def is_dirty(self):
+        """Has this survey been modified since it was parsed or last written?"""
+        return (self._raw is None or (self._shot_block is None and len(self._shots) != self._raw_count)
+                or self._header() != self._raw_header)
+
+    def mark_dirty(self):
+        """
+        Mark this survey as modified, so that :meth:`DatFile.write` re-serializes it. Only needed after
+        replacing an item of :attr:`shots` in place; other edits of shots and header values are detected.
+        """
+        self._shots_replaced()
+
+    def _raw_bytes(self, sources):
+        """
+        Return this survey's source bytes, or `None` if it has been modified or its source file has
+        changed. `sources` maps each :class:`_SourceFile` to an open file, or `None` if it changed.
+        """
+        if self.is_dirty:
+            return None
+        source, start, end = self._raw
+        if source not in sources:
+            sources[source] = open(source.filename, 'rb') if _source_file(source.filename) == source else None
+        f = sources[source]
+        if f is None:
+            return None
+        f.seek(start)
+        return f.read(end - start)
+
     @property
     def file_format(self):
         return '%s%s%s%s%s%s%s%s' % \
@@ -182,25 +438,113 @@ class Survey(object):
         else:
             self.lrud_association = fmt[-1]
 
+    @property
+    def shots(self):
+        if self._shot_block is not None:
+            self._load_shots()
+        return self._shots
+
+    @shots.setter
+    def shots(self, shots):
+        self._set_shots(shots)
+        self._shots_replaced()
+
+    def _set_shots(self, shots):
+        """Take `shots` as :attr:`shots` without notifying anybody, as when constructing a new survey"""
+        self._shot_block = None
+        for shot in shots:
+            shot._survey = self
+        self._shots = shots
+
+    def _shots_replaced(self):
+        """Called when :attr:`shots` is assigned, discarding everything derived from the old shots"""
+        self._raw = None  # we no longer match our source text, even with as many shots as before
+        self._stations = None
+        self.invalidate_lengths()
+        if self._parent is not None:
+            self._parent._invalidate_station_index()
+
+    def _load_shots(self):
+        """Materialize :attr:`shots` from the raw shot block kept by a "lazy" parse, or from :class:`_PackedShots`"""
+        shot_block, self._shot_block = self._shot_block, None
+        if isinstance(shot_block, _PackedShots):
+            self._set_parsed_shots(shot_block.unpack())
+            shot_block.restore_declinations(self._shots)
+            return
+        self._set_parsed_shots(list(CompassSurveyParser._parse_shot_lines(self.name, self.shot_header, shot_block.splitlines())))
+        self._raw_count = len(self._shots)  # loading isn't a modification
+
+    def _set_parsed_shots(self, shots):
+        """
+        Take a list of freshly parsed or unpacked shots as :attr:`shots` in bulk. Unlike :meth:`add_shot`,
+        this notifies nobody of each shot, so must not be used to add shots to an existing survey.
+        """
+        declination = self.declination
+        for shot in shots:
+            shot.declination = declination
+            shot._survey = self
+        self._shots = shots
+        self._lengths = None
+
     def add_shot(self, shot):
         """Add a shot dictionary to :attr:`shots`, applying this survey's magnetic declination"""
         shot.declination = self.declination
+        shot._survey = self
         self.shots.append(shot)
+        self._shot_added(shot)
+
+    def _shot_added(self, shot):
+        self._raw = None
+        if self._lengths is not None:
+            length = shot.length or 0.0
+            excluded = shot.flag_bits & EXCLUDED_BITS
+            self._add_lengths(length, 0.0 if excluded else length, length if excluded else 0.0)
+        if self._stations is not None and self._stations_count == len(self.shots) - 1:
+            self._stations.add(shot.get('FROM', None))
+            self._stations.add(shot.get('TO', None))
+            self._stations_count += 1
+        if self._parent is not None:
+            self._parent._index_shot(shot, self)
+
+    def _shot_changed(self, shot, key):
+        """Called by a :class:`Shot` belonging to this survey when one of its values changes"""
+        self._raw = None
+        if key in ('LENGTH', 'FLAGS'):
+            self.invalidate_lengths()
+        elif key in ('FROM', 'TO'):
+            self._stations = None
+            if self._parent is not None:
+                self._parent._invalidate_station_index()
+
+    def __getstate__(self):
+        state = _CachedLengths.__getstate__(self)
+        shots = state.get('_shots', None)
+        if state.get('_shot_block', None) is None and type(shots) is list and all(type(shot) is Shot for shot in shots):
+            # pickle our shots compactly, to be unpacked when first accessed
+            state['_shot_block'], state['_shots'] = _PackedShots(shots, self.declination), None
+            if self._raw is not None and len(shots) != self._raw_count:
+                state['_raw'] = None  # shots were added or removed, but can't be counted while packed
+        return state
+
+    def _child_count(self):
+        return len(self.shots)
 
-    @property
-    def length(self):
-        """Total surveyed length, regardless of exclusion flags."""
-        return sum([shot.length for shot in self.shots])
-
-    @property
-    def included_length(self):
-        """Surveyed length, not including "excluded" shots"""
-        return sum([shot.length for shot in self.shots if shot.is_included])
+    def _compute_lengths(self):
+        total = included = excluded = 0
+        for shot in self.shots:
+            length = shot.length
+            if length is None:
+                continue
+            total += length
+            if shot.flag_bits & EXCLUDED_BITS:
+                excluded += length
+            else:
+                included += length
+        return len(self.shots), total, included, excluded
 
-    @property
-    def excluded_length(self):
-        """Surveyed length which does not count toward the included total"""
-        return sum([shot.length for shot in self.shots if Exclude.LENGTH in shot.flags or Exclude.TOTAL in shot.flags])
+    def included_mask(self):
+        """List of booleans, one per shot, indicating whether each shot is included in length totals"""
+        return [not shot.flag_bits & EXCLUDED_BITS for shot in self.shots]
 
     @property
     def backsights_enabled(self):
@@ -223,10 +567,18 @@ class Survey(object):
             yield shot
 
     def __contains__(self, item):
-        for shot in self.shots:
-            if item in (shot.get('FROM', None), shot.get('TO', None)):
-                return True
-        return False
+        """Does this survey contain the specified station?"""
+        shots = self.shots
+        if self._stations is None or self._stations_count != len(shots):
+            self._stations = set()
+            for shot in shots:
+                self._stations.add(shot.get('FROM', None))
+                self._stations.add(shot.get('TO', None))
+            self._stations_count = len(shots)
+        try:
+            return item in self._stations
+        except TypeError:
+            return False
 
     def _serialize(self):
         date = self.date.strftime('%m %d %Y').lstrip('0') if self.date else ''
@@ -249,44 +601,93 @@ class Survey(object):
             '\t'.join(header),
             '',
         ]
-        for shot in self.shots:
-            vals = []
-            for k in header:
-                v = shot.get(k, None)
-                if k in ('BEARING', 'INC', 'AZM2', 'INC2'):
-                    vals.append('%7.2f' % (v if v is not None else -999.0))
-                elif k == 'LENGTH':
-                    vals.append('%8.3f' % (v if v is not None else -999.0))
-                elif k in ('LEFT', 'RIGHT', 'UP', 'DOWN'):
-                    vals.append('%7.2f' % (v if v is not None and v != float('inf') else -9.90))
-                elif k in ('FROM', 'TO'):
-                    v = v or ''
-                    vals.append(v.rjust(6))
-                elif k in ('FLAGS', 'COMMENTS'):
-                    pass  # handle them together below
-                else:
-                    vals.append(str(v) if v is not None else '')
+        lines.extend(_row_formatter(header).format_shots(self.shots))
+        return lines
 
-            if shot.get('FLAGS', ''):
-                flags = '#|%s#' % ''.join(list(shot.get('FLAGS', ())))
-                vals.append('%s  %s' % (flags, shot.get('COMMENTS', '') or ''))
-            else:
-                vals.append((shot.get('COMMENTS', '') or '')[:80])
 
-            lines.append('\t'.join(vals))
+class _RowFormatter(object):
+    """
+    Formats shot rows for one shot header layout. The layout is compiled once into a single format
+    string, plus the placeholder to substitute for each missing value.
+    """
+
+    def __init__(self, header):
+        self.keys = [key for key in header if key not in ('FLAGS', 'COMMENTS')]  # appended together last
+        formats, self.missing = [], []
+        for key in self.keys:
+            if key in ('BEARING', 'INC', 'AZM2', 'INC2'):
+                formats.append('%7.2f')
+                self.missing.append(-999.0)
+            elif key == 'LENGTH':
+                formats.append('%8.3f')
+                self.missing.append(-999.0)
+            elif key in ('LEFT', 'RIGHT', 'UP', 'DOWN'):
+                formats.append('%7.2f')
+                self.missing.append(-9.90)
+            elif key in ('FROM', 'TO'):
+                formats.append('%6s')
+                self.missing.append('')
+            else:
+                formats.append('%s')
+                self.missing.append('')
+        self.format = '\t'.join(formats + ['%s'])
+        # passage LRUDs are written like missing ones
+        self.infinite = [i for (i, key) in enumerate(self.keys) if key in ('LEFT', 'RIGHT', 'UP', 'DOWN')]
+
+    def format_shots(self, shots):
+        """Return a list of formatted lines for a sequence of shots"""
+        if hasattr(shots, 'column'):  # ShotColumns; read whole columns rather than boxing every row
+            columns = [shots.column(key) for key in self.keys] + [shots.column('FLAGS'), shots.column('COMMENTS')]
+            rows = zip(*columns)
+        else:
+            keys = self.keys + ['FLAGS', 'COMMENTS']
+            rows = ([shot.get(key, None) for key in keys] for shot in shots)
+        fmt, missing, infinite, inf = self.format, self.missing, self.infinite, float('inf')
+        lines = []
+        for row in rows:
+            vals = [v if v is not None else m for (v, m) in zip(row, missing)]
+            for i in infinite:
+                if vals[i] == inf:
+                    vals[i] = missing[i]
+            flags, comments = row[-2], row[-1] or ''
+            vals.append('#|%s#  %s' % (''.join(flags), comments) if flags else comments[:80])
+            lines.append(fmt % tuple(vals))
         return lines
 
 
-class DatFile(object):
+_ROW_FORMATTERS = {}  # shot header layout -> _RowFormatter
+
+
+def _row_formatter(header):
+    """Return the (cached) :class:`_RowFormatter` for a shot header layout"""
+    header = tuple(header)
+    try:
+        return _ROW_FORMATTERS[header]
+    except KeyError:
+        formatter = _ROW_FORMATTERS[header] = _RowFormatter(header)
+        return formatter
+
+
+class DatFile(_CachedLengths):
     """
     Representation of a Compass .DAT File. A DatFile is a container for :class:`Survey` objects.
 
     See: `Compass Survey Data File Format <http://www.fountainware.com/compass/Documents/FileFormats/SurveyDataFormat.htm>`_
 
+    Surveys are looked up by name in constant time. Compass does not enforce unique survey
+    designations; when several surveys share a name, lookup by that name returns the first one.
+    The name index is rebuilt automatically if :attr:`surveys` is modified directly, but surveys
+    renamed after being added must be followed by a call to :meth:`reindex`.
+
     :ivar name:     (string) the DatFile's "name", not necessarily related to its filename
     :ivar filename: (string) underlying .DAT file's filename
     :ivar surveys:  (list of :class:`Survey`)
     """
+    _raw_tail = None  # source bytes following the last survey's ^L, such as the ^Z soft EOF
+    _surveys_by_name = None  # survey name -> first Survey with that name
+    _surveys_indexed = 0     # number of surveys in the index
+    _station_index = None
+    _transient_attrs = ('_lengths', '_station_index')
 
     def __init__(self, name=None, filename=None):
         self.name = name
@@ -296,21 +697,22 @@ class DatFile(object):
     def add_survey(self, survey):
         """Add a :class:`Survey` to :attr:`surveys`."""
         self.surveys.append(survey)
+        if self._surveys_by_name is not None and self._surveys_indexed == len(self.surveys) - 1:
+            self._surveys_by_name.setdefault(survey.name, survey)
+            self._surveys_indexed += 1
+        survey._parent = self
+        if self._station_index is not None or (self._parent is not None and self._parent._station_index is not None):
+            for shot in survey.shots:
+                self._index_shot(shot, survey)
+        if self._lengths is not None:
+            self._add_lengths(survey.length, survey.included_length, survey.excluded_length)
+
+    def _child_count(self):
+        return len(self.surveys)
 
-    @property
-    def length(self):
-        """Total surveyed length."""
-        return sum([survey.length for survey in self.surveys])
-
-    @property
-    def included_length(self):
-        """Surveyed length, not including "excluded" shots"""
-        return sum([survey.included_length for survey in self.surveys])
-
-    @property
-    def excluded_length(self):
-        """Surveyed length which does not count toward the included total"""
-        return sum([survey.excluded_length for survey in self.surveys])
+    def _compute_lengths(self):
+        lengths = [survey._cached_lengths() for survey in self.surveys]
+        return (len(lengths), sum([l[1] for l in lengths]), sum([l[2] for l in lengths]), sum([l[3] for l in lengths]))
 
     def __len__(self):
         return len(self.surveys)
@@ -319,31 +721,201 @@ class DatFile(object):
         for survey in self.surveys:
             yield survey
 
+    def _survey_index(self):
+        if self._surveys_by_name is None or self._surveys_indexed != len(self.surveys):
+            self._surveys_by_name = {}
+            for survey in self.surveys:
+                self._surveys_by_name.setdefault(survey.name, survey)
+            self._surveys_indexed = len(self.surveys)
+        return self._surveys_by_name
+
+    def reindex(self):
+        """Rebuild the survey name index and discard the station index, e.g. after modifying :attr:`surveys` directly"""
+        self._surveys_by_name = None
+        self._survey_index()
+        self._invalidate_station_index()
+
+    @property
+    def station_index(self):
+        """
+        :class:`StationIndex` of every station in this file. It is built on first access and then updated
+        as shots and surveys are added, or rebuilt after a station is renamed or shots are replaced.
+        """
+        if self._station_index is None:
+            index = StationIndex()
+            for survey in self.surveys:
+                for shot in survey.shots:
+                    index.add_shot(shot, survey, self)
+            self._station_index = index
+        return self._station_index
+
+    def _index_shot(self, shot, survey):
+        """Add a shot newly added to one of our surveys to our station index, and our project's"""
+        if self._station_index is not None:
+            self._station_index.add_shot(shot, survey, self)
+        if self._parent is not None:
+            self._parent._index_shot(shot, survey, self)
+
+    def _invalidate_station_index(self):
+        self._station_index = None
+        if self._parent is not None:
+            self._parent._invalidate_station_index()
+
     def __contains__(self, item):
-        for survey in self.surveys:
-            if item == survey.name or item == survey:
-                return True
-        return False
+        if isinstance(item, Survey):
+            return self._survey_index().get(item.name, None) is item or item in self.surveys
+        try:
+            return item in self._survey_index()
+        except TypeError:
+            return False
 
     def __getitem__(self, item):
-        for survey in self.surveys:
-            if item == survey.name or item == survey:
-                return survey
-        raise KeyError(item)
+        if isinstance(item, Survey):
+            if item not in self:
+                raise KeyError(item)
+            return item
+        try:
+            return self._survey_index()[item]
+        except TypeError:
+            raise KeyError(item)
+
+    @staticmethod
+    def read(fname, lazy=False, columnar=False, cache=None):
+        """
+        Read a .DAT file and produce a `Survey`
+
+        :param lazy: (bool) parse only survey headers up front, deferring each survey's shots until accessed
+        :param columnar: (bool) store shots in memory-efficient :class:`davies.compass.columnar.ShotColumns`
+        :param cache: (:class:`davies.compass.cache.ParseCache`) optional persistent parse cache
+        """
+        return CompassDatParser(fname, lazy=lazy, columnar=columnar, cache=cache).parse()
 
     @staticmethod
-    def read(fname):
-        """Read a .DAT file and produce a `Survey`"""
-        return CompassDatParser(fname).parse()
+    def iter_surveys(fname, lazy=False, columnar=False):
+        """Incrementally read a .DAT file, yielding one :class:`Survey` at a time in constant memory"""
+        return CompassDatParser(fname, lazy=lazy, columnar=columnar).iter_surveys()
 
     def write(self, outfname=None):
-        """Write or overwrite a `Survey` to the specified .DAT file"""
+        """
+        Write or overwrite the specified .DAT file. Surveys which haven't been modified since they were
+        parsed (see :attr:`Survey.is_dirty`) are copied byte-for-byte from their source file, and only
+        modified surveys are re-serialized. The file is written to a temporary file, which then
+        replaces `outfname`.
+        """
         outfname = outfname or self.filename
-        with codecs.open(outfname, 'wb', 'windows-1252') as outf:
-            for survey in self.surveys:
-                outf.write('\r\n'.join(survey._serialize()))
-                outf.write('\r\n'+'\f'+'\r\n')  # ASCII "form feed" ^L
-            outf.write('\x1A')  # ASCII "sub" ^Z marks EOF
+        if not outfname:
+            raise ValueError('Unable to write DAT file without a filename')
+        tmpfname = '%s.%d.tmp' % (outfname, os.getpid())
+        sources = {}  # _SourceFile -> open file, or None if it has changed since it was parsed
+        ranges = []  # (survey, start, end) as written
+        try:
+            with io.open(tmpfname, 'wb', buffering=_WRITE_BUFFER_SIZE) as outf:
+                pos = 0
+                for i, survey in enumerate(self.surveys):
+                    block = survey._raw_bytes(sources)
+                    if block is None:
+                        # each survey is encoded as a block and streamed out, rather than joining the whole file
+                        text = ('\r\n' if i else '') + '\r\n'.join(survey._serialize()) + '\r\n'
+                        block = text.encode('windows-1252')
+                    outf.write(block)
+                    outf.write(b'\x0C')  # ASCII "form feed" ^L
+                    ranges.append((survey, pos, pos + len(block)))
+                    pos += len(block) + 1
+                tail = self._raw_tail if self._raw_tail is not None else b'\r\n\x1A'  # ASCII "sub" ^Z marks EOF
+                outf.write(tail)
+        except BaseException:
+            if os.path.exists(tmpfname):  # not if opening it failed
+                os.remove(tmpfname)
+            raise
+        finally:
+            for f in sources.values():
+                if f is not None:
+                    f.close()
+        if os.path.exists(outfname):
+            shutil.copymode(outfname, tmpfname)
+        _replace(tmpfname, outfname)
+
+        # our surveys are now unmodified with respect to the file we just wrote
+        source = _source_file(outfname)
+        for survey, start, end in ranges:
+            survey._set_raw(source, start, end)
+        self._raw_tail = tail
+
+    def _refresh_source(self, fname):
+        """Re-fingerprint source file `fname` of our unmodified surveys, after it was touched but not changed"""
+        source = _source_file(fname)
+        for survey in self.surveys:
+            if survey._raw is not None and survey._raw[0].filename == source.filename:
+                survey._raw = (source,) + survey._raw[1:]
+
+
+_SourceFile = namedtuple('_SourceFile', 'filename size mtime')
+
+
+def _source_file(fname):
+    """Return a :class:`_SourceFile` identifying the current contents of a file, or `None` if it's missing"""
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return _SourceFile(os.path.abspath(fname), st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))
+
+
+_replace = getattr(os, 'replace', os.rename)  # Python 2 has no atomic os.replace()
+
+
+StationReference = namedtuple('StationReference', 'shot survey datfile')
+
+
+class StationIndex(object):
+    """
+    Index of survey stations. Maps each station name to the :class:`StationReference` tuples
+    `(shot, survey, datfile)` for every shot which uses that station as its FROM or TO.
+    """
+
+    def __init__(self):
+        self._stations = {}  # station -> list of StationReference
+
+    def add_shot(self, shot, survey=None, datfile=None):
+        """Add a :class:`Shot` to the index under both its FROM and TO stations"""
+        ref = StationReference(shot, survey, datfile)
+        from_, to = shot.get('FROM', None), shot.get('TO', None)
+        for station in (from_, to) if from_ != to else (from_,):
+            if station is not None:
+                self._stations.setdefault(station, []).append(ref)
+
+    def get(self, station, default=None):
+        """Return the list of :class:`StationReference` for `station`, or `default`"""
+        return self._stations.get(station, default)
+
+    def shots(self, station):
+        """Return the list of :class:`Shot` which touch `station`"""
+        return [ref.shot for ref in self._stations.get(station, ())]
+
+    def surveys(self, station):
+        """Return the distinct :class:`Survey` objects which touch `station`, in order of appearance"""
+        return _unique([ref.survey for ref in self._stations.get(station, ())])
+
+    def datfiles(self, station):
+        """Return the distinct :class:`DatFile` objects which touch `station`, in order of appearance"""
+        return _unique([ref.datfile for ref in self._stations.get(station, ())])
+
+    def __getitem__(self, station):
+        return self._stations[station]
+
+    def __contains__(self, station):
+        return station in self._stations
+
+    def __len__(self):
+        return len(self._stations)
+
+    def __iter__(self):
+        return iter(self._stations)
+
+
+def _unique(objs):
+    seen = set()
+    return [obj for obj in objs if not (id(obj) in seen or seen.add(id(obj)))]
 
 
 class UTMDatum:
@@ -372,7 +944,7 @@ class UTMLocation(object):
         return "<%s UTM Zone %s %0.1fE %0.1fN %0.1f>" % (self.datum, self.zone, self.easting, self.northing, self.elevation)
 
 
-class Project(object):
+class Project(_CachedLengths):
     """
     Representation of a Compass .MAK Project file. A Project is a container for :class:`DatFile` objects.
 
@@ -383,7 +955,13 @@ class Project(object):
     :ivar base_location: (:class:`UTMLocation`)
     :ivar linked_files:  (list of :class:`DatFile`)
     :ivar fixed_stations: (map of :class:`DatFile` -> station -> :class:`UTMLocation`)
+
+    Linked files are looked up by name in constant time; when several share a name, the first is returned.
     """
+    _linked_files_by_name = None  # DatFile name -> first DatFile with that name
+    _linked_files_indexed = 0     # number of linked files in the index
+    _station_index = None
+    _transient_attrs = ('_lengths', '_station_index')
     
     def __init__(self, name=None, filename=None):
         self.name = name
@@ -411,6 +989,26 @@ class Project(object):
     def add_linked_file(self, datfile):
         """Add a :class:`DatFile` to :attr:`linked_files`."""
         self.linked_files.append(datfile)
+        if self._linked_files_by_name is not None and self._linked_files_indexed == len(self.linked_files) - 1:
+            self._linked_files_by_name.setdefault(getattr(datfile, 'name', datfile), datfile)
+            self._linked_files_indexed += 1
+        if isinstance(datfile, DatFile):
+            datfile._parent = self
+            if self._station_index is not None:
+                for survey in datfile:
+                    for shot in survey.shots:
+                        self._station_index.add_shot(shot, survey, datfile)
+            if self._lengths is not None:
+                self._add_lengths(datfile.length, datfile.included_length, datfile.excluded_length)
+        elif self._lengths is not None:
+            self._lengths = (self._lengths[0] + 1,) + self._lengths[1:]
+
+    def _child_count(self):
+        return len(self.linked_files)
+
+    def _compute_lengths(self):
+        lengths = [datfile._cached_lengths() for datfile in self.linked_files if isinstance(datfile, DatFile)]
+        return (len(self.linked_files), sum([l[1] for l in lengths]), sum([l[2] for l in lengths]), sum([l[3] for l in lengths]))
 
     def add_linked_station(self, datfile, station, location=None):
         """Add a linked or fixed station"""
@@ -431,16 +1029,73 @@ class Project(object):
         for linked_file in self.linked_files:
             yield linked_file
 
+    def _linked_file_index(self):
+        if self._linked_files_by_name is None or self._linked_files_indexed != len(self.linked_files):
+            self._linked_files_by_name = {}
+            for datfile in self.linked_files:
+                self._linked_files_by_name.setdefault(getattr(datfile, 'name', datfile), datfile)
+            self._linked_files_indexed = len(self.linked_files)
+        return self._linked_files_by_name
+
+    def reindex(self):
+        """Rebuild the linked file name index and discard the station index, e.g. after modifying :attr:`linked_files` directly"""
+        self._linked_files_by_name = None
+        self._linked_file_index()
+        self._invalidate_station_index()
+
+    @property
+    def station_index(self):
+        """
+        :class:`StationIndex` of every station in the project. It is built on first access and then updated
+        as shots, surveys and linked files are added, or rebuilt after a station is renamed or shots are replaced.
+        """
+        if self._station_index is None:
+            index = StationIndex()
+            for datfile in self.linked_files:
+                if not isinstance(datfile, DatFile):
+                    continue
+                for survey in datfile:
+                    for shot in survey.shots:
+                        index.add_shot(shot, survey, datfile)
+            self._station_index = index
+        return self._station_index
+
+    def _index_shot(self, shot, survey, datfile):
+        if self._station_index is not None:
+            self._station_index.add_shot(shot, survey, datfile)
+
+    def _invalidate_station_index(self):
+        self._station_index = None
+
+    def __contains__(self, item):
+        if isinstance(item, DatFile):
+            return self._linked_file_index().get(item.name, None) is item or item in self.linked_files
+        try:
+            return item in self._linked_file_index()
+        except TypeError:
+            return False
+
     def __getitem__(self, item):
-        for datfile in self.linked_files:
-            if item == datfile.name or item == datfile:
-                return datfile
-        raise KeyError(item)
+        if isinstance(item, DatFile):
+            if item not in self:
+                raise KeyError(item)
+            return item
+        try:
+            return self._linked_file_index()[item]
+        except TypeError:
+            raise KeyError(item)
 
     @staticmethod
-    def read(fname):
-        """Read a .MAK file and produce a `Project`"""
-        return CompassProjectParser(fname).parse()
+    def read(fname, lazy=False, columnar=False, workers=None, cache=None):
+        """
+        Read a .MAK file and produce a `Project`
+
+        :param lazy: (bool) parse only survey headers up front, deferring each survey's shots until accessed
+        :param columnar: (bool) store shots in memory-efficient :class:`davies.compass.columnar.ShotColumns`
+        :param workers: (int) number of processes with which to parse linked .DAT files in parallel
+        :param cache: (:class:`davies.compass.cache.ParseCache`) optional persistent parse cache for linked .DAT files
+        """
+        return CompassProjectParser(fname, lazy=lazy, columnar=columnar, workers=workers, cache=cache).parse()
 
     def _serialize(self):
         lines = []
@@ -486,6 +1141,17 @@ class Project(object):
             outf.write('\r\n'.join(self._serialize()))
             #outf.write('\x1A')  # ASCII "sub" ^Z marks EOF
 
+    def save_snapshot(self, fname):
+        """Write a compact binary snapshot of this project; see :mod:`davies.compass.snapshot`"""
+        from davies.compass.snapshot import save_snapshot
+        save_snapshot(self, fname)
+
+    @staticmethod
+    def load_snapshot(fname):
+        """Load a `Project` from a snapshot written by :meth:`save_snapshot`, memory-mapping its shot data"""
+        from davies.compass.snapshot import load_snapshot
+        return load_snapshot(fname)
+
 
 
 # File Parsing Utilities
@@ -507,9 +1173,16 @@ class ParseException(Exception):
 class CompassSurveyParser(object):
     """Parser for a Compass survey string."""
 
-    def __init__(self, survey_str):
-        """:param survey_str: string multiline representation of survey as found in .DAT file"""
+    def __init__(self, survey_str, lazy=False, strings=None):
+        """
+        :param survey_str: string multiline representation of survey as found in .DAT file
+        :param lazy: (bool) parse only the survey header, deferring shots until first accessed
+        :param strings: (:class:`davies.compass.columnar.StringTable`) if specified, produce a columnar
+                        survey which interns its station names into this (possibly shared) table
+        """
         self.survey_str = survey_str
+        self.lazy = lazy
+        self.strings = strings
 
     @staticmethod
     def _coerce(key, val):
@@ -547,16 +1220,20 @@ class CompassSurveyParser(object):
             elif tok == 'FORMAT:':
                 fmt = toks[i+1]
             elif tok == 'CORRECTIONS:':
-                corrections = map(float, toks[i+1:i+4])
+                corrections = tuple(map(float, toks[i+1:i+4]))
             elif tok == 'CORRECTIONS2:':
-                corrections2 = map(float, toks[i+1:i+3])
+                corrections2 = tuple(map(float, toks[i+1:i+3]))
         return declination, fmt, corrections, corrections2
 
     def parse(self):
         """Parse our string and return a Survey object, None, or raise :exc:`ParseException`"""
         if not self.survey_str:
             return None
-        lines = self.survey_str.splitlines()
+        if self.lazy:
+            # split off just the header lines, leaving the shot block as a single string
+            lines = self.survey_str.split('\n', 9)
+        else:
+            lines = self.survey_str.splitlines()
         if len(lines) < 10:
             raise ParseException("Expected at least 10 lines in a Compass Survey, only found %d!\nlines=%s" % (len(lines), lines))
 
@@ -583,15 +1260,31 @@ class CompassSurveyParser(object):
 
         lines.pop(0)
         shot_header = lines.pop(0).split()
-        val_count = len(shot_header) - 2 if 'FLAGS' in shot_header else len(shot_header)  # 1998 vintage data has no FLAGS, COMMENTS at end
         lines.pop(0)
 
-        survey = Survey(name=name, date=date, comment=comment, team=team, cave_name=cave_name,
-                        shot_header=shot_header, declination=declination,
-                        file_format=fmt, corrections=corrections, corrections2=corrections2)
+        survey_kwargs = dict(name=name, date=date, comment=comment, team=team, cave_name=cave_name,
+                             shot_header=shot_header, declination=declination,
+                             file_format=fmt, corrections=corrections, corrections2=corrections2)
+        if self.strings is not None:
+            from davies.compass.columnar import ColumnarSurvey
+            survey = ColumnarSurvey(strings=self.strings, **survey_kwargs)
+        else:
+            survey = Survey(**survey_kwargs)
+
+        if self.lazy:
+            survey._shot_block = '\n'.join(lines)
+            return survey
+
+        survey._set_parsed_shots(list(self._parse_shot_lines(name, shot_header, lines)))
+
+        #log.debug("Survey: name=%s shots=%d length=%0.1f date=%s team=%s\n%s", name, len(shots), survey.length, date, team, '\n'.join([str(shot) for shot in survey.shots]))
+
+        return survey
 
-        shots = []
-        shot_lines = lines
+    @staticmethod
+    def _parse_shot_lines(name, shot_header, shot_lines):
+        """Generator which parses shot lines, yielding a :class:`Shot` for each"""
+        val_count = len(shot_header) - 2 if 'FLAGS' in shot_header else len(shot_header)  # 1998 vintage data has no FLAGS, COMMENTS at end
         for shot_line in shot_lines:
             shot_vals = shot_line.split(None, val_count)
 
@@ -606,50 +1299,122 @@ class CompassSurveyParser(object):
                         raise ParseException('Invalid flags in %s survey: %s' % (name, flags_comment))  # A 2013 bug in Compass inserted corrupt binary garbage into FLAGS column, causes parse to barf
                 shot_vals += [flags, comment.strip()]
 
-            shot_vals = [(header, self._coerce(header, val)) for (header, val) in zip(shot_header, shot_vals)]
-            shot = Shot(shot_vals)
-            survey.add_shot(shot)
-
-        #log.debug("Survey: name=%s shots=%d length=%0.1f date=%s team=%s\n%s", name, len(shots), survey.length, date, team, '\n'.join([str(shot) for shot in survey.shots]))
-
-        return survey
+            shot_vals = [(header, CompassSurveyParser._coerce(header, val)) for (header, val) in zip(shot_header, shot_vals)]
+            yield _new_shot(shot_vals)
 
 
 class CompassDatParser(object):
     """Parser for Compass .DAT data files"""
 
-    def __init__(self, datfilename):
-        """:param datfilename: (string) filename"""
+    def __init__(self, datfilename, lazy=False, columnar=False, cache=None):
+        """
+        :param datfilename: (string) filename
+        :param lazy: (bool) parse only survey headers, deferring shots until first accessed
+        :param columnar: (bool) store shots in memory-efficient :class:`davies.compass.columnar.ShotColumns`
+        :param cache: (:class:`davies.compass.cache.ParseCache`) optional persistent parse cache
+        """
         self.datfilename = datfilename
+        self.lazy = lazy
+        self.columnar = columnar
+        self.cache = cache
 
     def parse(self):
         """Parse our data file and return a :class:`DatFile` or raise :exc:`ParseException`."""
+        if self.cache is not None:
+            datobj = self.cache.get(self.datfilename, lazy=self.lazy, columnar=self.columnar)
+            if datobj is not None:
+                return datobj
+            datobj = self._parse()
+            self.cache.put(self.datfilename, datobj, lazy=self.lazy, columnar=self.columnar)
+            return datobj
+        return self._parse()
+
+    def _parse(self):
         log.debug("Parsing Compass .DAT file %s ...", self.datfilename)
         datobj = DatFile(name_from_filename(self.datfilename), filename=self.datfilename)
 
-        with codecs.open(self.datfilename, 'rb', 'windows-1252') as datfile:
-            full_contents = datfile.read()
-            survey_strs = [survey_str.strip() for survey_str in full_contents.split('\x0C')]
+        for survey in self.iter_surveys():
+            datobj.add_survey(survey)
+        datobj._raw_tail = self._raw_tail
 
-            if survey_strs[-1] == '\x1A':
-                survey_strs.pop()  # Compass may place a "soft EOF" with ASCII SUB char
+        log.debug("Parsed %d surveys from Compass .DAT file %s.", len(datobj), self.datfilename)
+        return datobj
 
-            log.debug("Parsed %d raw surveys from Compass .DAT file %s.", len(survey_strs), self.datfilename)
-            for survey_str in survey_strs:
-                if not survey_str:
-                    continue
-                survey = CompassSurveyParser(survey_str).parse()
-                datobj.add_survey(survey)
+    def iter_surveys(self, chunk_size=64*1024):
+        """
+        Incrementally parse our data file, yielding one :class:`Survey` at a time or raising
+        :exc:`ParseException`. Only a single raw survey is held in memory at once.
 
-        return datobj
+        :param chunk_size: (int) number of bytes to read from the file at a time
+        """
+        if self.columnar:
+            from davies.compass.columnar import StringTable
+            strings = StringTable()  # shared by all surveys in the file
+        else:
+            strings = None
+
+        self._raw_tail = None
+        tail = None  # raw blocks following the most recent survey
+        with open(self.datfilename, 'rb') as datfile:
+            source = _source_file(self.datfilename)
+            for start, survey_bytes in _split_surveys(datfile, chunk_size):
+                # windows-1252 is a single-byte encoding, so splitting on the ^L byte is safe
+                survey_str = survey_bytes.decode('windows-1252').strip()
+                if not survey_str or survey_str == '\x1A':
+                    if tail is not None:
+                        tail.append(survey_bytes)
+                    continue  # Compass may place a "soft EOF" with ASCII SUB char
+                tail = []
+                survey = CompassSurveyParser(survey_str, lazy=self.lazy, strings=strings).parse()
+                eof = survey_bytes.find(b'\x1A')
+                if eof != -1:
+                    # the survey runs to a "soft EOF" without a ^L separator, keep the EOF as our tail
+                    tail.append(survey_bytes[eof:])
+                    survey_bytes = survey_bytes[:eof]
+                survey._set_raw(source, start, start + len(survey_bytes))
+                yield survey
+        self._raw_tail = b'\x0C'.join(tail) if tail else None
+
+
+def _split_surveys(f, chunk_size):
+    """
+    Generator which reads file `f` in chunks and yields `(offset, bytes)` for the raw bytes between
+    ASCII "form feed" ^L separators
+    """
+    pieces = []  # partial survey spanning chunk boundaries
+    start = 0
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        blocks = chunk.split(b'\x0C')
+        for block in blocks[:-1]:
+            pieces.append(block)
+            survey_bytes = b''.join(pieces)
+            yield start, survey_bytes
+            start += len(survey_bytes) + 1
+            pieces = []
+        pieces.append(blocks[-1])
+    yield start, b''.join(pieces)
 
 
 class CompassProjectParser(object):
     """Parser for Compass .MAK project files."""
 
-    def __init__(self, projectfile):
-        """:param projectfile: (string) filename"""
+    def __init__(self, projectfile, lazy=False, columnar=False, workers=None, cache=None):
+        """
+        :param projectfile: (string) filename
+        :param lazy: (bool) parse only survey headers, deferring shots until first accessed
+        :param columnar: (bool) store shots in memory-efficient :class:`davies.compass.columnar.ShotColumns`
+        :param workers: (int) size of the process pool used to parse linked .DAT files; `None` or `1`
+                        parses them serially in this process
+        :param cache: (:class:`davies.compass.cache.ParseCache`) optional persistent parse cache for linked .DAT files
+        """
         self.makfilename = projectfile
+        self.lazy = lazy
+        self.columnar = columnar
+        self.workers = workers
+        self.cache = cache
 
     def parse(self):
         """Parse our project file and return :class:`Project` object or raise :exc:`ParseException`."""
@@ -719,10 +1484,58 @@ class CompassProjectParser(object):
             project = Project(name_from_filename(self.makfilename), filename=self.makfilename)
             project.set_base_location(base_location)
 
-            for linked_file in linked_files:
-                # TODO: we need to support case-insensitive path resolution on case-sensitive filesystems
-                linked_file_path = os.path.join(os.path.dirname(self.makfilename), os.path.normpath(linked_file.replace('\\', '/')))
-                datfile = CompassDatParser(linked_file_path).parse()
+            # TODO: we need to support case-insensitive path resolution on case-sensitive filesystems
+            linked_file_paths = [os.path.join(os.path.dirname(self.makfilename), os.path.normpath(linked_file.replace('\\', '/')))
+                                 for linked_file in linked_files]
+            for datfile in self._parse_linked_files(linked_file_paths):
                 project.add_linked_file(datfile)
 
             return project
+
+    def _parse_linked_files(self, linked_file_paths):
+        """Parse linked .DAT files, returning a list of :class:`DatFile` in the same order as `linked_file_paths`"""
+        datfiles = [None] * len(linked_file_paths)
+        if self.cache is not None:
+            datfiles = [self.cache.get(path, lazy=self.lazy, columnar=self.columnar) for path in linked_file_paths]
+        pending = [i for (i, datfile) in enumerate(datfiles) if datfile is None]
+
+        workers = min(self.workers or 1, len(pending))
+        if workers <= 1:
+            for i in pending:
+                datfiles[i] = CompassDatParser(linked_file_paths[i], lazy=self.lazy, columnar=self.columnar).parse()
+        else:
+            self._parse_linked_files_parallel(linked_file_paths, pending, datfiles, workers)
+
+        if self.cache is not None:
+            for i in pending:
+                self.cache.put(linked_file_paths[i], datfiles[i], lazy=self.lazy, columnar=self.columnar)
+        return datfiles
+
+    def _parse_linked_files_parallel(self, linked_file_paths, pending, datfiles, workers):
+        """Parse the `pending` indexes of `linked_file_paths` in a process pool, storing results into `datfiles`"""
+        log.debug("Parsing %d linked files with %d worker processes ...", len(pending), workers)
+        # hand out the largest files first, so that one big straggler doesn't leave the rest of the pool idle
+        order = sorted(pending, key=lambda i: os.path.getsize(linked_file_paths[i]), reverse=True)
+        tasks = [(i, linked_file_paths[i], self.lazy, self.columnar) for i in order]
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            for i, datfile in pool.imap_unordered(_parse_linked_file, tasks):
+                datfiles[i] = datfile
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+
+def _parse_linked_file(task):
+    """
+    Process pool worker which parses a single linked .DAT file, returning `(index, DatFile)`. Since the
+    parent process unpickles every result itself, surveys are pickled compactly as :class:`_PackedShots`
+    and only unpacked in the parent when their shots are first accessed.
+    """
+    i, datfilename, lazy, columnar = task
+    return i, CompassDatParser(datfilename, lazy=lazy, columnar=columnar).parse()
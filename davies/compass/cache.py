@@ -0,0 +1,152 @@
+"""
+davies.compass.cache: Module for persistent on-disk caching of parsed Compass files
+"""
+
+import os
+import zlib
+import errno
+import pickle
+import hashlib
+import logging
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+__all__ = 'ParseCache',
+
+
+CACHE_VERSION = 2
+
+
+def _content_hash(fname, chunk_size=1024*1024):
+    """Calculate the SHA-1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParseCache(object):
+    """
+    Opt-in, size-limited, on-disk cache of parse results such as :class:`DatFile` objects.
+
+    Entries are keyed by source file path and parse options, and are only considered valid while the
+    source file's size, modification time, and content hash match those recorded at the time of
+    caching. A file which is merely "touched" is detected by its content hash and still hits the
+    cache. Results are stored as zlib-compressed pickles, and the least recently used entries are
+    evicted whenever the cache grows beyond :attr:`max_size` bytes.
+
+    Example usage::
+
+        cache = ParseCache(os.path.expanduser('~/.cache/davies'))
+        project = compass.Project.read('MYCAVE.MAK', cache=cache)
+
+    :ivar directory: (string) directory in which cache entries are stored
+    :ivar max_size:  (int) maximum total size of cache entries in bytes
+    :ivar hits:      (int) number of cache hits
+    :ivar misses:    (int) number of cache misses
+    """
+
+    def __init__(self, directory, max_size=256*1024*1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self._sizes = None  # entry filename -> size, lazily scanned from disk
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _entry_path(self, fname, options):
+        key = '%s\0%r' % (os.path.abspath(fname), sorted(options.items()))
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.cache')
+
+    def get(self, fname, **options):
+        """Return the cached parse result for file `fname` parsed with `options`, or `None`"""
+        entry_path = self._entry_path(fname, options)
+        try:
+            stat = os.stat(fname)
+            with open(entry_path, 'rb') as entry:
+                version, size, mtime, content_hash = pickle.load(entry)
+                if version != CACHE_VERSION or size != stat.st_size:
+                    raise ValueError('stale cache entry')
+                touched = mtime != stat.st_mtime
+                if touched and content_hash != _content_hash(fname):
+                    raise ValueError('stale cache entry')
+                payload = entry.read()
+                result = pickle.loads(zlib.decompress(payload))
+        except Exception as e:
+            if not isinstance(e, (IOError, OSError)):
+                log.debug("Discarding cache entry for %s: %s", fname, e)
+            self.misses += 1
+            return None
+
+        if touched:
+            if hasattr(result, '_refresh_source'):
+                result._refresh_source(fname)  # so unmodified surveys are still copied verbatim by DatFile.write()
+            try:
+                # record the new mtime, so that later hits needn't hash the file again
+                self._write_entry(entry_path, (CACHE_VERSION, stat.st_size, stat.st_mtime, content_hash), payload)
+            except (IOError, OSError):
+                pass
+        os.utime(entry_path, None)  # bump for LRU eviction
+        self.hits += 1
+        log.debug("Cache hit for %s", fname)
+        return result
+
+    def put(self, fname, result, **options):
+        """Store the parse `result` for file `fname` parsed with `options`"""
+        stat = os.stat(fname)
+        header = (CACHE_VERSION, stat.st_size, stat.st_mtime, _content_hash(fname))
+        entry_path = self._entry_path(fname, options)
+        self._write_entry(entry_path, header, zlib.compress(pickle.dumps(result, pickle.HIGHEST_PROTOCOL)))
+
+        sizes = self._entry_sizes()
+        sizes[os.path.basename(entry_path)] = os.path.getsize(entry_path)
+        if sum(sizes.values()) > self.max_size:
+            self._evict()
+
+    def _write_entry(self, entry_path, header, payload):
+        """Atomically write a cache entry of `header` values followed by the compressed `payload` bytes"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as entry:
+                pickle.dump(header, entry, pickle.HIGHEST_PROTOCOL)
+                entry.write(payload)
+            getattr(os, 'replace', os.rename)(tmp_path, entry_path)  # atomic, so concurrent readers never see partial entries
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _entry_sizes(self):
+        if self._sizes is None:
+            self._sizes = dict((name, os.path.getsize(os.path.join(self.directory, name)))
+                               for name in os.listdir(self.directory) if name.endswith('.cache'))
+        return self._sizes
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits within :attr:`max_size`"""
+        self._sizes = None  # rescan, other processes may share this cache directory
+        sizes = self._entry_sizes()
+        total = sum(sizes.values())
+        for name in sorted(sizes, key=lambda name: os.path.getmtime(os.path.join(self.directory, name))):
+            if total <= self.max_size:
+                break
+            log.debug("Evicting cache entry %s", name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= sizes.pop(name)
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        for name in list(self._entry_sizes()):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        self._sizes = {}
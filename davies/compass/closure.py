@@ -0,0 +1,336 @@
+"""
+davies.compass.closure: Least-squares loop closure for reduced survey networks
+
+A :class:`LoopClosure` adjusts the station coordinates of a :class:`davies.compass.reduction.Reduction`
+so that survey loops close, distributing each misclosure by weighted least squares. Each shot is
+weighted by the inverse of its length, so longer shots absorb more of the error.
+
+Rather than solving for every station, the network is first reduced as Compass does: dangling
+branches, which cannot affect a loop, are pruned, and each traverse between junction stations is
+collapsed into a single observation. The sparse normal equations of the remaining junctions are
+solved by preconditioned conjugate gradients (using NumPy when it is available). Traverse stations
+then take a share of their traverse's misclosure in proportion to their distance along it, and
+pruned branches follow the station they hang from.
+
+Exclude.CLOSURE (C) shots don't take part in the adjustment; any stations which they alone locate
+move rigidly with the station they're tied to.
+"""
+
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from davies.compass import Exclude, FLAG_BITS
+
+log = logging.getLogger(__name__)
+
+
+__all__ = 'LoopClosure',
+
+
+_CLOSURE_BIT = FLAG_BITS[Exclude.CLOSURE]
+
+MIN_VARIANCE = 1e-6  # variance of a zero-length shot, which ties two stations together
+
+
+def _conjugate_gradient(diag, rows, cols, weights, b, tolerance, max_iterations):
+    """
+    Solve `A x = b` for a symmetric positive-definite `A` with diagonal `diag` and off-diagonal
+    entries `A[rows[i], cols[i]] = -weights[i]`, by Jacobi-preconditioned conjugate gradients.
+    Returns `(x, iterations)`.
+    """
+    n = len(b)
+    if np is not None:
+        diag, b = np.array(diag, dtype=float), np.array(b, dtype=float)
+        rows, cols, weights = np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp), np.array(weights, dtype=float)
+        matvec = lambda v: diag * v - np.bincount(rows, weights * v[cols], minlength=n)
+        dot = np.dot
+        x, r = np.zeros(n), b.copy()
+        z = r / diag
+        p = z.copy()
+        rz, limit = dot(r, z), tolerance * tolerance * dot(b, b)
+        for iteration in range(max_iterations):
+            if dot(r, r) <= limit:
+                return x.tolist(), iteration
+            ap = matvec(p)
+            alpha = rz / dot(p, ap)
+            x += alpha * p
+            r -= alpha * ap
+            z = r / diag
+            rz, rz_prev = dot(r, z), rz
+            p = z + (rz / rz_prev) * p
+        return x.tolist(), max_iterations
+
+    entries = list(zip(rows, cols, weights))
+
+    def matvec(v):
+        out = [d * vi for (d, vi) in zip(diag, v)]
+        for i, j, w in entries:
+            out[i] -= w * v[j]
+        return out
+
+    def dot(u, v):
+        return sum([ui * vi for (ui, vi) in zip(u, v)])
+
+    x, r = [0.0] * n, list(b)
+    z = [ri / d for (ri, d) in zip(r, diag)]
+    p = list(z)
+    rz, limit = dot(r, z), tolerance * tolerance * dot(b, b)
+    for iteration in range(max_iterations):
+        if dot(r, r) <= limit:
+            return x, iteration
+        ap = matvec(p)
+        alpha = rz / dot(p, ap)
+        x = [xi + alpha * pi for (xi, pi) in zip(x, p)]
+        r = [ri - alpha * api for (ri, api) in zip(r, ap)]
+        z = [ri / d for (ri, d) in zip(r, diag)]
+        rz, rz_prev = dot(r, z), rz
+        beta = rz / rz_prev
+        p = [zi + beta * pi for (zi, pi) in zip(z, p)]
+    return x, max_iterations
+
+
+class LoopClosure(object):
+    """
+    Least-squares adjustment of the station coordinates of a :class:`davies.compass.reduction.Reduction`.
+
+    :ivar y:          (list of float) adjusted station North coordinates, indexed like the reduction's `names`
+    :ivar x:          (list of float) adjusted station East coordinates
+    :ivar z:          (list of float) adjusted station elevations
+    :ivar junctions:  (int) number of stations whose coordinates were solved for directly
+    :ivar traverses:  (int) number of traverses between junction stations
+    :ivar iterations: (int) most conjugate gradient iterations taken for any axis
+    """
+
+    def __init__(self, reduction, tolerance=1e-10, max_iterations=None):
+        """
+        :param reduction:      (:class:`davies.compass.reduction.Reduction`) unadjusted coordinates
+        :param tolerance:      (float) relative residual at which the iterative solver stops
+        :param max_iterations: (int) optional limit on solver iterations per axis
+        """
+        self._reduction = reduction
+        n = len(reduction.names)
+        frm, to, bits = reduction._frm, reduction._to, reduction._bits
+        placed_by = reduction.placed_by
+
+        # closure-excluded shots, and shots from a station to itself, take no part in the adjustment
+        shots = [s for s in range(len(frm)) if not bits[s] & _CLOSURE_BIT and frm[s] != to[s]]
+        adjacency = [[] for _ in range(n)]
+        for s in shots:
+            adjacency[frm[s]].append(s)
+            adjacency[to[s]].append(s)
+
+        # anchors hold their unadjusted position: fixed stations, and the station from which the
+        # reduction located each part of the network with no fixed station
+        anchored = [shot == -1 or bool(bits[shot] & _CLOSURE_BIT) for shot in placed_by]
+
+        alive = bytearray(len(frm))
+        for s in shots:
+            alive[s] = 1
+        pruned, degree = self._prune(adjacency, anchored, alive)
+        junction = [anchored[station] or degree[station] >= 3 for station in range(n)]
+        traverses = self._traverses(adjacency, junction, alive)
+        self.traverses = len(traverses)
+
+        pos = [list(reduction.y), list(reduction.x), list(reduction.z)]
+        self._solve(traverses, anchored, pos, tolerance, max_iterations)
+        self._distribute(traverses, pruned, pos)
+        self._follow_closure_shots(adjacency, anchored, pos)
+        self.y, self.x, self.z = pos
+
+    def _offset(self, shot):
+        reduction = self._reduction
+        return reduction._dy[shot], reduction._dx[shot], reduction._dz[shot]
+
+    def _prune(self, adjacency, anchored, alive):
+        """
+        Prune dangling branches, returning a list of `(station, shot, neighbor)` in pruning order and
+        the remaining degree of each station
+        """
+        frm, to = self._reduction._frm, self._reduction._to
+        degree = [sum([alive[s] for s in shots]) for shots in adjacency]
+        pruned = []
+        stack = [station for station in range(len(adjacency)) if degree[station] == 1 and not anchored[station]]
+        while stack:
+            station = stack.pop()
+            if degree[station] != 1:
+                continue
+            shot = next(s for s in adjacency[station] if alive[s])
+            alive[shot] = 0
+            degree[station] = 0
+            neighbor = to[shot] if frm[shot] == station else frm[shot]
+            pruned.append((station, shot, neighbor))
+            degree[neighbor] -= 1
+            if degree[neighbor] == 1 and not anchored[neighbor]:
+                stack.append(neighbor)
+        return pruned, degree
+
+    def _traverses(self, adjacency, junction, alive):
+        """
+        Collapse the pruned network into traverses between junction stations, returning a list of
+        `(from junction, to junction, [signed shots], variance)`. Shots walked backwards are stored
+        as their ones' complement.
+        """
+        frm, to, length = self._reduction._frm, self._reduction._to, self._reduction._length
+        visited = bytearray(len(frm))
+        traverses = []
+        for start in range(len(adjacency)):
+            if not junction[start]:
+                continue
+            for first in adjacency[start]:
+                if not alive[first] or visited[first]:
+                    continue
+                path, station, shot, variance = [], start, first, 0.0
+                while True:
+                    visited[shot] = 1
+                    if frm[shot] == station:
+                        path.append(shot)
+                        station = to[shot]
+                    else:
+                        path.append(~shot)
+                        station = frm[shot]
+                    variance += max(length[shot], MIN_VARIANCE)
+                    if junction[station]:
+                        break
+                    shot = next(s for s in adjacency[station] if alive[s] and s != shot)
+                traverses.append((start, station, path, variance))
+        return traverses
+
+    def _observed(self, path):
+        """Sum of the signed shot offsets along a traverse path"""
+        dy, dx, dz = self._reduction._dy, self._reduction._dx, self._reduction._dz
+        oy = ox = oz = 0.0
+        for shot in path:
+            if shot >= 0:
+                oy, ox, oz = oy + dy[shot], ox + dx[shot], oz + dz[shot]
+            else:
+                shot = ~shot
+                oy, ox, oz = oy - dy[shot], ox - dx[shot], oz - dz[shot]
+        return oy, ox, oz
+
+    def _solve(self, traverses, anchored, pos, tolerance, max_iterations):
+        """Solve for the corrections to unanchored junction stations, applying them to `pos`"""
+        unknowns = {}
+        for u, v, path, variance in traverses:
+            for station in (u, v):
+                if not anchored[station] and station not in unknowns:
+                    unknowns[station] = len(unknowns)
+        self.junctions = len(unknowns)
+        self.iterations = 0
+        if not unknowns:
+            return
+
+        n = len(unknowns)
+        diag, rows, cols, weights = [0.0] * n, [], [], []
+        rhs = [[0.0] * n for _ in range(3)]
+        for u, v, path, variance in traverses:
+            if u == v:
+                continue  # a loop back to the same junction only moves its own stations
+            w = 1.0 / variance
+            observed = self._observed(path)
+            iu, iv = unknowns.get(u, None), unknowns.get(v, None)
+            for axis in range(3):
+                misfit = w * (observed[axis] - (pos[axis][v] - pos[axis][u]))
+                if iv is not None:
+                    rhs[axis][iv] += misfit
+                if iu is not None:
+                    rhs[axis][iu] -= misfit
+            if iu is not None:
+                diag[iu] += w
+            if iv is not None:
+                diag[iv] += w
+            if iu is not None and iv is not None:
+                rows.extend((iu, iv))
+                cols.extend((iv, iu))
+                weights.extend((w, w))
+
+        if max_iterations is None:
+            max_iterations = 10 * n + 100
+        for axis in range(3):
+            correction, iterations = _conjugate_gradient(diag, rows, cols, weights, rhs[axis], tolerance, max_iterations)
+            if iterations == max_iterations:
+                log.warning('Loop closure did not converge within %d iterations', max_iterations)
+            self.iterations = max(self.iterations, iterations)
+            coords = pos[axis]
+            for station, i in unknowns.items():
+                coords[station] += correction[i]
+
+    def _distribute(self, traverses, pruned, pos):
+        """Locate traverse stations between their adjusted junctions, then pruned branch stations"""
+        frm, to, length = self._reduction._frm, self._reduction._to, self._reduction._length
+        for u, v, path, variance in traverses:
+            observed = self._observed(path)
+            misclosure = [pos[axis][v] - pos[axis][u] - observed[axis] for axis in range(3)]
+            coord = [pos[axis][u] for axis in range(3)]
+            distance = 0.0
+            for shot in path[:-1]:
+                sign, shot = (1, shot) if shot >= 0 else (-1, ~shot)
+                station = to[shot] if sign > 0 else frm[shot]
+                offset = self._offset(shot)
+                distance += max(length[shot], MIN_VARIANCE)
+                for axis in range(3):
+                    coord[axis] += sign * offset[axis]
+                    pos[axis][station] = coord[axis] + misclosure[axis] * distance / variance
+
+        for station, shot, neighbor in reversed(pruned):
+            sign = 1 if frm[shot] == neighbor else -1
+            offset = self._offset(shot)
+            for axis in range(3):
+                pos[axis][station] = pos[axis][neighbor] + sign * offset[axis]
+
+    def _follow_closure_shots(self, adjacency, anchored, pos):
+        """Move each part of the network which is tied on by a closure-excluded shot along with its tie station"""
+        reduction = self._reduction
+        frm, to, placed_by = reduction._frm, reduction._to, reduction.placed_by
+        ties = [station for (station, shot) in enumerate(placed_by) if anchored[station] and shot != -1]
+        if not ties:
+            return
+
+        # label the parts of the network which are connected without closure-excluded shots
+        part = [-1] * len(adjacency)
+        members = []
+        for start in range(len(adjacency)):
+            if part[start] != -1:
+                continue
+            part[start] = len(members)
+            stack, stations = [start], [start]
+            while stack:
+                station = stack.pop()
+                for shot in adjacency[station]:
+                    neighbor = to[shot] if frm[shot] == station else frm[shot]
+                    if part[neighbor] == -1:
+                        part[neighbor] = part[start]
+                        stack.append(neighbor)
+                        stations.append(neighbor)
+            members.append(stations)
+
+        original = reduction.y, reduction.x, reduction.z
+        tie_shots = dict((part[station], placed_by[station]) for station in ties)
+        moves = {}  # part -> translation of its stations
+
+        def tie_station(p):
+            shot = tie_shots[p]
+            return frm[shot] if part[to[shot]] == p else to[shot]
+
+        for p in tie_shots:
+            chain = []
+            while p in tie_shots and p not in moves:
+                chain.append(p)
+                p = part[tie_station(p)]
+            for p in reversed(chain):
+                station = tie_station(p)
+                move = moves.get(part[station], (0.0, 0.0, 0.0))
+                moves[p] = tuple(pos[axis][station] + move[axis] - original[axis][station] for axis in range(3))
+
+        for p, move in moves.items():
+            for station in members[p]:
+                for axis in range(3):
+                    pos[axis][station] += move[axis]
+
+    def __getitem__(self, station):
+        """Return the adjusted (Y, X, Z) coordinate of a station"""
+        i = self._reduction._ids[station]
+        return self.y[i], self.x[i], self.z[i]
@@ -0,0 +1,412 @@
+"""
+davies.compass.columnar: Memory-efficient columnar storage for Compass shots
+
+Rather than holding an :class:`OrderedDict` of boxed values per shot, a :class:`ColumnarSurvey`
+keeps its shots in typed arrays: float64 columns for LENGTH, BEARING, INC, AZM2, INC2 and LRUDs,
+interned string columns for FROM, TO and FLAGS, plus a bitmask column of exclusion flags. Shots
+are exposed as :class:`ShotView` objects, thin row views which behave like :class:`Shot`.
+"""
+
+from array import array
+try:
+    from collections.abc import MutableMapping, MutableSequence
+except ImportError:
+    from collections import MutableMapping, MutableSequence
+
+from davies.compass import Shot, Survey, EXCLUDED_BITS, flag_bits, average_azm, average_inc
+
+__all__ = 'StringTable', 'ShotColumns', 'ShotView', 'ColumnarSurvey'
+
+
+NAN = float('nan')
+
+_FLOAT_KEYS = ('LENGTH', 'BEARING', 'INC', 'AZM2', 'INC2', 'LEFT', 'UP', 'DOWN', 'RIGHT')
+_STRING_KEYS = ('FROM', 'TO', 'FLAGS')
+
+
+class StringTable(object):
+    """
+    Table of interned strings, which may be shared between the surveys of a whole :class:`DatFile`.
+
+    :ivar strings: (list of str) interned strings, indexed by id
+    """
+
+    def __init__(self):
+        self.strings = []
+        self._ids = {}
+
+    def intern(self, s):
+        """Return the integer id for string `s`, adding it to the table if necessary; `None` is id `-1`"""
+        if s is None:
+            return -1
+        try:
+            return self._ids[s]
+        except KeyError:
+            id = self._ids[s] = len(self.strings)
+            self.strings.append(s)
+            return id
+
+    def id(self, s):
+        """Return the integer id for string `s`, or `None` if it is not in the table"""
+        return self._ids.get(s, None)
+
+    def __getitem__(self, id):
+        return self.strings[id] if id != -1 else None
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getstate__(self):
+        return self.strings
+
+    def __setstate__(self, strings):
+        self.strings = strings
+        self._ids = dict((s, i) for (i, s) in enumerate(strings))
+
+
+class ShotColumns(MutableSequence):
+    """
+    Columnar storage for a sequence of shots. Indexing returns :class:`ShotView` row views, while
+    appending or assigning a shot (any mapping) copies its values into the underlying columns.
+
+    Note that views are positional; inserting or deleting shots shifts the rows that existing views
+    refer to.
+
+    :ivar strings:     (:class:`StringTable`) interned strings for FROM, TO and FLAGS columns
+    :ivar keys:        (list of str) column keys, in order of first appearance
+    :ivar columns:     (map of key -> column) `array('d')` for float keys (`None` is stored as NaN),
+                       `array('i')` of string ids for string keys, and `list` for any other keys
+    :ivar present:     (`array('I')`) per-row bitmask of which :attr:`keys` each shot has
+    :ivar flag_bits:   (`array('B')`) per-row bitmask of :data:`FLAG_BITS`
+    :ivar declination: (`array('d')`) per-row magnetic declination
+
+    Columns may also be read-only `memoryview` objects, such as those of a memory-mapped
+    :mod:`davies.compass.snapshot`; these are copied into private arrays on first modification.
+    """
+    _mapped = False  # columns are read-only views, copied on write
+
+    def __init__(self, strings=None, shots=()):
+        self.strings = strings if strings is not None else StringTable()
+        self.keys = []
+        self.columns = {}
+        self.present = array('I')
+        self.flag_bits = array('B')
+        self.declination = array('d')
+        self._key_bits = {}
+        self._survey = None  # the ColumnarSurvey which owns us, notified of changes
+        self.extend(shots)
+
+    def _key_bit(self, key):
+        """Return the presence bit for `key`, adding a new column if necessary"""
+        try:
+            return self._key_bits[key]
+        except KeyError:
+            pass
+        if len(self.keys) >= 8 * self.present.itemsize:
+            raise ValueError('Too many distinct shot keys for columnar storage: %s' % key)
+        n = len(self)
+        if key in _FLOAT_KEYS:
+            column = array('d', [NAN]) * n
+        elif key in _STRING_KEYS:
+            column = array('i', [-1]) * n
+        else:
+            column = [None] * n
+        self.columns[key] = column
+        bit = self._key_bits[key] = 1 << len(self.keys)
+        self.keys.append(key)
+        return bit
+
+    def _copy_on_write(self):
+        """Replace read-only column views with writable arrays of the same type"""
+        self._mapped = False
+        for key, column in list(self.columns.items()):
+            if isinstance(column, memoryview):
+                self.columns[key] = array(column.format, column.tobytes())
+        self.present = array('I', self.present.tobytes())
+        self.flag_bits = array('B', self.flag_bits.tobytes())
+        self.declination = array('d', self.declination.tobytes())
+
+    def _encode(self, key, val):
+        if key in _FLOAT_KEYS:
+            return float(val) if val is not None else NAN
+        elif key in _STRING_KEYS:
+            return self.strings.intern(val)
+        return val
+
+    def _decode(self, key, val):
+        if key in _FLOAT_KEYS:
+            return val if val == val else None  # NaN
+        elif key in _STRING_KEYS:
+            return self.strings[val]
+        return val
+
+    def get_value(self, row, key, default=None):
+        """Return the value of `key` for shot `row`, or `default` if that shot has no such key"""
+        bit = self._key_bits.get(key, 0)
+        if not self.present[row] & bit:
+            return default
+        return self._decode(key, self.columns[key][row])
+
+    def set_value(self, row, key, val):
+        """Set the value of `key` for shot `row`"""
+        if self._mapped:
+            self._copy_on_write()
+        bit = self._key_bit(key)
+        self.columns[key][row] = self._encode(key, val)
+        self.present[row] |= bit
+        if key == 'FLAGS':
+            self.flag_bits[row] = flag_bits(val)
+        if self._survey is not None:
+            self._survey._shot_changed(ShotView(self, row), key)
+
+    def del_value(self, row, key):
+        """Remove `key` from shot `row` or raise :exc:`KeyError`"""
+        if self._mapped:
+            self._copy_on_write()
+        bit = self._key_bits.get(key, 0)
+        if not self.present[row] & bit:
+            raise KeyError(key)
+        self.present[row] &= ~bit
+        self.columns[key][row] = self._encode(key, None)
+        if key == 'FLAGS':
+            self.flag_bits[row] = 0
+        if self._survey is not None:
+            self._survey._shot_changed(ShotView(self, row), key)
+
+    def row_keys(self, row):
+        """Return the keys present for shot `row`"""
+        present = self.present[row]
+        return [key for key in self.keys if present & self._key_bits[key]]
+
+    def column(self, key):
+        """Return a list of decoded values for `key` for every shot, `None` where missing"""
+        column = self.columns.get(key, None)
+        if column is None:
+            return [None] * len(self)
+        bit = self._key_bits[key]
+        return [self._decode(key, val) if present & bit else None for (val, present) in zip(column, self.present)]
+
+    def __len__(self):
+        return len(self.present)
+
+    def _row(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('shot index out of range')
+        return i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ShotView(self, row) for row in range(*i.indices(len(self)))]
+        return ShotView(self, self._row(i))
+
+    def __setitem__(self, i, shot):
+        if isinstance(i, slice):
+            raise TypeError('%s does not support slice assignment' % self.__class__.__name__)
+        if self._mapped:
+            self._copy_on_write()
+        row = self._row(i)
+        for key in self.keys:
+            self.columns[key][row] = self._encode(key, None)
+        self.present[row] = 0
+        self.flag_bits[row] = 0
+        self.declination[row] = getattr(shot, 'declination', 0.0)
+        for key, val in shot.items():
+            self.set_value(row, key, val)
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            for row in sorted(range(*i.indices(len(self))), reverse=True):
+                del self[row]
+            return
+        if self._mapped:
+            self._copy_on_write()
+        row = self._row(i)
+        for column in self.columns.values():
+            del column[row]
+        del self.present[row]
+        del self.flag_bits[row]
+        del self.declination[row]
+        if self._survey is not None:
+            self._survey.invalidate_lengths()
+
+    def insert(self, i, shot):
+        if self._mapped:
+            self._copy_on_write()
+        n = len(self)
+        row = max(0, min(n, i + n if i < 0 else i))
+        for key in self.keys:
+            column = self.columns[key]
+            column.insert(row, NAN if key in _FLOAT_KEYS else -1 if key in _STRING_KEYS else None)
+        self.present.insert(row, 0)
+        self.flag_bits.insert(row, 0)
+        self.declination.insert(row, 0.0)
+        self[row] = shot
+
+    def append(self, shot):
+        # fast path for the common case of appending to the end
+        if self._mapped:
+            self._copy_on_write()
+        row = len(self)
+        self.present.append(0)
+        self.flag_bits.append(0)
+        self.declination.append(getattr(shot, 'declination', 0.0))
+        for key in self.keys:
+            column = self.columns[key]
+            column.append(NAN if key in _FLOAT_KEYS else -1 if key in _STRING_KEYS else None)
+        survey, self._survey = self._survey, None  # a new shot isn't a change to an existing one
+        try:
+            for key, val in shot.items():
+                self.set_value(row, key, val)
+        finally:
+            self._survey = survey
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield ShotView(self, row)
+
+    def __getstate__(self):
+        if self._mapped:
+            self._copy_on_write()  # views of a memory-mapped file can't be pickled
+        return self.__dict__
+
+    def __repr__(self):
+        return '<%s %d shots>' % (self.__class__.__name__, len(self))
+
+
+class ShotView(MutableMapping):
+    """
+    Row view of a single shot within :class:`ShotColumns`, which provides the same interface as
+    :class:`Shot`. Reading or writing values reads or writes the underlying columns.
+    """
+
+    def __init__(self, columns, row):
+        self._columns = columns
+        self._row = row
+
+    # derived values are calculated exactly as for a dictionary-backed Shot
+    azm = Shot.azm
+    inc = Shot.inc
+    flags = Shot.flags
+    length = Shot.length
+    is_included = Shot.is_included
+    is_excluded = Shot.is_excluded
+
+    @property
+    def flag_bits(self):
+        return self._columns.flag_bits[self._row]
+
+    @property
+    def declination(self):
+        return self._columns.declination[self._row]
+
+    @declination.setter
+    def declination(self, declination):
+        if self._columns._mapped:
+            self._columns._copy_on_write()
+        self._columns.declination[self._row] = declination
+
+    def __getitem__(self, key):
+        columns = self._columns
+        if not columns.present[self._row] & columns._key_bits.get(key, 0):
+            raise KeyError(key)
+        return columns._decode(key, columns.columns[key][self._row])
+
+    def get(self, key, default=None):
+        return self._columns.get_value(self._row, key, default)
+
+    def __setitem__(self, key, val):
+        self._columns.set_value(self._row, key, val)
+
+    def __delitem__(self, key):
+        self._columns.del_value(self._row, key)
+
+    def __iter__(self):
+        return iter(self._columns.row_keys(self._row))
+
+    def __len__(self):
+        return len(self._columns.row_keys(self._row))
+
+    def __contains__(self, key):
+        return bool(self._columns.present[self._row] & self._columns._key_bits.get(key, 0))
+
+    __str__ = Shot.__dict__['__str__']
+    __repr__ = Shot.__dict__['__repr__']
+
+
+def _corrected_columns(shots, keys, with_flag_bits=False):
+    """
+    Return a list of values for each of `keys` across a survey's `shots`, followed by lists of each
+    shot's corrected azm and inc as by :attr:`Shot.azm` and :attr:`Shot.inc`, and if `with_flag_bits`
+    a list of each shot's :attr:`Shot.flag_bits`. :class:`ShotColumns` are read column by column
+    rather than boxing every row.
+    """
+    if isinstance(shots, ShotColumns):
+        column = shots.column
+        declination, bits = shots.declination, shots.flag_bits
+    else:
+        column = lambda key: [shot.get(key, None) for shot in shots]
+        declination = [shot.declination for shot in shots]
+        bits = [shot.flag_bits for shot in shots] if with_flag_bits else None
+    columns = dict((key, column(key)) for key in set(keys) | set(('BEARING', 'AZM2', 'INC', 'INC2')))
+    azm = [average_azm(a1, a2) for (a1, a2) in zip(columns['BEARING'], columns['AZM2'])]
+    azm = [a + d if a is not None else None for (a, d) in zip(azm, declination)]
+    inc = [average_inc(i1, i2) for (i1, i2) in zip(columns['INC'], columns['INC2'])]
+    return [columns[key] for key in keys] + [azm, inc] + ([bits] if with_flag_bits else [])
+
+
+class ColumnarSurvey(Survey):
+    """
+    A :class:`Survey` which stores its shots in :class:`ShotColumns`.
+
+    :ivar shots: (:class:`ShotColumns`) sequence of :class:`ShotView`
+    """
+
+    def __init__(self, *args, **kwargs):
+        """:kwarg strings: (:class:`StringTable`) optional string table shared with other surveys"""
+        self._strings = kwargs.pop('strings', None) or StringTable()
+        Survey.__init__(self, *args, **kwargs)
+
+    def _set_shots(self, shots):
+        self._shot_block = None
+        self._shots = shots if isinstance(shots, ShotColumns) else ShotColumns(self._strings, shots)
+        self._shots._survey = self
+
+    def add_shot(self, shot):
+        """Copy a shot dictionary into :attr:`shots`, applying this survey's magnetic declination"""
+        shots = self.shots
+        shots.append(shot)
+        shots.declination[-1] = self.declination
+        self._shot_added(shots[-1])
+
+    def _set_parsed_shots(self, shots):
+        self._set_shots(shots)
+        self._shots.declination = array('d', [self.declination]) * len(shots)
+        self._lengths = None
+
+    def _compute_lengths(self):
+        shots = self.shots
+        total = included = excluded = 0
+        for length, bits in zip(shots.columns.get('LENGTH', ()), shots.flag_bits):
+            if length != length:  # NaN
+                continue
+            total += length
+            if bits & EXCLUDED_BITS:
+                excluded += length
+            else:
+                included += length
+        return len(shots), total, included, excluded
+
+    def included_mask(self):
+        """List of booleans, one per shot, indicating whether each shot is included in length totals"""
+        return [not bits & EXCLUDED_BITS for bits in self.shots.flag_bits]
+
+    def __contains__(self, item):
+        """Does this survey contain the specified station?"""
+        shots = self.shots
+        id = shots.strings.id(item)
+        if id is None:
+            return False
+        return id in shots.columns.get('FROM', ()) or id in shots.columns.get('TO', ())
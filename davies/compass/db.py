@@ -0,0 +1,285 @@
+"""
+davies.compass.db: SQLite database of Compass survey data, for ad-hoc queries across whole archives
+
+A :class:`ShotDatabase` stores the projects, .DAT files, surveys, survey team members, and shots of
+any number of Compass projects in an indexed SQLite database, so that questions like these no
+longer require re-parsing every file::
+
+    db = ShotDatabase('archive.sqlite')
+    db.store(compass.Project.read('MYCAVE.MAK'))
+
+    # longest shots
+    db.execute('SELECT from_station, to_station, length FROM shots ORDER BY length DESC LIMIT 10')
+
+    # surveys by a person in a date range (dates are stored as ISO 8601 text)
+    db.execute('SELECT surveys.* FROM team JOIN surveys ON surveys.id = team.survey_id '
+               'WHERE team.name = ? AND surveys.date BETWEEN ? AND ?', ('Dave Riggs', '2000-01-01', '2009-12-31'))
+
+    # closure-excluded shots; `flag_bits != 0` lets SQLite use the index of flagged shots
+    db.execute('SELECT * FROM shots WHERE flag_bits != 0 AND flag_bits & ?', (FLAG_BITS[Exclude.CLOSURE],))
+
+Rows are written with batched `executemany` inserts, a whole .DAT file per transaction. Storing a
+project again only rewrites those .DAT files which have changed, and :meth:`ShotDatabase.refresh`
+re-reads just the stored .DAT files which have changed on disk.
+"""
+
+import os.path
+import sqlite3
+import logging
+
+from davies.compass import DatFile, _source_file
+from davies.compass.columnar import _corrected_columns
+
+log = logging.getLogger(__name__)
+
+
+__all__ = 'ShotDatabase',
+
+
+DB_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE projects (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    filename TEXT,
+    base_easting REAL,
+    base_northing REAL,
+    base_elevation REAL,
+    utm_zone INTEGER,
+    utm_datum TEXT
+);
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY,
+    project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE,
+    name TEXT,
+    filename TEXT,
+    size INTEGER,
+    mtime INTEGER
+);
+CREATE TABLE surveys (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT,
+    date TEXT,
+    comment TEXT,
+    cave_name TEXT,
+    declination REAL,
+    file_format TEXT,
+    shot_count INTEGER,
+    length REAL,
+    included_length REAL
+);
+CREATE TABLE team (
+    survey_id INTEGER NOT NULL REFERENCES surveys(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT
+);
+CREATE TABLE shots (
+    id INTEGER PRIMARY KEY,
+    survey_id INTEGER NOT NULL REFERENCES surveys(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    from_station TEXT,
+    to_station TEXT,
+    length REAL,
+    bearing REAL,
+    azm2 REAL,
+    inc REAL,
+    inc2 REAL,
+    corrected_azm REAL,
+    corrected_inc REAL,
+    left REAL,
+    up REAL,
+    down REAL,
+    right REAL,
+    flags TEXT,
+    flag_bits INTEGER NOT NULL,
+    comments TEXT
+);
+CREATE INDEX files_project ON files(project_id, name);
+CREATE INDEX surveys_file ON surveys(file_id);
+CREATE INDEX surveys_name ON surveys(name);
+CREATE INDEX surveys_date ON surveys(date);
+CREATE INDEX team_survey ON team(survey_id);
+CREATE INDEX team_name ON team(name);
+CREATE INDEX shots_survey ON shots(survey_id);
+CREATE INDEX shots_from ON shots(from_station);
+CREATE INDEX shots_to ON shots(to_station);
+CREATE INDEX shots_length ON shots(length);
+CREATE INDEX shots_flagged ON shots(flag_bits) WHERE flag_bits != 0;
+"""
+
+# shot keys stored in the columns which follow `to_station` in the shots table, in order
+_SHOT_KEYS = ('LENGTH', 'BEARING', 'AZM2', 'INC', 'INC2')
+_LRUD_KEYS = ('LEFT', 'UP', 'DOWN', 'RIGHT')
+
+
+def _shot_rows(survey, survey_id, first_id):
+    """Return a list of shots table rows for a survey's shots, with ids counting from `first_id`"""
+    keys = ('FROM', 'TO') + _SHOT_KEYS + _LRUD_KEYS + ('FLAGS', 'COMMENTS')
+    columns = _corrected_columns(survey.shots, keys, with_flag_bits=True)
+    frm, to, length, bearing, azm2, inc1, inc2, left, up, down, right, flags, comments, azm, inc, bits = columns
+    return list(zip(range(first_id, first_id + len(frm)), [survey_id] * len(frm), range(len(frm)),
+                    frm, to, length, bearing, azm2, inc1, inc2, azm, inc, left, up, down, right,
+                    [f or None for f in flags], bits, [c or None for c in comments]))
+
+
+class ShotDatabase(object):
+    """
+    SQLite database of Compass projects and .DAT files. See the module documentation for its tables
+    and example queries.
+
+    :ivar filename:   (string) database filename, or `':memory:'`
+    :ivar connection: (:class:`sqlite3.Connection`) connection to the database, for queries
+    """
+
+    def __init__(self, filename=':memory:'):
+        """:param filename: (string) database filename, which is created if necessary"""
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version == 0:
+            with self.connection:
+                self.connection.executescript(_SCHEMA)
+                self.connection.execute('PRAGMA user_version = %d' % DB_VERSION)
+        elif version != DB_VERSION:
+            raise ValueError('Unsupported database version %d: %s' % (version, filename))
+
+    def close(self):
+        """Close the database connection"""
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, sql, parameters=()):
+        """Execute a SQL query and return the :class:`sqlite3.Cursor`"""
+        return self.connection.execute(sql, parameters)
+
+    def _project_id(self, project):
+        """Return the id of the projects row for a :class:`Project`, inserting or updating it as necessary"""
+        loc = project.base_location
+        filename = os.path.abspath(project.filename) if project.filename else None
+        values = (project.name, filename,
+                  loc.easting if loc else None, loc.northing if loc else None, loc.elevation if loc else None,
+                  project._utm_zone, project._utm_datum)
+        if filename:
+            row = self.execute('SELECT id FROM projects WHERE filename = ?', (filename,)).fetchone()
+        else:
+            row = self.execute('SELECT id FROM projects WHERE filename IS NULL AND name = ?', (project.name,)).fetchone()
+        if row is None:
+            return self.execute('INSERT INTO projects (name, filename, base_easting, base_northing, base_elevation, '
+                                'utm_zone, utm_datum) VALUES (?, ?, ?, ?, ?, ?, ?)', values).lastrowid
+        self.execute('UPDATE projects SET name = ?, filename = ?, base_easting = ?, base_northing = ?, '
+                     'base_elevation = ?, utm_zone = ?, utm_datum = ? WHERE id = ?', values + (row[0],))
+        return row[0]
+
+    def store(self, project):
+        """
+        Store a :class:`davies.compass.Project`, replacing any previously stored copy of it. Only
+        those linked .DAT files which have changed since they were stored are rewritten, and files
+        which are no longer linked are removed. Returns the number of .DAT files written.
+        """
+        with self.connection:
+            project_id = self._project_id(project)
+        datfiles = [datfile for datfile in project if isinstance(datfile, DatFile)]
+        written = sum([self._store_datfile(datfile, project_id) for datfile in datfiles])
+
+        names = set(datfile.name for datfile in datfiles)
+        with self.connection:
+            for file_id, name in self.execute('SELECT id, name FROM files WHERE project_id = ?', (project_id,)).fetchall():
+                if name not in names:
+                    log.debug("Removing %s, no longer linked to project %s", name, project.name)
+                    self._delete_surveys(file_id)
+                    self.execute('DELETE FROM files WHERE id = ?', (file_id,))
+        return written
+
+    def store_datfile(self, datfile, project=None):
+        """
+        Store a single :class:`davies.compass.DatFile`, optionally as part of the specified
+        :class:`davies.compass.Project`, replacing any previously stored copy of it unless it is
+        unchanged. Returns `True` if the file was written.
+        """
+        with self.connection:
+            project_id = self._project_id(project) if project is not None else None
+        return self._store_datfile(datfile, project_id)
+
+    def _store_datfile(self, datfile, project_id):
+        filename = os.path.abspath(datfile.filename) if datfile.filename else None
+        source = _source_file(filename) if filename else None
+        with self.connection:
+            if project_id is None:
+                row = self.execute('SELECT id, size, mtime FROM files WHERE project_id IS NULL AND name = ?',
+                                   (datfile.name,)).fetchone()
+            else:
+                row = self.execute('SELECT id, size, mtime FROM files WHERE project_id = ? AND name = ?',
+                                   (project_id, datfile.name)).fetchone()
+            if row is not None and source is not None and tuple(row[1:]) == (source.size, source.mtime) \
+                    and not any(survey.is_dirty for survey in datfile):
+                return False  # unchanged since we stored it
+
+            size, mtime = (source.size, source.mtime) if source is not None else (None, None)
+            if row is None:
+                file_id = self.execute('INSERT INTO files (project_id, name, filename, size, mtime) VALUES (?, ?, ?, ?, ?)',
+                                       (project_id, datfile.name, filename, size, mtime)).lastrowid
+            else:
+                file_id = row[0]
+                self._delete_surveys(file_id)
+                self.execute('UPDATE files SET filename = ?, size = ?, mtime = ? WHERE id = ?',
+                             (filename, size, mtime, file_id))
+            self._insert_surveys(datfile, file_id)
+        log.debug("Stored %d surveys from %s", len(datfile), datfile.name)
+        return True
+
+    def _delete_surveys(self, file_id):
+        surveys = '(SELECT id FROM surveys WHERE file_id = ?)'
+        self.execute('DELETE FROM shots WHERE survey_id IN ' + surveys, (file_id,))
+        self.execute('DELETE FROM team WHERE survey_id IN ' + surveys, (file_id,))
+        self.execute('DELETE FROM surveys WHERE file_id = ?', (file_id,))
+
+    def _insert_surveys(self, datfile, file_id):
+        # we assign ids ourselves, so that each table is written with a single executemany()
+        survey_id = self.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM surveys').fetchone()[0]
+        shot_id = self.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM shots').fetchone()[0]
+        surveys, team, shots = [], [], []
+        for position, survey in enumerate(datfile):
+            rows = _shot_rows(survey, survey_id, shot_id)
+            surveys.append((survey_id, file_id, position, survey.name, survey.date.isoformat() if survey.date else None,
+                            survey.comment, survey.cave_name, survey.declination, survey.file_format,
+                            len(rows), survey.length, survey.included_length))
+            team.extend((survey_id, i, member) for (i, member) in enumerate(survey.team or ()) if member)
+            shots.extend(rows)
+            survey_id += 1
+            shot_id += len(rows)
+        self.connection.executemany('INSERT INTO surveys VALUES (%s)' % ', '.join(['?'] * 12), surveys)
+        self.connection.executemany('INSERT INTO team VALUES (?, ?, ?)', team)
+        self.connection.executemany('INSERT INTO shots VALUES (%s)' % ', '.join(['?'] * 19), shots)
+
+    def refresh(self, columnar=True):
+        """
+        Re-read and store those previously stored .DAT files which have changed on disk, and remove
+        those which no longer exist. Returns the number of .DAT files re-read.
+
+        :param columnar: (bool) parse with memory-efficient columnar storage, see :meth:`DatFile.read`
+        """
+        written = 0
+        for file_id, project_id, name, filename, size, mtime in \
+                self.execute('SELECT id, project_id, name, filename, size, mtime FROM files').fetchall():
+            if not filename:
+                continue
+            source = _source_file(filename)
+            if source is None:
+                log.debug("Removing %s, which no longer exists", filename)
+                with self.connection:
+                    self._delete_surveys(file_id)
+                    self.execute('DELETE FROM files WHERE id = ?', (file_id,))
+            elif (source.size, source.mtime) != (size, mtime):
+                datfile = DatFile.read(filename, columnar=columnar)
+                datfile.name = name  # as it was named within its project
+                written += self._store_datfile(datfile, project_id)
+        return written
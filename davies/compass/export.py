@@ -0,0 +1,183 @@
+"""
+davies.compass.export: Streaming export of Compass shots as a single flat table
+
+Shots from a whole :class:`davies.compass.Project`, :class:`davies.compass.DatFile`, or list of .DAT
+filenames are flattened into one table with a row per shot and the columns listed in
+:data:`COLUMNS`, ready to be loaded by tools like `pandas`. Rows are produced in batches of at
+most `batch_size` shots, and each batch is written out and discarded before the next is built, so
+memory use stays flat however large the project. When exporting from .DAT filenames, surveys are
+also parsed one at a time.
+
+CSV export uses only the standard library; Apache Parquet and Arrow IPC export require `pyarrow`.
+Each batch is written as one Parquet row group or Arrow record batch.
+
+Example usage::
+
+    from davies.compass import export
+
+    export.write_parquet(compass.Project.read('MYCAVE.MAK'), 'shots.parquet')
+
+    # or, without pyarrow
+    export.write_csv(glob.glob('*.DAT'), 'shots.csv')
+"""
+
+import io
+import csv
+import logging
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+from davies.compass import Project, DatFile, Survey, CompassDatParser, name_from_filename
+from davies.compass.columnar import _corrected_columns
+
+log = logging.getLogger(__name__)
+
+
+__all__ = 'COLUMNS', 'iter_shot_batches', 'write_csv', 'write_parquet', 'write_arrow'
+
+
+COLUMNS = ('file', 'survey', 'date', 'from', 'to', 'length', 'azm', 'inc', 'flags')
+"""Columns of the exported shots table; `azm` and `inc` are corrected as by :attr:`davies.compass.Shot.azm`"""
+
+DEFAULT_BATCH_SIZE = 64 * 1024
+
+
+def _file_surveys(source):
+    """Yield `(file name, survey)` for a Project, DatFile, Survey, .DAT filename, or iterable of these"""
+    if isinstance(source, Project):
+        for datfile in source:
+            if isinstance(datfile, DatFile):
+                for survey in datfile:
+                    yield datfile.name, survey
+    elif isinstance(source, DatFile):
+        for survey in source:
+            yield source.name, survey
+    elif isinstance(source, Survey):
+        yield getattr(source._parent, 'name', None), source
+    elif isinstance(source, (str, type(u''))):
+        name = name_from_filename(source)
+        for survey in CompassDatParser(source).iter_surveys():
+            yield name, survey
+    else:
+        for item in source:
+            for file_survey in _file_surveys(item):
+                yield file_survey
+
+
+def _survey_columns(survey):
+    """Return lists of `(FROM, TO, LENGTH, azm, inc, FLAGS)` values for a survey's shots"""
+    frm, to, length, flags, azm, inc = _corrected_columns(survey.shots, ('FROM', 'TO', 'LENGTH', 'FLAGS'))
+    return frm, to, length, azm, inc, [f or '' for f in flags]
+
+
+def iter_shot_batches(source, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Generator which yields batches of the shots table, each a map of :data:`COLUMNS` name -> list of
+    at most `batch_size` values. A batch may be passed directly to `pandas.DataFrame`.
+
+    :param source: (:class:`davies.compass.Project`, :class:`davies.compass.DatFile`, .DAT filename,
+                   or iterable of these or of :class:`davies.compass.Survey`) shots to export
+    :param batch_size: (int) maximum number of rows per batch
+    """
+    if batch_size < 1:
+        raise ValueError('batch_size must be positive: %s' % batch_size)
+    batch = dict((name, []) for name in COLUMNS)
+    for fname, survey in _file_surveys(source):
+        values = _survey_columns(survey)
+        n = len(values[0])
+        start = 0
+        while start < n:
+            end = min(n, start + batch_size - len(batch['file']))
+            batch['file'].extend([fname] * (end - start))
+            batch['survey'].extend([survey.name] * (end - start))
+            batch['date'].extend([survey.date] * (end - start))
+            for name, column in zip(COLUMNS[3:], values):
+                batch[name].extend(column[start:end])
+            start = end
+            if len(batch['file']) == batch_size:
+                yield batch
+                batch = dict((name, []) for name in COLUMNS)
+    if batch['file']:
+        yield batch
+
+
+def write_csv(source, f, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Write the shots table to a CSV file with a header row. Missing values are written as empty
+    fields, and dates in ISO 8601 format.
+
+    :param source: shots to export, see :func:`iter_shot_batches`
+    :param f: (str or file) output filename, or text file opened with `newline=''`
+    """
+    if not hasattr(f, 'write'):
+        with io.open(f, 'w', newline='', encoding='utf-8') as outf:
+            return write_csv(source, outf, batch_size)
+    writer = csv.writer(f)
+    writer.writerow(COLUMNS)
+    rows = 0
+    for batch in iter_shot_batches(source, batch_size):
+        writer.writerows(zip(*[batch[name] for name in COLUMNS]))
+        rows += len(batch['file'])
+    log.debug("Wrote %d shots as CSV", rows)
+    return rows
+
+
+def _schema():
+    return pa.schema([('file', pa.string()), ('survey', pa.string()), ('date', pa.date32()),
+                      ('from', pa.string()), ('to', pa.string()),
+                      ('length', pa.float64()), ('azm', pa.float64()), ('inc', pa.float64()),
+                      ('flags', pa.string())])
+
+
+def _record_batches(source, batch_size, schema):
+    for batch in iter_shot_batches(source, batch_size):
+        yield pa.RecordBatch.from_arrays([pa.array(batch[field.name], type=field.type) for field in schema],
+                                         schema=schema)
+
+
+def write_parquet(source, f, batch_size=DEFAULT_BATCH_SIZE, compression='snappy'):
+    """
+    Write the shots table to an Apache Parquet file, one row group per batch. Requires `pyarrow`.
+
+    :param source: shots to export, see :func:`iter_shot_batches`
+    :param f: (str or file) output filename, or binary file
+    :param compression: (str) Parquet compression codec
+    """
+    if pa is None:
+        raise ImportError('write_parquet() requires pyarrow')
+    import pyarrow.parquet as pq
+    schema, rows = _schema(), 0
+    writer = pq.ParquetWriter(f, schema, compression=compression)
+    try:
+        for record_batch in _record_batches(source, batch_size, schema):
+            writer.write_table(pa.Table.from_batches([record_batch]), row_group_size=batch_size)
+            rows += record_batch.num_rows
+    finally:
+        writer.close()
+    log.debug("Wrote %d shots as Parquet", rows)
+    return rows
+
+
+def write_arrow(source, f, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Write the shots table to an Arrow IPC (Feather version 2) file, one record batch per batch.
+    Requires `pyarrow`.
+
+    :param source: shots to export, see :func:`iter_shot_batches`
+    :param f: (str or file) output filename, or binary file
+    """
+    if pa is None:
+        raise ImportError('write_arrow() requires pyarrow')
+    schema, rows = _schema(), 0
+    writer = pa.ipc.new_file(f, schema)
+    try:
+        for record_batch in _record_batches(source, batch_size, schema):
+            writer.write_batch(record_batch)
+            rows += record_batch.num_rows
+    finally:
+        writer.close()
+    log.debug("Wrote %d shots as Arrow", rows)
+    return rows
@@ -0,0 +1,131 @@
+"""
+davies.compass.index: Module for random access to individual surveys within large Compass .DAT files
+"""
+
+import os
+import mmap
+import json
+import logging
+from collections import OrderedDict
+
+from davies.compass import CompassSurveyParser
+
+log = logging.getLogger(__name__)
+
+
+__all__ = 'DatIndex',
+
+
+INDEX_VERSION = 1
+
+
+class DatIndex(object):
+    """
+    Memory-mapped index of a Compass .DAT file. Only the ASCII "form feed" survey separators and
+    `SURVEY NAME:` lines are scanned to build the index; a :class:`Survey` is parsed only when it
+    is requested by name.
+
+    The index may optionally be cached on disk, in which case it is reused for as long as the
+    .DAT file's size and modification time are unchanged.
+
+    :ivar datfilename:    (string) underlying .DAT file's filename
+    :ivar cache_filename: (string) optional filename of the on-disk index cache
+    :ivar offsets:        (ordered map of survey name -> (start, end) byte offsets)
+    """
+
+    def __init__(self, datfilename, cache_filename=None, lazy=False):
+        """
+        :param datfilename:    (string) filename
+        :param cache_filename: (string) optional filename in which to cache the survey index
+        :param lazy:           (bool) defer parsing of each returned survey's shots until accessed
+        """
+        self.datfilename = datfilename
+        self.cache_filename = cache_filename
+        self.lazy = lazy
+
+        with open(datfilename, 'rb') as datfile:
+            stat = os.fstat(datfile.fileno())
+            self._fingerprint = (stat.st_size, stat.st_mtime)
+            self._mmap = mmap.mmap(datfile.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b''
+
+        self.offsets = self._load_cache() if cache_filename else None
+        if self.offsets is None:
+            self.offsets = self._build()
+            if cache_filename:
+                self.save(cache_filename)
+
+    def _build(self):
+        """Scan the memory-mapped file, returning an ordered map of survey name to byte range"""
+        log.debug("Indexing Compass .DAT file %s ...", self.datfilename)
+        mm, offsets = self._mmap, OrderedDict()
+        start, size = 0, len(mm)
+        while start < size:
+            end = mm.find(b'\x0C', start)
+            if end == -1:
+                end = size
+            name_pos = mm.find(b'SURVEY NAME:', start, end)
+            if name_pos != -1:
+                eol = mm.find(b'\n', name_pos, end)
+                name = mm[name_pos+12:eol if eol != -1 else end].decode('windows-1252').strip()
+                if name not in offsets:  # like DatFile, the first of any duplicate survey designations wins
+                    offsets[name] = (start, end)
+            start = end + 1
+        log.debug("Indexed %d surveys in Compass .DAT file %s.", len(offsets), self.datfilename)
+        return offsets
+
+    def _load_cache(self):
+        """Load our on-disk index cache, returning None if it is missing or stale"""
+        try:
+            with open(self.cache_filename, 'r') as cachefile:
+                cache = json.load(cachefile)
+        except (IOError, OSError, ValueError):
+            return None
+        if cache.get('version') != INDEX_VERSION or (cache.get('size'), cache.get('mtime')) != self._fingerprint:
+            log.debug("Discarding stale index cache %s", self.cache_filename)
+            return None
+        return OrderedDict((name, (start, end)) for (name, start, end) in cache['surveys'])
+
+    def save(self, cache_filename):
+        """Write this index to the specified cache file"""
+        size, mtime = self._fingerprint
+        cache = {
+            'version': INDEX_VERSION,
+            'size': size,
+            'mtime': mtime,
+            'surveys': [(name, start, end) for (name, (start, end)) in self.offsets.items()],
+        }
+        with open(cache_filename, 'w') as cachefile:
+            json.dump(cache, cachefile)
+
+    def close(self):
+        """Release the underlying memory map"""
+        if self._mmap:
+            self._mmap.close()
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _check_open(self):
+        if self._mmap is None:
+            raise ValueError('DatIndex is closed')
+
+    def __iter__(self):
+        self._check_open()
+        return iter(self.offsets)
+
+    def __contains__(self, item):
+        return item in self.offsets
+
+    def __getitem__(self, item):
+        """Parse and return the :class:`Survey` named `item` or raise :exc:`KeyError`"""
+        self._check_open()
+        start, end = self.offsets[item]
+        survey_str = self._mmap[start:end].decode('windows-1252').strip()
+        return CompassSurveyParser(survey_str, lazy=self.lazy).parse()
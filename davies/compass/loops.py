@@ -0,0 +1,138 @@
+"""
+davies.compass.loops: Loop detection in Compass survey data
+
+A :class:`LoopBasis` finds the independent loops of a survey network: a single union-find pass
+over the shots picks out each loop-closing shot, and the loop which that shot closes is traced
+through the spanning forest formed by the remaining shots. Together these loops are a fundamental
+cycle basis of the network, and their number is the network's shots - stations + components.
+
+Only shots which take part in loop closure are considered: Exclude.TOTAL (X) and Exclude.CLOSURE
+(C) shots are ignored, as are shots without a length and shots from a station to itself.
+"""
+
+from collections import namedtuple
+
+from davies.compass import Exclude, FLAG_BITS
+from davies.compass.columnar import ShotColumns
+from davies.compass.reduction import _surveys
+
+__all__ = 'Loop', 'LoopBasis'
+
+
+_IGNORED_BITS = FLAG_BITS[Exclude.TOTAL] | FLAG_BITS[Exclude.CLOSURE]
+
+
+Loop = namedtuple('Loop', 'shot common stations length')
+Loop.__doc__ = """
+A single independent loop, as found by :class:`LoopBasis`.
+
+:ivar shot:     (:class:`davies.compass.Shot`) the loop-closing shot
+:ivar common:   (str) the station where the two traverses from the closing shot's ends meet
+:ivar stations: (list of str) stations around the loop, from the closing shot's FROM station
+                to its TO station
+:ivar length:   (float) total length of the shots around the loop
+"""
+
+
+def _survey_rows(survey):
+    """Return a list of `(FROM, TO, LENGTH, flag bits)` tuples for a survey's shots"""
+    shots = survey.shots
+    if isinstance(shots, ShotColumns):  # read the columns directly rather than boxing every row
+        return list(zip(shots.column('FROM'), shots.column('TO'), shots.column('LENGTH'), shots.flag_bits))
+    return [(shot.get('FROM', None), shot.get('TO', None), shot.get('LENGTH', None), shot.flag_bits) for shot in shots]
+
+
+class LoopBasis(object):
+    """
+    Fundamental cycle basis of the loops in Compass survey data.
+
+    :ivar loops:      (list of :class:`Loop`) one loop per loop-closing shot, in shot order
+    :ivar stations:   (int) number of stations in the network
+    :ivar shots:      (int) number of shots in the network
+    :ivar components: (int) number of separate, unconnected parts of the network
+    """
+
+    def __init__(self, source):
+        """
+        :param source: (:class:`davies.compass.Project`, :class:`davies.compass.DatFile`, or
+                       iterable of :class:`davies.compass.Survey`) survey data
+        """
+        ids, names = {}, []
+        frm, to, length, rows = [], [], [], []  # rows are (survey, shot index), to find closing shots
+        surveys = []
+        for survey in _surveys(source):
+            for row, (a, b, l, bits) in enumerate(_survey_rows(survey)):
+                if a is None or b is None or l is None or a == b or bits & _IGNORED_BITS:
+                    continue
+                for name in (a, b):
+                    if name not in ids:
+                        ids[name] = len(names)
+                        names.append(name)
+                frm.append(ids[a])
+                to.append(ids[b])
+                length.append(l)
+                rows.append((len(surveys), row))
+            surveys.append(survey)
+        self.stations, self.shots = len(names), len(frm)
+
+        # union-find, with path halving and union by size; a shot between two stations which are
+        # already connected closes a loop, the rest form a spanning forest
+        n = len(names)
+        root, size = list(range(n)), [1] * n
+        closing, tree = [], [[] for _ in range(n)]
+        for shot, (a, b) in enumerate(zip(frm, to)):
+            ra = a
+            while root[ra] != ra:
+                root[ra] = ra = root[root[ra]]
+            rb = b
+            while root[rb] != rb:
+                root[rb] = rb = root[root[rb]]
+            if ra == rb:
+                closing.append(shot)
+                continue
+            if size[ra] < size[rb]:
+                ra, rb = rb, ra
+            root[rb] = ra
+            size[ra] += size[rb]
+            tree[a].append(shot)
+            tree[b].append(shot)
+
+        # root each tree of the forest, so that loops can be traced back to a common station
+        parent, parent_shot, depth = [-1] * n, [-1] * n, [-1] * n
+        self.components = 0
+        for start in range(n):
+            if depth[start] != -1:
+                continue
+            self.components += 1
+            depth[start] = 0
+            stack = [start]
+            while stack:
+                station = stack.pop()
+                for shot in tree[station]:
+                    other = to[shot] if frm[shot] == station else frm[shot]
+                    if depth[other] == -1:
+                        depth[other], parent[other], parent_shot[other] = depth[station] + 1, station, shot
+                        stack.append(other)
+
+        self.loops = []
+        for shot in closing:
+            a, b = frm[shot], to[shot]
+            a_path, b_path, total = [a], [b], length[shot]
+            while a != b:
+                if depth[a] >= depth[b]:
+                    total += length[parent_shot[a]]
+                    a = parent[a]
+                    a_path.append(a)
+                else:
+                    total += length[parent_shot[b]]
+                    b = parent[b]
+                    b_path.append(b)
+            stations = [names[i] for i in a_path] + [names[i] for i in reversed(b_path[:-1])]
+            survey, row = rows[shot]
+            self.loops.append(Loop(surveys[survey].shots[row], names[a], stations, total))
+
+    def __len__(self):
+        return len(self.loops)
+
+    def __iter__(self):
+        return iter(self.loops)
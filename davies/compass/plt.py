@@ -2,16 +2,41 @@
 davies.compass.plt: Module for parsing and working with Compass .PLT plot files
 """
 
+import re
 import logging
 import datetime
-from collections import OrderedDict
+from itertools import chain
+from collections import OrderedDict, namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from davies.compass import ParseException, name_from_filename
 
 log = logging.getLogger(__name__)
 
 
-__all__ = 'Plot', 'Segment', 'MoveCommand', 'DrawCommand', 'CompassPltParser'
+__all__ = 'Plot', 'Segment', 'MoveCommand', 'DrawCommand', 'CompassPltParser', 'PlotArrays'
+
+
+# record layout of the `stations` array returned by :meth:`Plot.to_arrays`
+STATION_DTYPE = [('y', 'f8'), ('x', 'f8'), ('z', 'f8'),
+                 ('l', 'f8'), ('r', 'f8'), ('u', 'f8'), ('d', 'f8'), ('edist', 'f8'),
+                 ('cmd', 'U1'), ('hidden', '?'), ('name', 'i4')]
+
+
+PlotArrays = namedtuple('PlotArrays', 'stations offsets names')
+PlotArrays.__doc__ = """
+Columnar NumPy representation of a :class:`Plot`, as returned by :meth:`Plot.to_arrays`.
+
+:ivar stations: (structured `ndarray`) one record per command, with fields y, x, z, l, r, u, d,
+                edist, cmd ('M', 'D', or 'd'), hidden, and name (an index into :attr:`names`)
+:ivar offsets:  (`ndarray` of int) CSR-style segment offsets; the commands of segment `i` are
+                `stations[offsets[i]:offsets[i+1]]`
+:ivar names:    (list of str) distinct station names, indexed by the `name` field
+"""
 
 
 class Command(object):
@@ -69,7 +94,13 @@ class Segment(object):
 
 
 class Plot(object):
-    """Compass .PLT plot file. A Plot is a container for :class:`Segment` objects."""
+    """
+    Compass .PLT plot file. A Plot is a container for :class:`Segment` objects.
+
+    Segments are looked up by name in constant time; when several share a name, the first is returned.
+    """
+    _segments_by_name = None  # segment name -> first Segment with that name
+    _segments_indexed = 0     # number of segments in the index
 
     def __init__(self, name=None):
         self.name = name
@@ -91,6 +122,9 @@ class Plot(object):
     def add_segment(self, segment):
         """Add a :class:`Segment` to :attr:`segments`."""
         self.segments.append(segment)
+        if self._segments_by_name is not None and self._segments_indexed == len(self.segments) - 1:
+            self._segments_by_name.setdefault(segment.name, segment)
+            self._segments_indexed += 1
 
     def add_fixed_point(self, name, coordinate):
         """Add a (Y, X, Z) tuple to :attr:`fixed_points`."""
@@ -107,17 +141,177 @@ class Plot(object):
         for segment in self.segments:
             yield segment
 
-    def __contains__(self, item):
+    def _segment_index(self):
+        if self._segments_by_name is None or self._segments_indexed != len(self.segments):
+            self.reindex()
+        return self._segments_by_name
+
+    def reindex(self):
+        """Rebuild the segment name index"""
+        self._segments_by_name = {}
         for segment in self.segments:
-            if item == segment.name:
-                return True
-        return False
+            self._segments_by_name.setdefault(segment.name, segment)
+        self._segments_indexed = len(self.segments)
+
+    def __contains__(self, item):
+        try:
+            return item in self._segment_index()
+        except TypeError:
+            return False
 
     def __getitem__(self, item):
+        try:
+            return self._segment_index()[item]
+        except TypeError:
+            raise KeyError(item)
+
+    def to_arrays(self):
+        """
+        Return this plot's commands as a :class:`PlotArrays` of NumPy arrays, so that whole-plot
+        transforms can be vectorized. Requires `numpy`.
+        """
+        if np is None:
+            raise ImportError('Plot.to_arrays() requires numpy')
+        records, offsets, names, name_ids = [], [0], [], {}
         for segment in self.segments:
-            if item == segment.name:
-                return segment
-        raise KeyError(item)
+            for cmd in segment.commands:
+                name_id = name_ids.get(cmd.name, None)
+                if name_id is None:
+                    name_id = name_ids[cmd.name] = len(names)
+                    names.append(cmd.name)
+                records.append((cmd.y, cmd.x, cmd.z, cmd.l, cmd.r, cmd.u, cmd.d, cmd.edist,
+                                cmd.cmd, cmd.cmd == 'd', name_id))
+            offsets.append(len(records))
+        stations = np.array(records, dtype=STATION_DTYPE)
+        return PlotArrays(stations, np.array(offsets, dtype=np.intp), names)
+
+
+ENCODING = 'windows-1252'
+
+_COMMAND_CODES = frozenset([b'M', b'D', b'd'])
+
+# any line which isn't an M, D, or d command record
+_RECORD_RE = re.compile(br'^[^MDd\r\n][^\n]*', re.M)
+
+# number of bytes read at a time; command lines are tokenized in blocks of at most this size
+_CHUNK_SIZE = 256 * 1024
+
+
+def _split_records(pltfile, chunk_size=_CHUNK_SIZE):
+    """
+    Generator which reads a binary .PLT file in chunks and yields `(True, data)` for each run of
+    consecutive M, D, and d command lines, or `(False, line)` for every other record line.
+    """
+    tail = b''
+    while True:
+        chunk = pltfile.read(chunk_size)
+        data = tail + chunk
+        if chunk:
+            cut = data.rfind(b'\n') + 1  # only split complete lines
+            data, tail = data[:cut], data[cut:]
+        pos = 0
+        for match in _RECORD_RE.finditer(data):
+            if match.start() > pos:
+                yield True, data[pos:match.start()]
+            yield False, match.group()
+            pos = match.end()
+        if pos < len(data):
+            yield True, data[pos:]
+        if not chunk:
+            break
+
+
+# columns of a block of consecutive M, D, and d records: `codes` (list of bytes), `names` and `flags`
+# (lists of str, flags are `None` where absent), and `columns`, a tuple of float lists (or `ndarray`)
+# in Y, X, Z, L, R, U, D, EDIST order
+_CommandBlock = namedtuple('_CommandBlock', 'codes names columns flags')
+
+_COLUMN_OFFSETS = (1, 2, 3, 6, 9, 7, 8, 11)  # token offsets of Y X Z L R U D EDIST within a record
+
+
+def _tokenize_commands(data, arrays=False):
+    """
+    Tokenize a run of consecutive M, D, and d lines into a :class:`_CommandBlock`.
+
+    The whole run is split at once and each field is then converted as a single column, directly
+    from the byte tokens. Each record has a code and 11 fields, plus an optional flags field; when
+    records differ, the start of each is found by checking whether the token after its 11th field
+    is a command code. Runs which don't fit this layout are tokenized one line at a time.
+
+    :param data: (bytes) .PLT lines, each beginning with an M, D, or d command code
+    :param arrays: (bool) return `columns` as float `ndarray`, each converted by `numpy` in one call
+    """
+    toks = data.split()
+    ntoks = len(toks)
+
+    for width in (12, 13):
+        if ntoks % width == 0 and _COMMAND_CODES.issuperset(toks[::width]):
+            # every record has the same layout, slice columns directly
+            field = lambda offset: toks[offset::width]
+            raw_flags = field(12) if width == 13 else [None] * (ntoks // width)
+            break
+    else:
+        starts, raw_flags = [], []
+        i = 0
+        while i + 11 < ntoks:
+            starts.append(i)
+            if i + 12 < ntoks and toks[i + 12] not in _COMMAND_CODES:
+                raw_flags.append(toks[i + 12])
+                i += 13
+            else:
+                raw_flags.append(None)
+                i += 12
+        if i == ntoks and _COMMAND_CODES.issuperset([toks[i] for i in starts]):
+            field = lambda offset: [toks[i + offset] for i in starts]
+        else:
+            field = None
+
+    if field is not None:
+        codes, raw_names = field(0), field(4)
+        if arrays:
+            columns = tuple(np.array(field(offset), dtype=float) for offset in _COLUMN_OFFSETS)
+        else:
+            columns = tuple(list(map(float, field(offset))) for offset in _COLUMN_OFFSETS)
+    else:
+        codes, raw_names, raw_flags, columns = [], [], [], tuple([] for _ in range(8))
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            flags = None  # flags are optional
+            try:
+                y, x, z, name, _, l, u, d, r, _, edist = line[1:].split()
+            except ValueError:
+                y, x, z, name, _, l, u, d, r, _, edist, flags = line[1:].split()
+            codes.append(line[:1])
+            raw_names.append(name)
+            raw_flags.append(flags)
+            for column, val in zip(columns, (y, x, z, l, r, u, d, edist)):
+                column.append(float(val))
+        if arrays:
+            columns = tuple(np.array(column, dtype=float) for column in columns)
+
+    # decoding windows-1252 is slow per token, so decode each column as a whole
+    names = [name[1:] for name in b'\n'.join(raw_names).decode(ENCODING).split('\n')] if codes else []  # strip 'S' prefix
+    flags = [None] * len(codes)
+    flagged = [i for (i, flag) in enumerate(raw_flags) if flag is not None]
+    if flagged:
+        for i, flag in zip(flagged, b'\n'.join([raw_flags[i] for i in flagged]).decode(ENCODING).split('\n')):
+            flags[i] = flag
+    return _CommandBlock(codes, names, columns, flags)
+
+
+def _build_commands(block):
+    """Return a list of :class:`Command` for a :class:`_CommandBlock`"""
+    commands = []
+    for code, name, y, x, z, l, r, u, d, edist, flags in zip(block.codes, block.names, *(block.columns + (block.flags,))):
+        if code == b'M':
+            commands.append(MoveCommand(y, x, z, name, l, r, u, d, edist, flags))
+        else:
+            cmd = DrawCommand(y, x, z, name, l, r, u, d, edist, flags)
+            if code == b'd':
+                cmd.cmd = 'd'  # "hidden" station with the 'P' flag
+            commands.append(cmd)
+    return commands
 
 
 class CompassPltParser(object):
@@ -128,16 +322,98 @@ class CompassPltParser(object):
         """:param pltfilename: string filename"""
         self.pltfilename = pltfilename
         self.strict_mode = strict_mode
+        self.plot = None
 
     def parse(self):
         """Parse our .PLT file and return :class:`Plot` object or raise :exc:`ParseException`."""
-        plt = Plot(name_from_filename(self.pltfilename))
+        for segment in self.iter_segments():
+            self.plot.add_segment(segment)
+        return self.plot
+
+    def parse_arrays(self):
+        """
+        Parse our .PLT file directly into :class:`PlotArrays`, equivalent to `parse().to_arrays()`
+        but without creating a :class:`Command` object per station. :attr:`plot` receives the
+        segments, without their commands. Requires `numpy`.
+        """
+        if np is None:
+            raise ImportError('CompassPltParser.parse_arrays() requires numpy')
+        blocks, offsets, count, segment = [], [0], 0, None
+        for c, obj in self._iter_records(arrays=True):
+            if c is None:
+                blocks.append(obj)
+                count += len(obj.codes)
+            elif c == 'N':
+                segment = obj
+            elif c == 'X':
+                segment.set_bounds(*obj)
+                self.plot.add_segment(segment)
+                offsets.append(count)
+
+        stations = np.empty(count, dtype=STATION_DTYPE)
+        if blocks:
+            for i, field in enumerate(('y', 'x', 'z', 'l', 'r', 'u', 'd', 'edist')):
+                stations[field] = np.concatenate([block.columns[i] for block in blocks])
+        codes = np.array(list(chain.from_iterable(block.codes for block in blocks)), dtype='S1')
+        stations['cmd'] = codes.astype('U1')
+        stations['hidden'] = codes == b'd'
+        name_ids = {}  # name -> id, in order of first appearance
+        stations['name'] = [name_ids.setdefault(name, len(name_ids))
+                            for name in chain.from_iterable(block.names for block in blocks)]
+        names = sorted(name_ids, key=name_ids.get)
+        return PlotArrays(stations, np.array(offsets, dtype=np.intp), names)
+
+    def iter_segments(self):
+        """
+        Generator which yields each :class:`Segment`, complete with its commands, as soon as it has
+        been read. Plot-level values (bounds, UTM zone, datum, fixed points, loops) are collected in
+        :attr:`plot` as they are read, but the segments themselves are not retained.
+        """
+        segment = None
+        for c, obj in self._iter_records():
+            if c == 'N':
+                segment = obj
+            elif c == 'X':
+                segment.set_bounds(*obj)
+                yield segment  # An X-bounds command signifies end of segment
+                segment = None
+            else:
+                segment.commands.extend(_build_commands(obj))
+
+    def iter_commands(self):
+        """
+        Generator which yields each :class:`MoveCommand` and :class:`DrawCommand` as it is read,
+        without building segments. Plot-level values are collected in :attr:`plot` as they are read.
+        """
+        for c, obj in self._iter_records():
+            if c is None:
+                for cmd in _build_commands(obj):
+                    yield cmd
+
+    def _iter_records(self, arrays=False):
+        """
+        Generator which yields `(code, obj)` tuples for segment-level records: a new :class:`Segment`
+        for 'N', a bounds tuple for 'X', and a :class:`_CommandBlock` for each block of consecutive
+        'M', 'D' and 'd' records (code `None`). All other records are applied directly to :attr:`plot`.
+
+        The file is read as bytes; runs of command lines, which make up nearly all of a .PLT file, are
+        handed to :func:`_tokenize_commands` as blocks, while the rare remaining records are decoded
+        as text.
+
+        :param arrays: (bool) give each :class:`_CommandBlock` its columns as `ndarray`
+        """
+        plt = self.plot = Plot(name_from_filename(self.pltfilename))
 
         with open(self.pltfilename, 'rb') as pltfile:
-            segment = None
+            for is_commands, line in _split_records(pltfile):
+                if is_commands:
+                    block = _tokenize_commands(line, arrays)
+                    if block.codes:
+                        yield None, block
+                    continue
 
-            for line in pltfile:
-                if not line:
+                line = line.decode(ENCODING)
+                if not line.strip():
                     continue
 
                 c, val = line[:1], line[1:]
@@ -160,7 +436,7 @@ class CompassPltParser(object):
                     plt.utm_zone = int(val)
 
                 elif c == 'O':
-                    plt.datum = val
+                    plt.datum = val.strip()
 
                 elif c == 'N':
                     date, comment = None, ''  # both date and comment are optional
@@ -174,36 +450,10 @@ class CompassPltParser(object):
                         except ValueError:
                             name = val
                     comment = comment[1:].strip()
-                    segment = Segment(name, date, comment)
-
-                elif c == 'M':
-                    flags = None  # flags are optional
-                    try:
-                        y, x, z, name, _, l, u, d, r, _, edist = val.split()
-                    except ValueError:
-                        y, x, z, name, _, l, u, d, r, _, edist, flags = val.split()
-                    cmd = MoveCommand(float(y), float(x), float(z), name[1:],
-                                      float(l), float(r), float(u), float(d), float(edist), flags)
-                    segment.add_command(cmd)
-
-                elif c in ('D', 'd'):
-                    # 'D' for normal stations, 'd' for "hidden" stations with the 'P' flag
-                    flags = None
-                    try:
-                        y, x, z, name, _, l, u, d, r, _, edist = val.split()
-                    except ValueError:
-                        y, x, z, name, _, l, u, d, r, _, edist, flags = val.split()
-                    cmd = DrawCommand(float(y), float(x), float(z), name[1:],
-                                      float(l), float(r), float(u), float(d), float(edist), flags)
-                    cmd.cmd = c
-                    segment.add_command(cmd)
+                    yield c, Segment(name, date, comment)
 
                 elif c == 'X':
-                    segment.set_bounds(*(float(v) for v in val.split()))
-
-                    # An X-bounds command signifies end of segment
-                    plt.add_segment(segment)
-                    segment = None
+                    yield c, tuple(float(v) for v in val.split())
 
                 elif c == 'P':
                     name, y, x, z = val.split()
@@ -225,5 +475,3 @@ class CompassPltParser(object):
                         raise ParseException(msg)
                     else:
                         log.warning(msg)
-
-        return plt
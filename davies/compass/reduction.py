@@ -0,0 +1,282 @@
+"""
+davies.compass.reduction: Survey reduction of Compass .DAT data to station coordinates
+
+A :class:`Reduction` takes a :class:`davies.compass.Project`, :class:`davies.compass.DatFile`, or
+sequence of :class:`davies.compass.Survey` and computes a coordinate for every station by walking
+the shot graph outward from the fixed stations. Shot offsets are computed for all shots at once,
+using NumPy when it is available.
+
+Coordinates follow the Compass .PLT convention of Y, X, Z (North, East, Elevation) order, in feet.
+Shot exclusion flags are handled as Compass does:
+
+ - Exclude.TOTAL (X) shots are left out of the reduction entirely
+ - Exclude.CLOSURE (C) shots are only used to locate stations which no other shot can reach
+ - Exclude.PLOT (P) shots are drawn as hidden 'd' commands by :meth:`Reduction.to_plot`
+ - Exclude.LENGTH (L) shots are reduced normally
+
+Where the shot graph contains loops, each station is located along the first (breadth-first) path
+which reaches it, until :meth:`Reduction.close_loops` adjusts the network.
+"""
+
+import logging
+from math import sin, radians
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from davies.survey_math import cartesian_offset_array, m2ft
+from davies.compass import Project, DatFile, UTMLocation, Exclude, FLAG_BITS, average_azm, average_inc
+from davies.compass.columnar import ShotColumns
+from davies.compass.closure import LoopClosure
+from davies.compass.plt import Plot, Segment, MoveCommand, DrawCommand
+
+log = logging.getLogger(__name__)
+
+
+__all__ = 'Reduction',
+
+
+NAN = float('nan')
+INF = float('inf')
+
+_TOTAL_BIT = FLAG_BITS[Exclude.TOTAL]
+_CLOSURE_BIT = FLAG_BITS[Exclude.CLOSURE]
+_PLOT_BIT = FLAG_BITS[Exclude.PLOT]
+
+_KEYS = ('FROM', 'TO', 'LENGTH', 'BEARING', 'AZM2', 'INC', 'INC2', 'LEFT', 'RIGHT', 'UP', 'DOWN', 'FLAGS')
+
+_NO_LRUD = -9.0  # .PLT value for a missing or passage LRUD
+
+
+def _surveys(source):
+    """Yield the surveys of a Project, DatFile, or iterable of Surveys"""
+    if isinstance(source, Project):
+        for datfile in source:
+            if isinstance(datfile, DatFile):
+                for survey in datfile:
+                    yield survey
+    else:
+        for survey in source:
+            yield survey
+
+
+def _survey_rows(survey):
+    """Return a list of per-shot tuples of :data:`_KEYS` values, plus flag bits and declination"""
+    shots = survey.shots
+    if isinstance(shots, ShotColumns):  # read the columns directly rather than boxing every row
+        return list(zip(*([shots.column(key) for key in _KEYS] + [shots.flag_bits, shots.declination])))
+    return [tuple(shot.get(key, None) for key in _KEYS) + (shot.flag_bits, shot.declination) for shot in shots]
+
+
+def _shot_offsets(length, azm1, azm2, inc1, inc2, declination):
+    """Return `(dy, dx, dz)` lists of offsets for columns of shot readings, which are `None` where missing"""
+    if np is not None:
+        azm1, azm2, inc1, inc2 = [np.array(column, dtype=float) for column in (azm1, azm2, inc1, inc2)]
+        back = (azm2 + 180) % 360
+        with np.errstate(invalid='ignore'):
+            mean = (azm1 + back) / 2.0
+            wrapped = np.abs(azm1 - back) > 180  # see average_azm()
+        mean[wrapped] = (mean[wrapped] + 180) % 360
+        azm = np.where(np.isnan(azm2), azm1, np.where(np.isnan(azm1), back, mean)) + declination
+        inc = np.where(np.isnan(inc2), inc1, np.where(np.isnan(inc1), -inc2, (inc1 - inc2) / 2.0))
+        azm, inc = np.nan_to_num(azm), np.nan_to_num(inc)
+        dx, dy = cartesian_offset_array(azm, inc, length, None)
+        dz = np.array(length, dtype=float) * np.sin(np.radians(inc))
+        return dy.tolist(), dx.tolist(), dz.tolist()
+
+    azm = [a + d if a is not None else 0.0 for (a, d) in
+           zip([average_azm(a1, a2) for (a1, a2) in zip(azm1, azm2)], declination)]
+    inc = [average_inc(i1, i2) for (i1, i2) in zip(inc1, inc2)]
+    inc = [i if i is not None else 0.0 for i in inc]
+    dx, dy = cartesian_offset_array(azm, inc, length, None)
+    dz = [l * sin(radians(i)) for (l, i) in zip(length, inc)]
+    return dy, dx, dz
+
+
+def _lrud(val):
+    return val if val is not None and val != INF else _NO_LRUD
+
+
+class Reduction(object):
+    """
+    Station coordinates computed from Compass survey data.
+
+    Stations are located outward from the fixed stations; any part of the cave which isn't connected
+    to a fixed station is located from its first station, placed at the origin.
+
+    :ivar names:     (list of str) station names, in order of first appearance
+    :ivar y:         (list of float) station North coordinates, indexed like :attr:`names`
+    :ivar x:         (list of float) station East coordinates
+    :ivar z:         (list of float) station elevations
+    :ivar fixed:     (list of str) names of the stations which were fixed in place
+    :ivar surveys:   (list of :class:`davies.compass.Survey`) surveys which were reduced
+    :ivar placed_by: (list of int) index of the shot which located each station, or `-1` for
+                     stations which were fixed or placed at the origin
+    """
+
+    def __init__(self, source, fixed=None):
+        """
+        :param source: (:class:`davies.compass.Project`, :class:`davies.compass.DatFile`, or
+                       iterable of :class:`davies.compass.Survey`) survey data to reduce
+        :param fixed:  (map of station -> (Y, X, Z) tuple in feet, or :class:`davies.compass.UTMLocation`
+                       in meters) fixed station locations; defaults to a Project's fixed stations
+        """
+        if fixed is None:
+            fixed = {}
+            if isinstance(source, Project):
+                for stations in source.fixed_stations.values():
+                    fixed.update((station, location) for (station, location) in stations.items() if location)
+
+        self.surveys = []
+        self._survey_ends = []  # index one past each survey's last shot
+        ids, names = {}, []
+        frm, to, length, azm1, azm2, inc1, inc2, lruds, flags, bits, declination = ([] for _ in range(11))
+        for survey in _surveys(source):
+            for row in _survey_rows(survey):
+                shot_bits = row[12]
+                if row[0] is None or row[1] is None or row[2] is None or shot_bits & _TOTAL_BIT:
+                    continue
+                for name in row[:2]:
+                    if name not in ids:
+                        ids[name] = len(names)
+                        names.append(name)
+                frm.append(ids[row[0]])
+                to.append(ids[row[1]])
+                length.append(row[2])
+                azm1.append(row[3])
+                azm2.append(row[4])
+                inc1.append(row[5])
+                inc2.append(row[6])
+                lruds.append(row[7:11])
+                flags.append(row[11] or None)
+                bits.append(shot_bits)
+                declination.append(row[13])
+            self.surveys.append(survey)
+            self._survey_ends.append(len(frm))
+
+        self.names = names
+        self._ids = ids
+        self._frm, self._to, self._length = frm, to, length
+        self._lruds, self._flags, self._bits = lruds, flags, bits
+        self._dy, self._dx, self._dz = _shot_offsets(length, azm1, azm2, inc1, inc2, declination)
+        self._locate(fixed)
+
+    def _locate(self, fixed):
+        """Locate every station by a breadth-first walk of the shot graph"""
+        n = len(self.names)
+        frm, to, bits = self._frm, self._to, self._bits
+        dy, dx, dz = self._dy, self._dx, self._dz
+        y, x, z = [NAN] * n, [NAN] * n, [NAN] * n
+        placed_by = [-1] * n
+        placed = [False] * n
+
+        adjacency = [[] for _ in range(n)]
+        for shot, (a, b) in enumerate(zip(frm, to)):
+            adjacency[a].append(shot)
+            adjacency[b].append(shot)
+
+        queue, closure_queue = deque(), deque()  # shots which may locate a new station
+
+        def place(station, coordinate, shot):
+            y[station], x[station], z[station] = coordinate
+            placed[station] = True
+            placed_by[station] = shot
+            for s in adjacency[station]:
+                (closure_queue if bits[s] & _CLOSURE_BIT else queue).append(s)
+
+        self.fixed = []
+        for name, location in fixed.items():
+            station = self._ids.get(name, None)
+            if station is None:
+                log.warning('Fixed station %s is not in the survey data', name)
+                continue
+            if isinstance(location, UTMLocation):
+                location = (m2ft(location.northing), m2ft(location.easting), m2ft(location.elevation))
+            place(station, tuple(float(v) for v in location), -1)
+            self.fixed.append(name)
+
+        unplaced = (station for station in range(n) if not placed[station])
+        while True:
+            while queue or closure_queue:
+                # closure-excluded shots are only followed once no other shot can locate a station
+                shot = queue.popleft() if queue else closure_queue.popleft()
+                a, b = frm[shot], to[shot]
+                if not placed[b]:
+                    place(b, (y[a] + dy[shot], x[a] + dx[shot], z[a] + dz[shot]), shot)
+                elif not placed[a]:
+                    place(a, (y[b] - dy[shot], x[b] - dx[shot], z[b] - dz[shot]), shot)
+            start = next(unplaced, None)
+            if start is None:
+                break
+            if self.fixed or start:
+                log.debug('Station %s is not connected to a fixed station, placing it at the origin', self.names[start])
+            place(start, (0.0, 0.0, 0.0), -1)
+
+        self.y, self.x, self.z = y, x, z
+        self.placed_by = placed_by
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, station):
+        return station in self._ids
+
+    def __getitem__(self, station):
+        """Return the (Y, X, Z) coordinate of a station"""
+        i = self._ids[station]
+        return self.y[i], self.x[i], self.z[i]
+
+    def close_loops(self, **kwargs):
+        """
+        Adjust station coordinates so that loops close, by weighted least squares; see
+        :class:`davies.compass.closure.LoopClosure` for keyword arguments. Returns the :class:`LoopClosure`.
+        """
+        closure = LoopClosure(self, **kwargs)
+        self.y, self.x, self.z = closure.y, closure.x, closure.z
+        return closure
+
+    def to_plot(self, name=None):
+        """
+        Return a :class:`davies.compass.plt.Plot` with one :class:`davies.compass.plt.Segment` per
+        survey. Each draw command carries the LRUDs of the shot which it draws.
+        """
+        plot = Plot(name)
+        names, y, x, z = self.names, self.y, self.x, self.z
+        frm, to, length, lruds, flags, bits = self._frm, self._to, self._length, self._lruds, self._flags, self._bits
+        for station in self.fixed:
+            plot.add_fixed_point(station, self[station])
+
+        edist, start = 0.0, 0
+        for survey, end in zip(self.surveys, self._survey_ends):
+            segment = Segment(survey.name, survey.date, survey.comment)
+            last = None
+            for shot in range(start, end):
+                a, b = frm[shot], to[shot]
+                l, r, u, d = [_lrud(val) for val in lruds[shot]]
+                if a != last:
+                    segment.add_command(MoveCommand(y[a], x[a], z[a], names[a], l, r, u, d, edist))
+                edist += length[shot]
+                cmd = DrawCommand(y[b], x[b], z[b], names[b], l, r, u, d, edist, flags[shot])
+                if bits[shot] & _PLOT_BIT:
+                    cmd.cmd = 'd'  # "hidden" station
+                segment.add_command(cmd)
+                last = b
+            start = end
+            if segment.commands:
+                ys, xs, zs = [[getattr(cmd, axis) for cmd in segment] for axis in 'yxz']
+                segment.set_bounds(min(ys), max(ys), min(xs), max(xs), min(zs), max(zs))
+            plot.add_segment(segment)
+
+        if names:
+            plot.set_bounds(min(y), max(y), min(x), max(x), min(z), max(z))
+        return plot
+
+    def to_arrays(self):
+        """Return :meth:`to_plot` as a :class:`davies.compass.plt.PlotArrays`. Requires `numpy`."""
+        return self.to_plot().to_arrays()
@@ -0,0 +1,435 @@
+"""
+davies.compass.snapshot: Compact binary snapshots of whole Compass projects
+
+A snapshot stores a parsed :class:`davies.compass.Project` in a single versioned binary file,
+which is loaded by memory-mapping it rather than by parsing. Shot data are stored as typed
+columns for the whole project, every string (station names, flags, comments, survey metadata)
+is interned once in a shared string table, and per-survey metadata are fixed-width records.
+
+Loading a snapshot only builds the Project, DatFile and Survey objects; each survey's shots are
+read-only views of the mapped file, created when :attr:`davies.compass.Survey.shots` is first
+accessed and copied only if modified. Since the file is mapped read-only, any number of processes
+which load the same snapshot share the same pages of the operating system's file cache.
+
+Example usage::
+
+    project = compass.Project.read('MYCAVE.MAK')
+    project.save_snapshot('MYCAVE.snapshot')
+
+    # ... then in each worker process
+    project = compass.Project.load_snapshot('MYCAVE.snapshot')
+
+File layout, all values little-endian:
+
+ - header: magic bytes, format version, and section count
+ - directory: name, array typecode, byte offset and item count of each section
+ - sections, each aligned to 8 bytes: a JSON document of project and file metadata, the string
+   table, survey records, and one column per shot key
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+import logging
+import datetime
+from array import array
+from collections import OrderedDict
+
+from davies.compass import Project, DatFile, UTMLocation, _SourceFile, _replace
+from davies.compass.columnar import StringTable, ShotColumns, ColumnarSurvey, _FLOAT_KEYS, _STRING_KEYS
+
+log = logging.getLogger(__name__)
+
+
+__all__ = 'save_snapshot', 'load_snapshot', 'SnapshotError'
+
+
+SNAPSHOT_MAGIC = b'DAVSNAP\x00'
+SNAPSHOT_VERSION = 1
+
+_HEADER = struct.Struct('<8sII')  # magic, version, section count
+_SECTION = struct.Struct('<24scQQ')  # name, typecode, offset, count
+_ALIGNMENT = 8
+
+NAN = float('nan')
+
+_TEAM_SEPARATOR = '\x1f'  # ASCII "unit separator" between team members
+
+# fields of the per-survey records
+_SURVEY_STRINGS = ('name', 'comment', 'cave_name', 'team', 'file_format', 'shot_header')  # string ids
+_SURVEY_FLOATS = 6  # declination, corrections, corrections2
+_SURVEY_INTS = 4  # date ordinal, raw source index, raw start, raw end
+
+# views of a memory-mapped file are only possible where the file's byte order is native
+_MAPPABLE = hasattr(memoryview, 'cast') and sys.byteorder == 'little'
+
+
+class SnapshotError(Exception):
+    """Raised when a file isn't a snapshot, or is a snapshot of an unsupported version."""
+    pass
+
+
+class _MappedStrings(StringTable):
+    """
+    :class:`StringTable` over the string section of a snapshot. Strings are decoded as they're
+    looked up by id; the table is only decoded in full if strings are looked up by value or added.
+    """
+
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    def __getattr__(self, name):
+        if name not in ('strings', '_ids'):
+            raise AttributeError(name)
+        self.__setstate__([self[id] for id in range(len(self._offsets) - 1)])
+        return self.__dict__[name]
+
+    def __getitem__(self, id):
+        if 'strings' in self.__dict__:
+            return StringTable.__getitem__(self, id)
+        if id == -1:
+            return None
+        return bytes(self._data[self._offsets[id]:self._offsets[id + 1]]).decode('utf-8')
+
+    def __len__(self):
+        if 'strings' in self.__dict__:
+            return len(self.strings)
+        return len(self._offsets) - 1
+
+
+class _SnapshotSurvey(ColumnarSurvey):
+    """:class:`ColumnarSurvey` whose shots are views of a snapshot's columns, created on first access"""
+
+    def _load_shots(self):
+        snapshot, start, end = self._shot_block
+        self._set_shots(snapshot._shot_columns(start, end))
+
+    def __getstate__(self):
+        self.shots  # a memory-mapped snapshot can't be pickled, so take our own copy of the shots
+        return ColumnarSurvey.__getstate__(self)
+
+
+class _ShotTable(object):
+    """
+    Project-wide shot columns, accumulated a survey at a time while writing a snapshot. Columns are
+    float64 for float keys and int32 string ids for all others, and rows have presence bits as
+    for :class:`ShotColumns`.
+    """
+
+    def __init__(self, strings):
+        self.strings = strings
+        self.keys, self.columns = [], []
+        self.present, self.flag_bits, self.declination = array('I'), array('B'), array('d')
+        self._key_bits = {}
+        self._remaps = {}  # id(StringTable) -> (StringTable, map of its string ids -> our string ids)
+
+    def __len__(self):
+        return len(self.present)
+
+    def _column(self, key):
+        """Return the presence bit and column for `key`, adding a new column if necessary"""
+        bit = self._key_bits.get(key, None)
+        if bit is None:
+            if len(self.keys) >= 8 * self.present.itemsize:
+                raise ValueError('Too many distinct shot keys for a snapshot: %s' % key)
+            bit = self._key_bits[key] = 1 << len(self.keys)
+            self.keys.append(key)
+            self.columns.append(array('d', [NAN]) * len(self) if key in _FLOAT_KEYS else array('i', [-1]) * len(self))
+        return bit, self.columns[self.keys.index(key)]
+
+    def _remap(self, strings):
+        """Return a map of string ids in another :class:`StringTable` to ids in ours"""
+        table, remap = self._remaps.get(id(strings), (None, None))
+        if table is not strings:
+            remap = {-1: -1}
+            self._remaps[id(strings)] = (strings, remap)
+        for i in range(len(remap) - 1, len(strings)):
+            remap[i] = self.strings.intern(strings[i])
+        return remap
+
+    def add_shots(self, shots):
+        """Append a survey's shots, either a list of :class:`Shot` or :class:`ShotColumns`"""
+        start, n = len(self), len(shots)
+        intern = self.strings.intern
+        if isinstance(shots, ShotColumns):
+            bits = {}  # their presence bit -> ours
+            for key in shots.keys:
+                bit, column = self._column(key)
+                bits[shots._key_bits[key]] = bit
+                values = shots.columns[key]
+                if key in _FLOAT_KEYS:
+                    column.extend(values)
+                elif key in _STRING_KEYS:
+                    remap = self._remap(shots.strings)
+                    column.extend([remap[id] for id in values])
+                else:
+                    column.extend([intern(value) for value in values])
+            present = dict((p, sum([ours for (theirs, ours) in bits.items() if p & theirs])) for p in set(shots.present))
+            self.present.extend([present[p] for p in shots.present])
+            self.flag_bits.extend(shots.flag_bits)
+            self.declination.extend(shots.declination)
+        else:
+            layouts = [tuple(shot) for shot in shots]
+            keys = []
+            for layout in OrderedDict.fromkeys(layouts):
+                keys.extend(key for key in layout if key not in keys)
+            for key in keys:
+                bit, column = self._column(key)
+                values = [shot.get(key, None) for shot in shots]
+                if key in _FLOAT_KEYS:
+                    column.extend([float(value) if value is not None else NAN for value in values])
+                else:
+                    column.extend([intern(value) for value in values])
+            present = dict((layout, sum([self._key_bits[key] for key in layout])) for layout in set(layouts))
+            self.present.extend([present[layout] for layout in layouts])
+            self.flag_bits.extend([shot.flag_bits for shot in shots])
+            self.declination.extend([shot.declination for shot in shots])
+        for key, column in zip(self.keys, self.columns):
+            if len(column) == start:  # a key which none of these shots have
+                column.extend(array(column.typecode, [NAN if key in _FLOAT_KEYS else -1]) * n)
+
+
+def _to_bytes(column):
+    """Return the little-endian bytes of an array"""
+    if sys.byteorder != 'little' and column.itemsize > 1:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes() if hasattr(column, 'tobytes') else column.tostring()
+
+
+def save_snapshot(project, fname):
+    """
+    Write a snapshot of a :class:`davies.compass.Project` to file `fname`. Lazily parsed shots are
+    parsed in the process. The snapshot is written to a temporary file which then replaces `fname`,
+    so processes which have already mapped an older snapshot are unaffected.
+    """
+    strings = StringTable()
+    shots = _ShotTable(strings)
+    survey_ends, survey_strings, survey_floats, survey_ints = array('I'), array('i'), array('d'), array('i')
+    files, sources, source_ids = [], [], {}
+
+    for linked_file in project.linked_files:
+        if not isinstance(linked_file, DatFile):
+            files.append({'link': linked_file})  # a linked file which couldn't be read
+            continue
+        for survey in linked_file:
+            shots.add_shots(survey.shots)
+            survey_ends.append(len(shots))
+
+            team = _TEAM_SEPARATOR.join(survey.team) if survey.team else None
+            survey_strings.extend(strings.intern(value) for value in (
+                survey.name, survey.comment, survey.cave_name, team, survey.file_format, '\t'.join(survey.shot_header)))
+            survey_floats.extend([float(survey.declination)] + [float(c) for c in survey.corrections] +
+                                 [float(c) for c in survey.corrections2])
+
+            source, start, end = survey._raw if not survey.is_dirty else (None, 0, 0)
+            if source is not None and end < 2**31:
+                if source not in source_ids:
+                    source_ids[source] = len(sources)
+                    sources.append(list(source))
+                source = source_ids[source]
+            else:
+                source, start, end = -1, 0, 0
+            survey_ints.extend((survey.date.toordinal() if survey.date else 0, source, start, end))
+
+        tail = linked_file._raw_tail.decode('latin-1') if linked_file._raw_tail is not None else None
+        files.append({'name': linked_file.name, 'filename': linked_file.filename, 'surveys': len(linked_file),
+                      'tail': tail})
+
+    fixed = []
+    for i, linked_file in enumerate(project.linked_files):
+        for station, location in project.fixed_stations.get(linked_file, {}).items():
+            fixed.append([i, station, _location_json(location)])
+
+    meta = {
+        'name': project.name,
+        'filename': project.filename,
+        'base_location': _location_json(project.base_location),
+        'utm': [project._utm_zone, project._utm_datum, project._utm_convergence],
+        'override_lrud': project.override_lrud,
+        'lrud_association': project.lrud_association,
+        'files': files,
+        'fixed_stations': fixed,
+        'sources': sources,
+        'keys': shots.keys,
+    }
+
+    string_data, string_offsets = bytearray(), array('I', [0])
+    for s in strings.strings:
+        string_data += s.encode('utf-8')
+        string_offsets.append(len(string_data))
+
+    sections = [
+        ('meta', array('B', json.dumps(meta).encode('utf-8'))),
+        ('strings.offsets', string_offsets),
+        ('strings.data', array('B', bytes(string_data))),
+        ('surveys.ends', survey_ends),
+        ('surveys.strings', survey_strings),
+        ('surveys.floats', survey_floats),
+        ('surveys.ints', survey_ints),
+        ('shots.present', shots.present),
+        ('shots.flag_bits', shots.flag_bits),
+        ('shots.declination', shots.declination),
+    ] + [('shots.%d' % i, column) for (i, column) in enumerate(shots.columns)]
+
+    tmpfname = '%s.%d.tmp' % (fname, os.getpid())
+    try:
+        with open(tmpfname, 'wb') as f:
+            offset = _HEADER.size + _SECTION.size * len(sections)
+            directory = []
+            for name, column in sections:
+                offset += -offset % _ALIGNMENT
+                directory.append(_SECTION.pack(name.encode('ascii'), column.typecode.encode('ascii'), offset, len(column)))
+                offset += len(column) * column.itemsize
+            f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(sections)))
+            f.write(b''.join(directory))
+            for name, column in sections:
+                f.write(b'\0' * (-f.tell() % _ALIGNMENT))
+                f.write(_to_bytes(column))
+    except BaseException:
+        if os.path.exists(tmpfname):  # not if opening it failed
+            os.remove(tmpfname)
+        raise
+    _replace(tmpfname, fname)
+    log.debug("Wrote snapshot of %d surveys, %d shots and %d strings to %s", len(survey_ends), len(shots), len(strings), fname)
+
+
+def _location_json(location):
+    if not location:
+        return None
+    return [location.easting, location.northing, location.elevation, location.zone, location.datum, location.convergence]
+
+
+def _location(values):
+    return UTMLocation(*values[:4], datum=values[4], convergence=values[5]) if values else None
+
+
+class _Snapshot(object):
+    """The sections of a snapshot file, as views of its memory map (or as arrays, where mapping isn't possible)"""
+
+    def __init__(self, fname):
+        with open(fname, 'rb') as f:
+            try:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise SnapshotError('Not a snapshot: %s' % fname)
+        if len(self._buffer) < _HEADER.size:
+            raise SnapshotError('Not a snapshot: %s' % fname)
+        magic, version, count = _HEADER.unpack_from(self._buffer, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError('Not a snapshot: %s' % fname)
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError('Unsupported snapshot version %d: %s' % (version, fname))
+
+        self._prototypes = {}  # file format -> Survey.__dict__
+        self.sections = {}
+        for i in range(count):
+            name, typecode, offset, length = _SECTION.unpack_from(self._buffer, _HEADER.size + i * _SECTION.size)
+            self.sections[name.rstrip(b'\0').decode('ascii')] = self._section(typecode.decode('ascii'), offset, length)
+
+    def _section(self, typecode, offset, count):
+        size = count * array(typecode).itemsize
+        if offset + size > len(self._buffer):
+            raise SnapshotError('Truncated snapshot')
+        if _MAPPABLE:
+            return memoryview(self._buffer)[offset:offset + size].cast(typecode)
+        data = self._buffer[offset:offset + size]
+        if typecode == 'B':
+            return data
+        column = array(typecode, data)
+        if sys.byteorder != 'little':
+            column.byteswap()
+        return column
+
+    def _shot_columns(self, start, end):
+        """Return :class:`ShotColumns` for shot rows `start` to `end`"""
+        sections = self.sections
+        shots = ShotColumns(self.strings)
+        shots.present = sections['shots.present'][start:end]
+        shots.flag_bits = sections['shots.flag_bits'][start:end]
+        if not _MAPPABLE:
+            shots.flag_bits = array('B', shots.flag_bits)  # rather than bytes
+        shots.declination = sections['shots.declination'][start:end]
+        for i, key in enumerate(self.keys):  # keeping every project key, so that presence bits are unchanged
+            shots._key_bits[key] = 1 << i
+            shots.keys.append(key)
+            shots.columns[key] = sections['shots.%d' % i][start:end]
+            if key not in _FLOAT_KEYS and key not in _STRING_KEYS:
+                shots.columns[key] = [self.strings[id] for id in shots.columns[key]]
+        shots._mapped = _MAPPABLE
+        return shots
+
+    def _new_survey(self, file_format, attrs):
+        """
+        Return a new :class:`_SnapshotSurvey` with the specified attributes. Rather than initializing each
+        survey, which is slow for many small surveys, surveys are copied from a prototype per file format.
+        """
+        prototype = self._prototypes.get(file_format, None)
+        if prototype is None:
+            prototype = self._prototypes[file_format] = _SnapshotSurvey(file_format=file_format).__dict__
+        survey = _SnapshotSurvey.__new__(_SnapshotSurvey)
+        state = survey.__dict__
+        state.update(prototype)
+        state.update(attrs, _strings=self.strings)
+        state['passage_dimension_order'] = list(prototype['passage_dimension_order'])
+        state['shot_item_order'] = list(prototype['shot_item_order'])
+        return survey
+
+    def load(self):
+        """Build and return the :class:`Project`"""
+        sections = self.sections
+        meta = json.loads(bytes(sections['meta']).decode('utf-8'))
+        strings = self.strings = _MappedStrings(sections['strings.offsets'], sections['strings.data'])
+        self.keys = meta['keys']
+        sources = [_SourceFile(*source) for source in meta['sources']]
+
+        project = Project(meta['name'], meta['filename'])
+        if meta['base_location']:
+            project.set_base_location(_location(meta['base_location']))
+        project._utm_zone, project._utm_datum, project._utm_convergence = meta['utm']
+        project.override_lrud = meta['override_lrud']
+        project.lrud_association = meta['lrud_association']
+
+        ends, survey_strings = sections['surveys.ends'], sections['surveys.strings']
+        floats, ints = sections['surveys.floats'], sections['surveys.ints']
+        n_strings = len(_SURVEY_STRINGS)
+        decoded = {}  # string id -> string, since much survey metadata is repeated
+        i, start = 0, 0  # survey index, shot row
+        for file_meta in meta['files']:
+            if 'link' in file_meta:
+                project.add_linked_file(file_meta['link'])
+                continue
+            datfile = DatFile(file_meta['name'], filename=file_meta['filename'])
+            for _ in range(file_meta['surveys']):
+                ids = survey_strings[i * n_strings:(i + 1) * n_strings]
+                name, comment, cave_name, team, file_format, shot_header = \
+                    [decoded[id] if id in decoded else decoded.setdefault(id, strings[id]) for id in ids]
+                declination, c1, c2, c3, c4, c5 = floats[i * _SURVEY_FLOATS:(i + 1) * _SURVEY_FLOATS]
+                date, source, raw_start, raw_end = ints[i * _SURVEY_INTS:(i + 1) * _SURVEY_INTS]
+                end = ends[i]
+                survey = self._new_survey(file_format, dict(
+                    name=name, date=datetime.date.fromordinal(date) if date else None, comment=comment,
+                    team=team.split(_TEAM_SEPARATOR) if team is not None else [], declination=declination,
+                    corrections=(c1, c2, c3), corrections2=(c4, c5), cave_name=cave_name,
+                    shot_header=shot_header.split('\t') if shot_header else [], _shots=None,
+                    _shot_block=(self, start, end), _raw_count=end - start))
+                if source != -1:
+                    survey._set_raw(sources[source], raw_start, raw_end)
+                datfile.add_survey(survey)
+                i, start = i + 1, end
+            if file_meta['tail'] is not None:
+                datfile._raw_tail = file_meta['tail'].encode('latin-1')
+            project.add_linked_file(datfile)
+
+        for file_index, station, location in meta['fixed_stations']:
+            project.add_linked_station(project.linked_files[file_index], station, _location(location))
+        return project
+
+
+def load_snapshot(fname):
+    """Load a :class:`davies.compass.Project` from a snapshot file written by :func:`save_snapshot`"""
+    log.debug("Loading snapshot %s ...", fname)
+    return _Snapshot(fname).load()
@@ -6,14 +6,14 @@ from __future__ import division
 from __future__ import print_function
 
 import re
-import codecs
+import io
 import logging
 from datetime import datetime
 from collections import OrderedDict, defaultdict
 
 log = logging.getLogger(__name__)
 
-__all__ = 'TxtFile', 'Survey', 'MergingSurvey', 'Shot', 'PocketTopoTxtParser'
+__all__ = 'TxtFile', 'Survey', 'MergingSurvey', 'Shot', 'PocketTopoTxtParser', 'ParseException'
 
 
 # TODO: properly handle zero-length shots with both from/to (station equivalence)
@@ -84,6 +84,8 @@ class Survey(object):
 
         self.shots = []
         self.splays = defaultdict(list)
+        self._stations = None  # FROM and TO stations of the first `_stations_count` shots, built on first lookup and then kept up to date
+        self._stations_count = 0
         if shots:
             [self.add_shot(shot) for shot in shots]
 
@@ -93,6 +95,10 @@ class Survey(object):
         if shot.is_splay:
             self.splays[shot['FROM']].append(shot)
         self.shots.append(shot)
+        if self._stations is not None and self._stations_count == len(self.shots) - 1:
+            self._stations.add(shot.get('FROM', None))
+            self._stations.add(shot.get('TO', None))
+            self._stations_count += 1
 
     @property
     def length(self):
@@ -112,10 +118,18 @@ class Survey(object):
             yield shot
 
     def __contains__(self, item):
-        for shot in self.shots:
-            if item in (shot.get('FROM', None), shot.get('TO', None)):
-                return True
-        return False
+        """Does this survey contain the specified station?"""
+        if self._stations is None or self._stations_count != len(self.shots):
+            # shots were added since our station set was built
+            self._stations = set()
+            for shot in self.shots:
+                self._stations.add(shot.get('FROM', None))
+                self._stations.add(shot.get('TO', None))
+            self._stations_count = len(self.shots)
+        try:
+            return item in self._stations
+        except TypeError:
+            return False
 
     def __str__(self):
         return self.name
@@ -242,7 +256,11 @@ class TxtFile(object):
     :ivar angle_units:   (int) `360` for degrees (default) or `400` for grads
     :ivar surveys:       (list of :class:`Survey`)
     :ivar reference_points:  (dict of :class:`UTMLocation` by station)
+
+    Surveys are looked up by name in constant time; when several share a name, the first is returned.
     """
+    _surveys_by_name = None  # survey name -> first Survey with that name
+    _surveys_indexed = 0     # number of surveys in the index
 
     def __init__(self, name=None, length_units='m', angle_units=360):
         self.name = name
@@ -263,6 +281,9 @@ class TxtFile(object):
         survey.length_units = self.length_units
         survey.angle_units = self.angle_units
         self.surveys.append(survey)
+        if self._surveys_by_name is not None and self._surveys_indexed == len(self.surveys) - 1:
+            self._surveys_by_name.setdefault(survey.name, survey)
+            self._surveys_indexed += 1
 
     def add_reference_point(self, station, utm_location):
         """Add a :class:`UTMLocation` to :attr:`reference_points`."""
@@ -280,17 +301,35 @@ class TxtFile(object):
         for survey in self.surveys:
             yield survey
 
-    def __contains__(self, item):
+    def _survey_index(self):
+        if self._surveys_by_name is None or self._surveys_indexed != len(self.surveys):
+            self.reindex()
+        return self._surveys_by_name
+
+    def reindex(self):
+        """Rebuild the survey name index"""
+        self._surveys_by_name = {}
         for survey in self.surveys:
-            if item == survey.name or item == survey:
-                return True
-        return False
+            self._surveys_by_name.setdefault(survey.name, survey)
+        self._surveys_indexed = len(self.surveys)
+
+    def __contains__(self, item):
+        if isinstance(item, Survey):
+            return self._survey_index().get(item.name, None) is item or item in self.surveys
+        try:
+            return item in self._survey_index()
+        except TypeError:
+            return False
 
     def __getitem__(self, item):
-        for survey in self.surveys:
-            if item == survey.name or item == survey:
-                return survey
-        raise KeyError(item)
+        if isinstance(item, Survey):
+            if item not in self:
+                raise KeyError(item)
+            return item
+        try:
+            return self._survey_index()[item]
+        except TypeError:
+            raise KeyError(item)
 
     @staticmethod
     def read(fname, merge_duplicate_shots=False, encoding='windows-1252'):
@@ -304,6 +343,11 @@ class TxtFile(object):
     #             outf.write('\r\n'.join(survey._serialize()))
 
 
+class ParseException(Exception):
+    """Exception raised when parsing fails."""
+    pass
+
+
 class PocketTopoTxtParser(object):
     """Parses the PocketTopo .TXT file format"""
 
@@ -318,36 +362,38 @@ class PocketTopoTxtParser(object):
         SurveyClass = MergingSurvey if self.merge_duplicate_shots else Survey
         txtobj = None
 
-        with codecs.open(self.txtfilename, 'rb', self.encoding) as txtfile:
-            lines = txtfile.read().splitlines()
+        with io.open(self.txtfilename, 'r', encoding=self.encoding) as txtfile:
+            # single forward pass over the file's lines, so parsing is linear in file size
 
             # first line is cave name and units
             first_line_re = re.compile(r'^([\w\s]*)\(([\w\s]*),([\w\s]*)')
-            first_line = lines.pop(0)
+            first_line = next(txtfile, '')
             cave_name, length_units, angle_units = first_line_re.search(first_line).groups()
             cave_name, angle_units = cave_name.strip(), int(angle_units)
             txtobj = TxtFile(cave_name, length_units, angle_units)
+            surveys_by_id = {}  # trip id -> Survey, for routing shots to their trip
+
+            in_header = True
+            for lineno, line in enumerate(txtfile, 2):
+                if in_header:
+                    # next block identifies surveys (trip) metadata, surrounded by blanks
+                    if not line.strip():
+                        continue  # skip blanks
+                    if line.startswith('['):
+                        toks = line.split(None, 3)
+                        id, date, declination = toks[:3]
+                        id = id.strip('[]:')
+                        date = datetime.strptime(date, '%Y/%m/%d').date()
+                        declination = float(declination)
+                        comment = toks[3].strip().strip('"') if len(toks) == 4 else ''
+                        survey = SurveyClass(id, date, comment, declination, cave_name)
+                        txtobj.add_survey(survey)
+                        surveys_by_id.setdefault(id, survey)
+                        continue
+                    in_header = False
 
-            while not lines[0]:
-                lines.pop(0)  # skip blanks
-
-            # next block identifies surveys (trip) metadata
-            while lines[0].startswith('['):
-                toks = lines.pop(0).split(None, 3)
-                id, date, declination = toks[:3]
-                id = id.strip('[]:')
-                date = datetime.strptime(date, '%Y/%m/%d').date()
-                declination = float(declination)
-                comment = toks[3].strip('"') if len(toks) == 4 else ''
-                survey = SurveyClass(id, date, comment, declination, cave_name)
-                txtobj.add_survey(survey)
-
-            while not lines[0]:
-                lines.pop(0)  # skip blanks
-
-            # finally actual survey data
-            while lines:
-                line = lines.pop(0).strip()
+                # finally actual survey data
+                line = line.strip()
                 if not line:
                     continue
 
@@ -387,8 +433,13 @@ class PocketTopoTxtParser(object):
                 else:
                     raise Exception()
 
+                try:
+                    survey = surveys_by_id[survey_id]
+                except KeyError:
+                    raise ParseException('Shot on line %d refers to unknown trip [%s]: %s' % (lineno, survey_id, line.strip()))
+
                 shot = Shot([('FROM',from_), ('TO',to), ('LENGTH',length), ('AZM',azm), ('INC',inc), ('COMMENT',comment)])
-                txtobj[survey_id].add_shot(shot)
+                survey.add_shot(shot)
 
         return txtobj
 
@@ -0,0 +1,209 @@
+"""
+davies.spatial: Spatial indexing of survey stations
+
+A pure-Python k-d tree (no `scipy` dependency) for nearest-station, radius, and box queries over
+3D coordinates, plus :class:`PlotIndex` which indexes the stations and segments of a Compass
+:class:`davies.compass.plt.Plot`.
+
+Coordinates follow the Compass .PLT convention of Y, X, Z (North, East, Elevation) order.
+"""
+
+import heapq
+import math
+
+
+__all__ = 'KDTree', 'PlotIndex'
+
+
+class KDTree(object):
+    """
+    Static k-d tree over 3D points. Each point has an associated item, which is what queries return.
+
+    :ivar points: (list of tuple) point coordinates
+    :ivar items:  (list) the item for each point; defaults to the point's index
+    """
+    LEAF_SIZE = 16  # points per leaf, which are scanned linearly
+
+    def __init__(self, points, items=None):
+        """
+        :param points: (iterable of 3-tuple) point coordinates
+        :param items:  (iterable) optional item for each point
+        """
+        self.points = [tuple(float(v) for v in point) for point in points]
+        self.items = list(items) if items is not None else list(range(len(self.points)))
+        if len(self.items) != len(self.points):
+            raise ValueError('Expected %d items, got %d' % (len(self.points), len(self.items)))
+        self._coords = tuple(list(column) for column in zip(*self.points)) or ([], [], [])
+        self._order = list(range(len(self.points)))  # point indexes, permuted so each node is a contiguous range
+        self._nodes = []  # (lo, hi, axis, split, left, right); leaves have axis -1
+        if self.points:
+            self._build(0, len(self.points))
+
+    def _build(self, lo, hi):
+        node = len(self._nodes)
+        self._nodes.append(None)
+        if hi - lo <= self.LEAF_SIZE:
+            self._nodes[node] = (lo, hi, -1, 0.0, -1, -1)
+            return node
+
+        # split on the axis with the greatest spread, at the median point
+        order = self._order[lo:hi]
+        spreads = []
+        for column in self._coords:
+            values = [column[i] for i in order]
+            spreads.append(max(values) - min(values))
+        axis = spreads.index(max(spreads))
+        order.sort(key=self._coords[axis].__getitem__)
+        self._order[lo:hi] = order
+        mid = (lo + hi) // 2
+        split = self._coords[axis][order[mid - lo]]
+
+        left = self._build(lo, mid)
+        right = self._build(mid, hi)
+        self._nodes[node] = (lo, hi, axis, split, left, right)
+        return node
+
+    def __len__(self):
+        return len(self.points)
+
+    def _dist2(self, i, point):
+        y, x, z = self.points[i]
+        return (y - point[0]) ** 2 + (x - point[1]) ** 2 + (z - point[2]) ** 2
+
+    def nearest(self, point, k=1):
+        """Return a list of up to `k` `(distance, item)` tuples for the points nearest `point`, closest first"""
+        if not self.points or k < 1:
+            return []
+        heap = []  # max-heap of (-dist2, index) for the best k found so far
+        stack = [(0, 0.0)]  # (node, lower bound of squared distance to any point in it)
+        while stack:
+            node, bound = stack.pop()
+            if len(heap) == k and bound > -heap[0][0]:
+                continue  # pruned by a closer point found since this node was pushed
+            lo, hi, axis, split, left, right = self._nodes[node]
+            if axis == -1:
+                for i in self._order[lo:hi]:
+                    d2 = self._dist2(i, point)
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-d2, i))
+                    elif d2 < -heap[0][0]:
+                        heapq.heapreplace(heap, (-d2, i))
+                continue
+            diff = point[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            stack.append((far, max(bound, diff * diff)))
+            stack.append((near, bound))  # searched first
+        return [(math.sqrt(-d2), self.items[i]) for (d2, i) in sorted(heap, reverse=True)]
+
+    def within(self, point, radius):
+        """Return a list of `(distance, item)` tuples for every point within `radius` of `point`, closest first"""
+        if not self.points:
+            return []
+        r2 = radius * radius
+        found = []
+        stack = [0]
+        while stack:
+            lo, hi, axis, split, left, right = self._nodes[stack.pop()]
+            if axis == -1:
+                for i in self._order[lo:hi]:
+                    d2 = self._dist2(i, point)
+                    if d2 <= r2:
+                        found.append((d2, i))
+                continue
+            if point[axis] - radius <= split:
+                stack.append(left)
+            if point[axis] + radius >= split:
+                stack.append(right)
+        found.sort()
+        return [(math.sqrt(d2), self.items[i]) for (d2, i) in found]
+
+    def in_box(self, lo, hi):
+        """Return a list of items for every point within the box with corners `lo` and `hi` (inclusive)"""
+        if not self.points:
+            return []
+        found = []
+        stack = [0]
+        while stack:
+            start, end, axis, split, left, right = self._nodes[stack.pop()]
+            if axis == -1:
+                for i in self._order[start:end]:
+                    p = self.points[i]
+                    if lo[0] <= p[0] <= hi[0] and lo[1] <= p[1] <= hi[1] and lo[2] <= p[2] <= hi[2]:
+                        found.append(i)
+                continue
+            if lo[axis] <= split:
+                stack.append(left)
+            if hi[axis] >= split:
+                stack.append(right)
+        found.sort()
+        return [self.items[i] for i in found]
+
+
+class PlotIndex(object):
+    """
+    Spatial index over the stations and segments of a :class:`davies.compass.plt.Plot`.
+
+    Each station is indexed once, by the first :class:`davies.compass.plt.Command` which plots it.
+    Segments are indexed by their bounding boxes.
+
+    :ivar stations: (:class:`KDTree`) of :class:`davies.compass.plt.Command`
+    :ivar segments: (:class:`KDTree`) of :class:`davies.compass.plt.Segment`, keyed on bounding box center
+    """
+
+    def __init__(self, plot, hidden=False):
+        """
+        :param plot:   (:class:`davies.compass.plt.Plot`)
+        :param hidden: (bool) whether to index "hidden" stations (typically splay shots)
+        """
+        seen, points, commands = set(), [], []
+        bounds = []  # (segment, (ymin, xmin, zmin), (ymax, xmax, zmax))
+        for segment in plot:
+            for cmd in segment:
+                if cmd.name in seen or (cmd.cmd == 'd' and not hidden):
+                    continue
+                seen.add(cmd.name)
+                points.append((cmd.y, cmd.x, cmd.z))
+                commands.append(cmd)
+            box = self._segment_bounds(segment)
+            if box is not None:
+                bounds.append((segment,) + box)
+        self.stations = KDTree(points, commands)
+
+        # a box query is answered by querying segment centers with the box grown by the largest
+        # segment half-extent, then checking each candidate's own bounds
+        self._segment_bounds_by_id = dict((id(segment), (lo, hi)) for (segment, lo, hi) in bounds)
+        self._half_extent = [max([(hi[a] - lo[a]) / 2.0 for (_, lo, hi) in bounds] or [0.0]) for a in range(3)]
+        self.segments = KDTree([tuple((lo[a] + hi[a]) / 2.0 for a in range(3)) for (_, lo, hi) in bounds],
+                               [segment for (segment, _, _) in bounds])
+
+    @staticmethod
+    def _segment_bounds(segment):
+        if None not in (segment.ymin, segment.ymax, segment.xmin, segment.xmax, segment.zmin, segment.zmax):
+            return (segment.ymin, segment.xmin, segment.zmin), (segment.ymax, segment.xmax, segment.zmax)
+        if not segment.commands:
+            return None
+        coords = list(zip(*[(cmd.y, cmd.x, cmd.z) for cmd in segment]))
+        return tuple(min(c) for c in coords), tuple(max(c) for c in coords)
+
+    def nearest(self, point, k=1):
+        """Return a list of up to `k` `(distance, command)` tuples for the stations nearest the (Y, X, Z) `point`"""
+        return self.stations.nearest(point, k)
+
+    def within(self, point, radius):
+        """Return a list of `(distance, command)` tuples for the stations within `radius` of the (Y, X, Z) `point`"""
+        return self.stations.within(point, radius)
+
+    def stations_in_box(self, lo, hi):
+        """Return a list of station commands within the box with (Y, X, Z) corners `lo` and `hi`"""
+        return self.stations.in_box(lo, hi)
+
+    def segments_in_box(self, lo, hi):
+        """Return a list of segments whose bounding boxes intersect the box with (Y, X, Z) corners `lo` and `hi`"""
+        grown_lo = [lo[a] - self._half_extent[a] for a in range(3)]
+        grown_hi = [hi[a] + self._half_extent[a] for a in range(3)]
+        found = []
+        for segment in self.segments.in_box(grown_lo, grown_hi):
+            seg_lo, seg_hi = self._segment_bounds_by_id[id(segment)]
+            if all(seg_lo[a] <= hi[a] and seg_hi[a] >= lo[a] for a in range(3)):
+                found.append(segment)
+        return found
@@ -1,14 +1,27 @@
 """
 davies.math: basic mathematics routines for reduction of survey data
 
-This is "slow math", operating on scalar values without vector math (no `numpy` dependency).
+The basic routines are "slow math", operating on scalar values without vector math (no `numpy`
+dependency). Each has an `_array` counterpart which operates on whole columns of values at once;
+these use `numpy` when it is installed, and otherwise fall back to the scalar routines and return
+lists.
 """
 
 import math
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 __all__ = 'hd', 'vd', 'cartesian_offset', 'angle_delta', \
-          'm2ft', 'ft2m'
+          'm2ft', 'ft2m', \
+          'hd_array', 'vd_array', 'cartesian_offset_array', 'angle_delta_array', \
+          'm2ft_array', 'ft2m_array', 'HAS_NUMPY'
+
+
+HAS_NUMPY = np is not None
 
 
 #
@@ -71,3 +84,85 @@ def angle_delta(a1, a2):
     :param a2: (float) angle in degrees
     """
     return 180 - abs(abs(a1 - a2) - 180)
+
+
+#
+# Array Routines
+#
+
+def _columns(*args):
+    """Broadcast a mix of scalars and equal-length sequences to lists, for the pure-Python fallback"""
+    n = max([len(arg) for arg in args if hasattr(arg, '__len__')] or [1])
+    return [arg if hasattr(arg, '__len__') else [arg] * n for arg in args]
+
+
+def m2ft_array(m):
+    """Convert an array of meters to feet"""
+    if np is not None:
+        return np.asarray(m, dtype=float) * 3.28084
+    return [m2ft(v) for v in m]
+
+def ft2m_array(ft):
+    """Convert an array of feet to meters"""
+    if np is not None:
+        return np.asarray(ft, dtype=float) * 0.3048
+    return [ft2m(v) for v in ft]
+
+
+def hd_array(inc, sd):
+    """
+    Calculate horizontal distances for arrays of shots.
+
+    :param inc: (array of float) inclination angles in degrees
+    :param sd:  (array of float) slope distances in any units
+    """
+    if np is not None:
+        return np.asarray(sd, dtype=float) * np.cos(np.radians(inc))
+    return [hd(i, d) for (i, d) in zip(*_columns(inc, sd))]
+
+
+def vd_array(inc, sd):
+    """
+    Calculate vertical distances for arrays of shots.
+
+    :param inc: (array of float) inclination angles in degrees
+    :param sd:  (array of float) slope distances in any units
+    """
+    if np is not None:
+        return np.abs(np.asarray(sd, dtype=float) * np.sin(np.radians(inc)))
+    return [vd(i, d) for (i, d) in zip(*_columns(inc, sd))]
+
+
+def cartesian_offset_array(azm, inc, sd, origin=(0, 0)):
+    """
+    Calculate the (X, Y) cartesian coordinate offsets for arrays of shots.
+
+    :param azm:    (array of float) azimuth angles in degrees
+    :param inc:    (array of float) inclination angles in degrees
+    :param sd:     (array of float) slope distances in any units
+    :param origin: (tuple(float, float)) optional origin coordinate, or tuple of origin arrays
+    :returns: tuple of (X array, Y array)
+    """
+    if np is not None:
+        azm = np.radians(azm)
+        hd = np.asarray(sd, dtype=float) * np.cos(np.radians(inc))
+        x, y = hd * np.sin(azm), hd * np.cos(azm)
+        return (x, y) if not origin else (x + origin[0], y + origin[1])
+    offsets = [cartesian_offset(a, i, d, None) for (a, i, d) in zip(*_columns(azm, inc, sd))]
+    x, y = [offset[0] for offset in offsets], [offset[1] for offset in offsets]
+    if not origin:
+        return x, y
+    x0, y0 = _columns(origin[0], origin[1], x)[:2]
+    return [v + o for (v, o) in zip(x, x0)], [v + o for (v, o) in zip(y, y0)]
+
+
+def angle_delta_array(a1, a2):
+    """
+    Calculate the absolute differences between two arrays of angles in degrees
+
+    :param a1: (array of float) angles in degrees
+    :param a2: (array of float) angles in degrees
+    """
+    if np is not None:
+        return 180 - np.abs(np.abs(np.asarray(a1, dtype=float) - a2) - 180)
+    return [angle_delta(v1, v2) for (v1, v2) in zip(*_columns(a1, a2))]
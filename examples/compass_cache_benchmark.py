@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Benchmark reading a Compass .DAT file through a ParseCache, against parsing it directly.
+
+usage: compass_cache_benchmark.py DATFILE [REPEAT]
+
+
+Example:
+
+$ ./examples/compass_cache_benchmark.py tests/data/compass/FULFORD.DAT
+parse                 2.12 msec
+cache miss            4.19 msec
+cache hit             0.32 msec   (6.7x)
+  ... and unpack      0.95 msec
+hit after touch       0.61 msec
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from davies.compass import DatFile
+from davies.compass.cache import ParseCache
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(datfilename, repeat=20):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, os.path.basename(datfilename))
+        shutil.copy(datfilename, fname)
+        cache = ParseCache(os.path.join(tmpdir, 'cache'))
+
+        def miss():
+            cache.clear()
+            DatFile.read(fname, cache=cache)
+
+        def touched():
+            st = os.stat(fname)
+            os.utime(fname, (st.st_atime, st.st_mtime + 1))
+            start = time.time()
+            DatFile.read(fname, cache=cache)
+            return time.time() - start
+
+        parse = best_time(lambda: DatFile.read(fname), repeat)
+        print('parse              %7.2f msec' % (parse * 1000))
+        print('cache miss         %7.2f msec' % (best_time(miss, repeat) * 1000))
+        hit = best_time(lambda: DatFile.read(fname, cache=cache), repeat)
+        print('cache hit          %7.2f msec   (%.1fx)' % (hit * 1000, parse / hit))
+        print('  ... and unpack   %7.2f msec' % (best_time(lambda: [s.shots for s in DatFile.read(fname, cache=cache)], repeat) * 1000))
+        print('hit after touch    %7.2f msec' % (min(touched() for _ in range(repeat)) * 1000))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1], *[int(arg) for arg in sys.argv[2:3]])
@@ -16,8 +16,7 @@ def print_cumulative_footage(datfiles):
 
     for datfilename in datfiles:
         print datfilename, '...'
-        datfile = DatFile.read(datfilename)
-        for survey in datfile:
+        for survey in DatFile.iter_surveys(datfilename):
             month = survey.date.strftime('%Y-%m')
             monthly_stats[month] += survey.included_length
 
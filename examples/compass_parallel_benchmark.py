@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Benchmark Project.read() of a synthetic Compass project with linked .DAT files parsed serially and
+in a process pool, along with the serial cost of receiving each worker's parsed DatFile.
+
+usage: compass_parallel_benchmark.py [FILES] [SHOTS_PER_FILE] [WORKERS]
+
+
+A pool can only win with more than one CPU; each file costs the parent just the unpickle time, with
+shots unpacked later as each survey is first used. Example, on a single-CPU machine:
+
+$ ./examples/compass_parallel_benchmark.py 4 50000 2
+parsing 4 files of 50000 shots each
+  workers=1            2.334 sec
+  workers=2            3.992 sec   (0.6x)
+  parse per file       0.517 sec
+  unpickle per file    0.058 sec
+  ... and unpack       0.209 sec
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import pickle
+import random
+import shutil
+import datetime
+import tempfile
+import multiprocessing
+
+from davies.compass import Project, DatFile, Survey, Shot
+
+
+def write_datfile(fname, shots, shots_per_survey=20):
+    """Write a synthetic .DAT file with the specified number of shots"""
+    rand = random.Random(shots)
+    dat = DatFile(os.path.basename(fname), filename=fname)
+    for i in range(0, shots, shots_per_survey):
+        survey = Survey(name='S%d' % i, date=datetime.date(2015, 6, 22), team=['A. Caver', 'B. Caver'],
+                        declination=5.5, file_format='DDDDUDLRLADN', cave_name='Benchmark Cave',
+                        shot_header=['FROM', 'TO', 'LENGTH', 'BEARING', 'INC', 'LEFT', 'UP', 'DOWN', 'RIGHT', 'FLAGS', 'COMMENTS'])
+        for j in range(i, min(shots, i + shots_per_survey)):
+            survey.add_shot(Shot([('FROM', 'A%d' % j), ('TO', 'A%d' % (j + 1)), ('LENGTH', rand.uniform(1, 50)),
+                                  ('BEARING', rand.uniform(0, 360)), ('INC', rand.uniform(-90, 90)),
+                                  ('LEFT', 1.0), ('UP', 2.0), ('DOWN', 3.0), ('RIGHT', 4.0),
+                                  ('FLAGS', 'L' if j % 50 == 0 else ''), ('COMMENTS', '')]))
+        dat.add_survey(survey)
+    dat.write(fname)
+
+
+def best_time(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(files=8, shots=50000, workers=multiprocessing.cpu_count()):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        makfname = os.path.join(tmpdir, 'BENCH.MAK')
+        with open(makfname, 'w') as mak:
+            mak.write('@357715.717,4372837.574,3048.000,13,-1.050;\r\n&North American 1983;\r\n')
+            for i in range(files):
+                write_datfile(os.path.join(tmpdir, 'BENCH%d.DAT' % i), shots)
+                mak.write('#BENCH%d.DAT;\r\n' % i)
+
+        print('parsing %d files of %d shots each' % (files, shots))
+        serial = best_time(lambda: Project.read(makfname, workers=1))
+        print('  workers=1          %7.3f sec' % serial)
+        parallel = best_time(lambda: Project.read(makfname, workers=workers))
+        print('  workers=%-2d         %7.3f sec   (%.1fx)' % (workers, parallel, serial / parallel))
+
+        # the parent process receives each worker's DatFile serially
+        datfname = os.path.join(tmpdir, 'BENCH0.DAT')
+        payload = pickle.dumps(DatFile.read(datfname), pickle.HIGHEST_PROTOCOL)
+        print('  parse per file     %7.3f sec' % best_time(lambda: DatFile.read(datfname)))
+        print('  unpickle per file  %7.3f sec' % best_time(lambda: pickle.loads(payload)))
+        print('  ... and unpack     %7.3f sec' % best_time(lambda: [s.shots for s in pickle.loads(payload)]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:4]]
+    benchmark(*args)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Benchmark parsing a Compass .DAT file against building the same shots as plain OrderedDicts, the
+parse work which can't be avoided. The difference is our own bookkeeping on the parsing hot path.
+
+usage: compass_parse_benchmark.py DATFILE [REPEAT]
+
+
+Example:
+
+$ ./examples/compass_parse_benchmark.py tests/data/compass/FULFORD.DAT
+build OrderedDicts    1.34 msec
+parse                 2.11 msec   (1.6x)
+"""
+from __future__ import print_function
+
+import sys
+import time
+from collections import OrderedDict
+
+from davies.compass import DatFile, CompassSurveyParser
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(datfilename, repeat=20):
+    dat = DatFile.read(datfilename)
+    with open(datfilename, 'rb') as f:
+        blocks = f.read().decode('windows-1252').split('\x0C')
+    blocks = [(survey.shot_header, block.strip().splitlines()[9:]) for (survey, block) in zip(dat, blocks)]
+
+    def build_shots():
+        for header, lines in blocks:
+            for line in lines:
+                vals = line.split(None, len(header) - 2)
+                OrderedDict((key, CompassSurveyParser._coerce(key, val)) for (key, val) in zip(header, vals))
+
+    build = best_time(build_shots, repeat)
+    print('build OrderedDicts %7.2f msec' % (build * 1000))
+    parse = best_time(lambda: DatFile.read(datfilename), repeat)
+    print('parse              %7.2f msec   (%.1fx)' % (parse * 1000, parse / build))
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1], *[int(arg) for arg in sys.argv[2:3]])
@@ -32,7 +32,7 @@ def compass_stats(datfiles):
     stats = {}
 
     for datfile in datfiles:
-        for survey in compass.DatFile.read(datfile):
+        for survey in compass.DatFile.iter_surveys(datfile):
             for name in survey.team:
                 stats[name] = stats.get(name, 0.0) + survey.length
 
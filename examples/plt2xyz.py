@@ -22,16 +22,15 @@ FT_TO_M = 0.3048  # convert feet to meters
 def plt2xyz(fname):
 	"""Convert a Compass plot file to XYZ pointcloud"""
 	parser = CompassPltParser(fname)
-	plt = parser.parse()
-
-	for segment in plt:
-		for command in segment:
-			if command.cmd == 'd':
-				if plt.utm_zone:
-					x, y, z = command.x * FT_TO_M, command.y * FT_TO_M, command.z * FT_TO_M
-				else:
-					x, y, z = command.x, command.y, command.z
-				print('%.3f\t%.3f\t%.3f' % (x, y, z))
+
+	# stream commands rather than parsing the whole plot, so huge files run in constant memory
+	for command in parser.iter_commands():
+		if command.cmd == 'd':
+			if parser.plot.utm_zone:
+				x, y, z = command.x * FT_TO_M, command.y * FT_TO_M, command.z * FT_TO_M
+			else:
+				x, y, z = command.x, command.y, command.z
+			print('%.3f\t%.3f\t%.3f' % (x, y, z))
 
 
 def main():
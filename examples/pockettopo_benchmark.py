@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Benchmark the PocketTopo .TXT parser against synthetic exports of increasing size, to show
+that parse time scales linearly with the number of shots.
+
+usage: pockettopo_benchmark.py [MAX_SHOTS]
+
+
+Example:
+
+$ ./examples/pockettopo_benchmark.py 160000
+   shots      trips   seconds   usec/shot
+   10000          5     0.121       12.1
+   20000         10     0.240       12.0
+   40000         20     0.494       12.3
+   80000         40     1.007       12.6
+  160000         80     2.226       13.9
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+from davies import pockettopo
+
+
+def write_txtfile(fname, shots, shots_per_trip=2000):
+    """Write a synthetic PocketTopo .TXT export with the specified number of shots"""
+    trips = max(1, shots // shots_per_trip)
+    rand = random.Random(shots)
+    with open(fname, 'w') as f:
+        f.write('Benchmark Cave  (m, 360)\n\n')
+        for trip in range(1, trips + 1):
+            f.write('[%d]: 2015/06/22     0.00  "trip %d"\n' % (trip, trip))
+        f.write('\n     1.0         594999.00    5189999.00   3999.00    "entrance"\n\n')
+        for i in range(shots):
+            trip = i * trips // shots + 1
+            if i % 4:
+                f.write('     %d.%d                  %6.2f  %6.2f  %6.2f  [%d]\n' %
+                        (trip, i, rand.uniform(1, 20), rand.uniform(0, 360), rand.uniform(-90, 90), trip))
+            else:
+                f.write('     %d.%d      %d.%d     %6.2f  %6.2f  %6.2f  [%d]\n' %
+                        (trip, i, trip, i + 4, rand.uniform(1, 20), rand.uniform(0, 360), rand.uniform(-90, 90), trip))
+    return trips
+
+
+def benchmark(max_shots=160000):
+    print('%8s %10s %9s %11s' % ('shots', 'trips', 'seconds', 'usec/shot'))
+    shots = 10000
+    while shots <= max_shots:
+        fd, fname = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+        try:
+            trips = write_txtfile(fname, shots)
+            start = time.time()
+            pockettopo.TxtFile.read(fname)
+            elapsed = time.time() - start
+        finally:
+            os.remove(fname)
+        print('%8d %10d %9.3f %11.1f' % (shots, trips, elapsed, 1e6 * elapsed / shots))
+        shots *= 2
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 160000)
@@ -1,8 +1,30 @@
 import unittest
 import datetime
+import csv
+import math
 import os.path
+import pickle
+import shutil
+import tempfile
 
 from davies.compass import *
+from davies.compass import FLAG_BITS, CompassSurveyParser, _CachedLengths, _PackedShots
+from davies.compass.index import DatIndex
+from davies.compass.cache import ParseCache
+from davies.compass.columnar import ColumnarSurvey, ShotColumns, _corrected_columns
+from davies.compass.reduction import Reduction
+from davies.compass.closure import MIN_VARIANCE
+from davies.compass.loops import LoopBasis
+from davies.compass.snapshot import SnapshotError
+from davies.compass import export
+from davies.compass.db import ShotDatabase
+from davies.compass.plt import CompassPltParser
+from davies.survey_math import m2ft
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
 
 
 DATA_DIR = 'tests/data/compass'
@@ -65,6 +87,420 @@ class CompassParsingTestCase(unittest.TestCase):
         self.assertTrue(Exclude.PLOT in self.shot_w_flags.flags)
 
 
+class CompassParallelParsingTest(unittest.TestCase):
+
+    def test_workers(self):
+        project = Project.read(TESTFILE)
+        parallel_project = Project.read(TESTFILE, workers=2)
+        self.assertEqual([dat.name for dat in parallel_project], [dat.name for dat in project])
+        for dat, parallel_dat in zip(project, parallel_project):
+            self.assertEqual([s.name for s in parallel_dat], [s.name for s in dat])
+            self.assertEqual([s.shots for s in parallel_dat], [s.shots for s in dat])
+        self.assertEqual(parallel_project.linked_files[0]['BS'].shots[-1].declination, 11.18)
+
+    def test_payload(self):
+        # the parent process unpickles every worker's DatFile serially, so shots travel packed and stay packed until used
+        # (see examples/compass_parallel_benchmark.py for timings)
+        dat = DatFile.read(os.path.join(DATA_DIR, 'FULFORD.DAT'))
+        payload = pickle.dumps(dat, pickle.HIGHEST_PROTOCOL)
+        self.assertTrue(len(payload) < 0.5 * len(pickle.dumps([s.shots for s in dat], pickle.HIGHEST_PROTOCOL)))
+
+        unpickled = pickle.loads(payload)
+        for survey in unpickled:
+            self.assertTrue(isinstance(survey._shot_block, _PackedShots))
+            self.assertEqual(len(survey._shot_block), len(dat[survey.name].shots))
+        self.assertEqual([s.shots for s in unpickled], [s.shots for s in dat])
+        self.assertEqual([[shot.declination for shot in s] for s in unpickled], [[shot.declination for shot in s] for s in dat])
+        self.assertTrue(all(shot._survey is unpickled['BS'] for shot in unpickled['BS']))
+
+
+class CompassParseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ParseCache(os.path.join(self.tmpdir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_project(self):
+        project = Project.read(TESTFILE, cache=self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+        cached_project = Project.read(TESTFILE, cache=self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+        for dat, cached_dat in zip(project, cached_project):
+            self.assertEqual([s.shots for s in cached_dat], [s.shots for s in dat])
+
+    def test_modified(self):
+        fname = os.path.join(self.tmpdir, 'FLAGS.DAT')
+        shutil.copy(os.path.join(DATA_DIR, 'FLAGS.DAT'), fname)
+        DatFile.read(fname, cache=self.cache)
+        self.assertEqual(len(DatFile.read(fname, cache=self.cache)['toc']), 17)
+        self.assertEqual(self.cache.hits, 1)
+
+        dat = DatFile.read(fname)
+        dat['toc'].shots.pop()
+        dat.write(fname)
+        self.assertEqual(len(DatFile.read(fname, cache=self.cache)['toc']), 16)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_touched(self):
+        import davies.compass.cache
+        fname = os.path.join(self.tmpdir, 'FULFORD.DAT')
+        shutil.copy(os.path.join(DATA_DIR, 'FULFORD.DAT'), fname)
+        DatFile.read(fname, cache=self.cache)
+        st = os.stat(fname)
+        os.utime(fname, (st.st_atime, st.st_mtime + 10))
+        dat = DatFile.read(fname, cache=self.cache)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertTrue(all(survey._raw_bytes({}) is not None for survey in dat))  # still copied verbatim
+
+        content_hash, hashed = davies.compass.cache._content_hash, []
+        davies.compass.cache._content_hash = lambda fname: hashed.append(fname) or content_hash(fname)
+        try:
+            DatFile.read(fname, cache=self.cache)
+        finally:
+            davies.compass.cache._content_hash = content_hash
+        self.assertEqual((self.cache.hits, hashed), (2, []))  # the entry now records the new mtime
+
+    def test_packed_hit(self):
+        fname = os.path.join(DATA_DIR, 'FULFORD.DAT')
+        DatFile.read(fname, cache=self.cache)
+        dat = DatFile.read(fname, cache=self.cache)
+        self.assertEqual(self.cache.hits, 1)
+        # a hit unpickles each survey's shots compactly, and only unpacks them when they're used
+        self.assertTrue(all(isinstance(survey._shot_block, _PackedShots) for survey in dat))
+        self.assertEqual([survey.shots for survey in dat], [survey.shots for survey in DatFile.read(fname)])
+
+    def test_options(self):
+        DatFile.read(os.path.join(DATA_DIR, 'FLAGS.DAT'), cache=self.cache)
+        lazy_dat = DatFile.read(os.path.join(DATA_DIR, 'FLAGS.DAT'), lazy=True, cache=self.cache)
+        self.assertEqual(self.cache.hits, 0)
+        self.assertTrue(lazy_dat['toc']._shot_block)
+
+    def test_eviction(self):
+        self.cache.max_size = 1
+        Project.read(TESTFILE, cache=self.cache)
+        self.assertTrue(len(os.listdir(self.cache.directory)) <= 1)
+
+
+class CompassColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        fname = os.path.join(DATA_DIR, 'FLAGS.DAT')
+        self.survey = DatFile.read(fname)['toc']
+        self.columnar_dat = DatFile.read(fname, columnar=True)
+        self.columnar_survey = self.columnar_dat['toc']
+
+    def test_storage(self):
+        self.assertTrue(isinstance(self.columnar_survey, ColumnarSurvey))
+        self.assertTrue(isinstance(self.columnar_survey.shots, ShotColumns))
+        strings = set(id(survey.shots.strings) for survey in self.columnar_dat)
+        self.assertEqual(len(strings), 1, 'string table should be shared by the whole DatFile')
+
+    def test_shots(self):
+        self.assertEqual(len(self.columnar_survey), len(self.survey))
+        for shot, view in zip(self.survey, self.columnar_survey):
+            self.assertEqual(view, shot)
+            self.assertEqual(list(view.keys()), list(shot.keys()))
+            self.assertEqual(view.azm, shot.azm)
+            self.assertEqual(view.flags, shot.flags)
+            self.assertEqual(view.is_included, shot.is_included)
+        self.assertEqual(self.columnar_survey.shots[-1]['TO'], self.survey.shots[-1]['TO'])
+
+    def test_corrected_columns(self):
+        keys = ('FROM', 'BEARING')
+        expected = [[shot['FROM'] for shot in self.survey], [shot['BEARING'] for shot in self.survey],
+                    [shot.azm for shot in self.survey], [shot.inc for shot in self.survey], [shot.flag_bits for shot in self.survey]]
+        self.assertEqual(_corrected_columns(self.survey.shots, keys, with_flag_bits=True), expected)
+        self.assertEqual([list(c) for c in _corrected_columns(self.columnar_survey.shots, keys, with_flag_bits=True)], expected)
+        self.assertEqual(_corrected_columns(self.survey.shots, keys), expected[:4])
+
+    def test_lengths(self):
+        self.assertEqual(self.columnar_survey.included_mask(), self.survey.included_mask())
+        self.assertEqual(self.columnar_survey.length, self.survey.length)
+        self.assertEqual(self.columnar_survey.included_length, self.survey.included_length)
+        self.assertEqual(self.columnar_survey.excluded_length, self.survey.excluded_length)
+
+    def test_contains(self):
+        self.assertTrue('toc7a' in self.columnar_survey)
+        self.assertFalse('nope' in self.columnar_survey)
+
+    def test_mutation(self):
+        view = self.columnar_survey.shots[0]
+        view['FLAGS'] = 'X'
+        self.assertTrue(view.is_excluded)
+        self.assertEqual(self.columnar_survey.shots[0]['FLAGS'], 'X')
+        del view['LEFT']
+        self.assertFalse('LEFT' in view)
+        self.assertRaises(KeyError, lambda: view['LEFT'])
+        self.columnar_survey.add_shot(Shot(FROM='a', TO='b', LENGTH=10.0))
+        self.assertEqual(self.columnar_survey.shots[-1].length, 10.0)
+        self.assertEqual(self.columnar_survey.shots[-1].declination, self.survey.declination)
+        self.assertEqual(self.columnar_survey.shots[-1].get('BEARING'), None)
+
+    def test_serialize(self):
+        self.assertEqual(self.columnar_survey._serialize(), self.survey._serialize())
+
+
+class CompassCachedLengthsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Project.read(TESTFILE)
+        self.dat = self.project.linked_files[0]
+        self.survey = self.dat['BS']
+
+    def test_project(self):
+        self.assertAlmostEqual(self.project.length, sum([dat.length for dat in self.project]))
+        self.assertAlmostEqual(self.project.included_length, sum([dat.included_length for dat in self.project]))
+        self.assertAlmostEqual(self.project.excluded_length, sum([dat.excluded_length for dat in self.project]))
+
+    def test_add_shot(self):
+        project_length, dat_length, survey_length = self.project.length, self.dat.length, self.survey.length
+        self.survey.add_shot(Shot(FROM='BS1', TO='BS0', LENGTH=10.0))
+        self.survey.add_shot(Shot(FROM='BS0', TO='BS00', LENGTH=5.0, FLAGS='L'))
+        self.assertAlmostEqual(self.survey.length, survey_length + 15.0)
+        self.assertAlmostEqual(self.dat.length, dat_length + 15.0)
+        self.assertAlmostEqual(self.project.length, project_length + 15.0)
+        self.assertAlmostEqual(self.project.excluded_length, 5.0)
+
+    def test_add_survey(self):
+        project_length = self.project.length
+        survey = Survey(name='NEW')
+        survey.add_shot(Shot(FROM='A1', TO='A2', LENGTH=20.0))
+        self.dat.add_survey(survey)
+        self.assertAlmostEqual(self.project.length, project_length + 20.0)
+
+    def test_shot_mutation(self):
+        project_length, included_length = self.project.length, self.project.included_length
+        shot = self.survey.shots[0]
+        shot['LENGTH'] += 1.0
+        self.assertAlmostEqual(self.survey.length, sum([s.length for s in self.survey]))
+        self.assertAlmostEqual(self.project.length, project_length + 1.0)
+        shot['FLAGS'] = 'X'
+        self.assertAlmostEqual(self.project.included_length, included_length - shot.length + 1.0)
+        self.assertAlmostEqual(self.survey.excluded_length, shot.length)
+
+    def test_assigned_shots(self):
+        survey = Survey(name='X', shots=[Shot(FROM='A1', TO='A2', LENGTH=1.0)])
+        self.assertEqual(survey.length, 1.0)
+        survey.shots[0]['LENGTH'] = 5.0
+        self.assertEqual(survey.length, 5.0)
+
+        project_length, survey_length = self.project.length, self.survey.length
+        self.survey.shots = [Shot(FROM=shot['FROM'], TO=shot['TO'], LENGTH=1.0) for shot in self.survey.shots]
+        self.assertAlmostEqual(self.survey.length, len(self.survey))  # as many shots as before
+        self.assertAlmostEqual(self.project.length, project_length - survey_length + len(self.survey))
+        self.survey.shots[0]['LENGTH'] = 2.0
+        self.assertAlmostEqual(self.survey.length, len(self.survey) + 1.0)
+
+    def test_columnar_mutation(self):
+        dat = DatFile.read(os.path.join(DATA_DIR, 'FULFORD.DAT'), columnar=True)
+        length = dat.length
+        dat['BS'].shots[0]['LENGTH'] += 1.0
+        self.assertAlmostEqual(dat.length, length + 1.0)
+        dat['BS'].add_shot(Shot(FROM='BS1', TO='BS0', LENGTH=10.0))
+        self.assertAlmostEqual(dat.length, length + 11.0)
+
+
+class CompassParseOverheadTest(unittest.TestCase):
+    """Guard against bookkeeping (caches, indexes, dirty tracking) creeping into the parsing hot path"""
+
+    def setUp(self):
+        self.fname = os.path.join(DATA_DIR, 'FULFORD.DAT')
+
+    def test_no_notifications(self):
+        calls = []
+        shot_added, shot_changed = Survey._shot_added, Survey._shot_changed
+        Survey._shot_added = lambda survey, shot: calls.append(shot)
+        Survey._shot_changed = lambda survey, shot, key: calls.append(shot)
+        try:
+            DatFile.read(self.fname)
+            DatFile.read(self.fname, columnar=True)
+            for survey in DatFile.read(self.fname, lazy=True):
+                survey.shots
+        finally:
+            Survey._shot_added, Survey._shot_changed = shot_added, shot_changed
+        self.assertEqual(calls, [])
+
+    def test_no_bookkeeping(self):
+        # see examples/compass_parse_benchmark.py for the parse time against building plain OrderedDicts
+        calls = []
+        def record(name):
+            return lambda self, *args: calls.append(name)
+        patches = [(_CachedLengths, 'invalidate_lengths'), (Survey, '_compute_lengths'), (Survey, '_shots_replaced'),
+                   (DatFile, '_compute_lengths'), (DatFile, '_index_shot'), (DatFile, '_invalidate_station_index')]
+        originals = [getattr(cls, name) for (cls, name) in patches]
+        for cls, name in patches:
+            setattr(cls, name, record(name))
+        try:
+            DatFile.read(self.fname)
+            DatFile.read(self.fname, columnar=True)
+            for survey in DatFile.read(self.fname, lazy=True):
+                survey.shots
+        finally:
+            for (cls, name), original in zip(patches, originals):
+                setattr(cls, name, original)
+        self.assertEqual(calls, [])
+
+    def test_lazy_coerce_count(self):
+        calls = []
+        coerce = CompassSurveyParser._coerce
+        CompassSurveyParser._coerce = staticmethod(lambda key, val: calls.append(key) or coerce(key, val))
+        try:
+            dat = DatFile.read(self.fname, lazy=True)
+            self.assertEqual(calls, [])
+            survey = dat.surveys[1]
+            survey.shots
+        finally:
+            CompassSurveyParser._coerce = staticmethod(coerce)
+        self.assertEqual(len(calls), sum(len(shot) for shot in survey.shots))
+
+
+class CompassLookupIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Project.read(TESTFILE)
+        self.dat = self.project.linked_files[0]
+
+    def test_survey_lookup(self):
+        survey = self.dat.surveys[3]
+        self.assertTrue(self.dat[survey.name] is survey)
+        self.assertTrue(self.dat[survey] is survey)
+        self.assertTrue(survey in self.dat)
+        self.assertFalse(Survey(name=survey.name) in self.dat)
+        self.assertFalse('NOPE' in self.dat)
+        self.assertFalse([] in self.dat)
+        self.assertRaises(KeyError, lambda: self.dat['NOPE'])
+
+    def test_duplicate_names(self):
+        first = self.dat['BS']
+        dupe = Survey(name='BS')
+        self.dat.add_survey(dupe)
+        self.assertTrue(self.dat['BS'] is first)
+        self.assertTrue(dupe in self.dat)
+        self.assertTrue(self.dat[dupe] is dupe)
+
+    def test_add_after_lookup(self):
+        self.assertFalse('NEW' in self.dat)
+        survey = Survey(name='NEW')
+        self.dat.add_survey(survey)
+        self.assertTrue(self.dat['NEW'] is survey)
+
+    def test_direct_modification(self):
+        self.assertTrue('BS' in self.dat)
+        self.dat.surveys = [survey for survey in self.dat.surveys if survey.name != 'BS']
+        self.assertFalse('BS' in self.dat)
+
+    def test_reindex(self):
+        survey = self.dat['BS']
+        survey.name = 'RENAMED'
+        self.dat.reindex()
+        self.assertTrue(self.dat['RENAMED'] is survey)
+
+    def test_project_lookup(self):
+        self.assertTrue(self.project['FULFORD'] is self.dat)
+        self.assertTrue(self.project[self.dat] is self.dat)
+        self.assertTrue('FULSURF' in self.project)
+        self.assertRaises(KeyError, lambda: self.project['NOPE'])
+
+
+class CompassStationIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Project.read(TESTFILE)
+        self.dat = self.project.linked_files[0]
+
+    def test_lookup(self):
+        survey = self.dat['BS']
+        refs = self.project.station_index['BS1']
+        self.assertEqual(len(refs), 3)
+        self.assertTrue(all(ref.shot['FROM'] == 'BS1' or ref.shot['TO'] == 'BS1' for ref in refs))
+        self.assertEqual(self.project.station_index.surveys('BS1'), [survey])
+        self.assertEqual(self.project.station_index.datfiles('BS1'), [self.dat])
+        self.assertFalse('NOPE' in self.project.station_index)
+        self.assertEqual(self.project.station_index.shots('NOPE'), [])
+
+    def test_all_stations(self):
+        stations = set()
+        for survey in self.dat:
+            for shot in survey:
+                stations.update((shot['FROM'], shot['TO']))
+        self.assertEqual(set(self.dat.station_index), stations)
+
+    def test_add_shot(self):
+        self.assertTrue('BS1' in self.project.station_index)
+        survey = self.dat['BS']
+        shot = Shot([('FROM', 'BS1'), ('TO', 'NEW1'), ('LENGTH', 10.0)])
+        survey.add_shot(shot)
+        index = self.project.station_index
+        self.assertEqual(index['NEW1'][0].shot, shot)
+        self.assertTrue(self.dat.station_index['NEW1'][0].survey is survey)
+        self.assertEqual(len(index['BS1']), 4)
+        self.assertTrue('NEW1' in survey)
+
+    def test_add_survey(self):
+        index = self.project.station_index
+        survey = Survey(name='NEW', shots=[Shot([('FROM', 'NEW1'), ('TO', 'NEW2'), ('LENGTH', 1.0)])])
+        self.dat.add_survey(survey)
+        self.assertEqual(self.project.station_index.surveys('NEW2'), [survey])
+
+    def test_add_lazy_datfile(self):
+        self.project.station_index
+        dat = DatFile.read(os.path.join(DATA_DIR, 'FLAGS.DAT'), lazy=True)
+        self.project.add_linked_file(dat)
+        index = self.project.station_index
+        station = dat['toc'].shots[0]['FROM']
+        self.assertEqual(index.datfiles(station), [dat])
+        self.assertEqual(len(index[station]), len(dat.station_index[station]))
+
+    def test_station_renamed(self):
+        shot = self.dat['BS'].shots[0]
+        self.project.station_index
+        shot['FROM'] = 'RENAMED'
+        self.assertTrue('RENAMED' in self.project.station_index)
+        self.assertTrue('RENAMED' in self.dat['BS'])
+
+    def test_survey_contains(self):
+        survey = self.dat['BS']
+        self.assertTrue('BS1' in survey)
+        self.assertFalse('NOPE' in survey)
+        self.assertFalse([] in survey)
+        self.assertTrue('XCE8' in survey)
+        survey.shots = [shot for shot in survey.shots if shot['TO'] != 'XCE8']
+        self.assertFalse('XCE8' in survey)
+        survey.add_shot(Shot([('FROM', 'BS1'), ('TO', 'NEW1'), ('LENGTH', 1.0)]))
+        self.assertTrue('NEW1' in survey)
+
+    def test_lazily_built(self):
+        self.assertTrue(self.project._station_index is None)
+        self.assertTrue(all(survey._stations is None for survey in self.dat))
+        self.dat['BS'].add_shot(Shot([('FROM', 'BS1'), ('TO', 'NEW1'), ('LENGTH', 1.0)]))
+        self.assertTrue(self.project._station_index is None)  # nothing to update until first queried
+
+    def test_incremental(self):
+        index, dat_index = self.project.station_index, self.dat.station_index
+        survey = self.dat['BS']
+        'BS1' in survey
+        survey.add_shot(Shot([('FROM', 'BS1'), ('TO', 'NEW1'), ('LENGTH', 1.0)]))
+        self.dat.add_survey(Survey(name='NEW', shots=[Shot([('FROM', 'NEW1'), ('TO', 'NEW2'), ('LENGTH', 1.0)])]))
+        self.assertTrue(self.project.station_index is index)  # updated in place, not rebuilt
+        self.assertTrue(self.dat.station_index is dat_index)
+        self.assertEqual(len(index['NEW1']), 2)
+        self.assertEqual(len(dat_index['NEW2']), 1)
+        self.assertTrue(survey._stations is not None and 'NEW1' in survey._stations)
+
+    def test_constructed_survey_renamed(self):
+        survey = Survey(name='NEW', shots=[Shot([('FROM', 'NEW1'), ('TO', 'NEW2'), ('LENGTH', 1.0)])])
+        self.dat.add_survey(survey)
+        self.assertTrue('NEW2' in survey and 'NEW2' in self.project.station_index)
+        survey.shots[0]['TO'] = 'RENAMED'
+        self.assertTrue('RENAMED' in survey)
+        self.assertFalse('NEW2' in survey)
+        self.assertEqual(self.project.station_index.surveys('RENAMED'), [survey])
+        self.assertFalse('NEW2' in self.project.station_index)
+
+
 class CompassSpecialCharacters(unittest.TestCase):
 
     def runTest(self):
@@ -90,6 +526,271 @@ class CompassShotCorrection(unittest.TestCase):
         self.assertEqual(shot.inc, -3.75)
 
 
+class CompassBacksightWraparound(unittest.TestCase):
+
+    def runTest(self):
+        shot = Shot(BEARING=359.0, AZM2=181.0)
+        self.assertEqual(shot.azm, 0.0)
+        shot['AZM2'] = 183.0
+        self.assertEqual(shot.azm, 1.0)
+        shot['BEARING'], shot['AZM2'] = 1.0, 177.0
+        self.assertEqual(shot.azm, 359.0)
+
+
+class CompassReductionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dat = DatFile.read(os.path.join(DATA_DIR, 'FLAGS.DAT'))
+
+    def assertCoordinateAlmostEqual(self, c1, c2):
+        for v1, v2 in zip(c1, c2):
+            self.assertAlmostEqual(v1, v2, places=6)
+
+    def test_shot_offset(self):
+        reduction = Reduction(self.dat)
+        self.assertEqual(reduction['z23'], (0.0, 0.0, 0.0))
+        # z23-toc0: 8.2' at backsight-averaged 72.0, declination -9.04, and inclination 38.0
+        hd = 8.2 * math.cos(math.radians(38.0))
+        self.assertCoordinateAlmostEqual(reduction['toc0'], (hd * math.cos(math.radians(62.96)),
+                                                             hd * math.sin(math.radians(62.96)),
+                                                             8.2 * math.sin(math.radians(38.0))))
+        # toc0-toc1 has only a back compass reading, and is vertical
+        y0, x0, z0 = reduction['toc0']
+        self.assertCoordinateAlmostEqual(reduction['toc1'], (y0, x0, z0 + 14.1))
+
+    def test_excluded_shots(self):
+        reduction = Reduction(self.dat)
+        self.assertFalse('toc11a' in reduction)  # X shot
+        self.assertTrue('toc7a' in reduction)  # L shot
+        self.assertEqual(len(reduction), 17)
+
+    def test_fixed_station(self):
+        project = Project('TEST')
+        project.add_linked_file(self.dat)
+        project.add_linked_station(self.dat, 'toc5', UTMLocation(1000.0, 2000.0, 100.0, zone=13))
+        reduction = Reduction(project)
+        self.assertEqual(reduction.fixed, ['toc5'])
+        self.assertCoordinateAlmostEqual(reduction['toc5'], (m2ft(2000.0), m2ft(1000.0), m2ft(100.0)))
+
+        free = Reduction(self.dat)
+        offset = [a - b for (a, b) in zip(reduction['toc5'], free['toc5'])]
+        for station in free:
+            self.assertCoordinateAlmostEqual(reduction[station], [v + o for (v, o) in zip(free[station], offset)])
+
+        reduction = Reduction(self.dat, fixed={'z23': (10.0, 20.0, 30.0)})
+        self.assertEqual(reduction['z23'], (10.0, 20.0, 30.0))
+
+    def test_closure_excluded_shots(self):
+        survey = Survey(name='LOOP')
+        survey.add_shot(Shot(FROM='A', TO='B', LENGTH=10.0, BEARING=0.0, INC=0.0))
+        survey.add_shot(Shot(FROM='A', TO='C', LENGTH=10.0, BEARING=90.0, INC=0.0, FLAGS='C'))
+        survey.add_shot(Shot(FROM='B', TO='C', LENGTH=10.0, BEARING=180.0, INC=0.0))
+        survey.add_shot(Shot(FROM='C', TO='D', LENGTH=5.0, BEARING=90.0, INC=0.0, FLAGS='C'))
+        reduction = Reduction([survey])
+        # C is located through B, even though A-C reaches it in fewer shots
+        self.assertCoordinateAlmostEqual(reduction['C'], (0.0, 0.0, 0.0))
+        self.assertEqual(reduction.placed_by[reduction.names.index('C')], 2)
+        # D can only be reached through a closure-excluded shot
+        self.assertCoordinateAlmostEqual(reduction['D'], (0.0, 5.0, 0.0))
+
+    def test_disconnected(self):
+        s1 = Survey(name='ONE', shots=[Shot(FROM='A1', TO='A2', LENGTH=10.0, BEARING=0.0, INC=0.0)])
+        s2 = Survey(name='TWO', shots=[Shot(FROM='B1', TO='B2', LENGTH=10.0, BEARING=90.0, INC=0.0)])
+        reduction = Reduction([s1, s2])
+        self.assertEqual(reduction['B1'], (0.0, 0.0, 0.0))
+        self.assertCoordinateAlmostEqual(reduction['B2'], (0.0, 10.0, 0.0))
+
+    def test_columnar(self):
+        columnar = DatFile.read(os.path.join(DATA_DIR, 'FLAGS.DAT'), columnar=True)
+        reduction, expected = Reduction(columnar), Reduction(self.dat)
+        self.assertEqual(reduction.names, expected.names)
+        for station in expected:
+            self.assertEqual(reduction[station], expected[station])
+
+    def test_to_plot(self):
+        plot = Reduction(self.dat).to_plot('FLAGS')
+        self.assertEqual(len(plot), 1)
+        segment = plot['toc']
+        self.assertEqual([(cmd.cmd, cmd.name) for cmd in segment.commands[:3]], [('M', 'z23'), ('D', 'toc0'), ('D', 'toc1')])
+        self.assertEqual(len([cmd for cmd in segment if cmd.cmd != 'M']), 16)
+        self.assertEqual(segment.commands[1].edist, 8.2)
+        self.assertEqual(segment.commands[9].flags, 'L')
+        self.assertEqual(segment.ymax, max(cmd.y for cmd in segment))
+
+    def test_project(self):
+        project = Project.read(TESTFILE)
+        reduction = Reduction(project)
+        plot = reduction.to_plot()
+        self.assertEqual(len(plot), sum(len(datfile) for datfile in project))
+        for station in reduction:
+            for v in reduction[station]:
+                self.assertFalse(math.isnan(v))
+
+
+class CompassLoopClosureTest(unittest.TestCase):
+
+    def assertCoordinateAlmostEqual(self, c1, c2):
+        for v1, v2 in zip(c1, c2):
+            self.assertAlmostEqual(v1, v2, places=6)
+
+    def test_single_loop(self):
+        survey = Survey(name='LOOP')
+        for frm, to, length, azm in (('A', 'B', 10.0, 0.0), ('B', 'C', 10.0, 90.0), ('C', 'D', 10.0, 180.0), ('D', 'A', 11.0, 270.0)):
+            survey.add_shot(Shot(FROM=frm, TO=to, LENGTH=length, BEARING=azm, INC=0.0))
+        survey.add_shot(Shot(FROM='B', TO='B1', LENGTH=5.0, BEARING=270.0, INC=0.0))  # dangling branch
+        reduction = Reduction([survey], fixed={'A': (0.0, 0.0, 0.0)})
+        closure = reduction.close_loops()
+        # the 1' misclosure is distributed in proportion to distance around the loop
+        self.assertEqual(reduction['A'], (0.0, 0.0, 0.0))
+        self.assertCoordinateAlmostEqual(reduction['B'], (10.0, 10.0 / 41, 0.0))
+        self.assertCoordinateAlmostEqual(reduction['C'], (10.0, 10.0 + 20.0 / 41, 0.0))
+        self.assertCoordinateAlmostEqual(reduction['D'], (0.0, 10.0 + 30.0 / 41, 0.0))
+        self.assertCoordinateAlmostEqual(reduction['B1'], (10.0, 10.0 / 41 - 5.0, 0.0))
+        self.assertEqual(closure['B1'], reduction['B1'])
+        self.assertEqual(closure.junctions, 0)
+        self.assertEqual(closure.traverses, 1)
+
+    def assertLeastSquares(self, reduction, fixed, anchored=()):
+        """Check that the adjusted coordinates satisfy the weighted normal equations at every free station"""
+        original = Reduction(reduction.surveys, fixed=fixed)
+        frm, to, length, bits = reduction._frm, reduction._to, reduction._length, reduction._bits
+        closure_bit = FLAG_BITS[Exclude.CLOSURE]
+        coords = (reduction.y, reduction.x, reduction.z)
+        offsets = (original._dy, original._dx, original._dz)
+        totals = [[0.0] * len(reduction) for _ in range(3)]
+        for shot in range(len(frm)):
+            if bits[shot] & closure_bit or frm[shot] == to[shot]:
+                continue
+            for axis in range(3):
+                residual = (coords[axis][to[shot]] - coords[axis][frm[shot]] - offsets[axis][shot]) / max(length[shot], MIN_VARIANCE)
+                totals[axis][to[shot]] += residual
+                totals[axis][frm[shot]] -= residual
+        for station, name in enumerate(reduction.names):
+            if name not in fixed and name not in anchored:
+                for axis in range(3):
+                    self.assertAlmostEqual(totals[axis][station], 0.0, places=6)
+
+    def test_project(self):
+        fixed = {'A1': (0.0, 0.0, 0.0), 'SS6': (-200.0, 150.0, 20.0)}
+        reduction = Reduction(Project.read(TESTFILE), fixed=fixed)
+        closure = reduction.close_loops()
+        self.assertTrue(closure.junctions > 0)
+        self.assertEqual(reduction['SS6'], fixed['SS6'])
+        self.assertLeastSquares(reduction, fixed)
+
+    def test_closure_excluded_shots(self):
+        survey = Survey(name='LOOP')
+        for frm, to, length, azm in (('A', 'B', 10.0, 0.0), ('B', 'C', 10.0, 90.0), ('C', 'A', 15.0, 225.0)):
+            survey.add_shot(Shot(FROM=frm, TO=to, LENGTH=length, BEARING=azm, INC=0.0))
+        survey.add_shot(Shot(FROM='B', TO='C', LENGTH=12.0, BEARING=80.0, INC=0.0, FLAGS='C'))  # not adjusted
+        survey.add_shot(Shot(FROM='C', TO='D', LENGTH=5.0, BEARING=90.0, INC=0.0, FLAGS='C'))
+        survey.add_shot(Shot(FROM='D', TO='E', LENGTH=5.0, BEARING=0.0, INC=10.0))
+        reduction = Reduction([survey])
+        before = reduction['C'], reduction['D'], reduction['E']
+        reduction.close_loops()
+        self.assertLeastSquares(reduction, {}, anchored=('A',))
+        # D and E hang from C by a closure-excluded shot, and move with it
+        moved = [a - b for (a, b) in zip(reduction['C'], before[0])]
+        self.assertTrue(any(abs(v) > 0.1 for v in moved))
+        for station, coord in zip('DE', before[1:]):
+            self.assertCoordinateAlmostEqual(reduction[station], [v + m for (v, m) in zip(coord, moved)])
+
+
+class CompassLoopClosureFallbackTest(CompassLoopClosureTest):
+    """Run the loop closure tests against the pure-Python fallbacks, even if `numpy` is installed"""
+
+    def setUp(self):
+        import davies.compass.closure, davies.compass.reduction, davies.survey_math
+        self.modules = davies.compass.closure, davies.compass.reduction, davies.survey_math
+        self.np = davies.survey_math.np
+        for module in self.modules:
+            module.np = None
+
+    def tearDown(self):
+        for module in self.modules:
+            module.np = self.np
+
+
+class CompassLoopBasisTest(unittest.TestCase):
+
+    def test_triangle(self):
+        a = Survey(name='A', shots=[Shot(FROM='A1', TO='A2', LENGTH=11.36, BEARING=26.6, INC=-10.1),
+                                    Shot(FROM='A2', TO='A3', LENGTH=30.64, BEARING=31.4, INC=-25.1),
+                                    Shot(FROM='A2', TO='A2SPLAY', LENGTH=2.1, BEARING=270.0, INC=0.0, FLAGS='P')])
+        b = Survey(name='B', shots=[Shot(FROM='A2', TO='B1', LENGTH=47.38, BEARING=111.0, INC=-35.2),
+                                    Shot(FROM='B1', TO='A3', LENGTH=66.76, BEARING=296.0, INC=10.2)])
+        loops = LoopBasis([a, b])
+        self.assertEqual(len(loops), 1)
+        loop = loops.loops[0]
+        self.assertEqual((loop.shot['FROM'], loop.shot['TO']), ('B1', 'A3'))
+        self.assertEqual(loop.common, 'A2')
+        self.assertEqual(loop.stations, ['B1', 'A2', 'A3'])
+        self.assertAlmostEqual(loop.length, 30.64 + 47.38 + 66.76)
+
+    def test_several_loops(self):
+        # a square with one diagonal, the other diagonal closure-excluded, and a spur reached only past an X shot
+        shots = [Shot(FROM=fr, TO=to, LENGTH=10.0, FLAGS=flags) for (fr, to, flags) in
+                 [('A', 'B', ''), ('B', 'C', ''), ('C', 'D', ''), ('D', 'A', ''), ('A', 'C', ''),
+                  ('B', 'D', 'C'), ('D', 'E', 'X'), ('E', 'A', '')]]
+        loops = LoopBasis([Survey(name='S', shots=shots)])
+        self.assertEqual((len(loops), loops.shots, loops.stations, loops.components), (2, 6, 5, 1))
+        self.assertEqual([(loop.shot['FROM'], loop.shot['TO']) for loop in loops], [('D', 'A'), ('A', 'C')])
+        self.assertEqual([loop.stations for loop in loops], [['D', 'C', 'B', 'A'], ['A', 'B', 'C']])
+        self.assertEqual([loop.length for loop in loops], [40.0, 30.0])
+
+    def test_excluded_shots(self):
+        shots = [Shot(FROM='A', TO='B', LENGTH=10.0), Shot(FROM='B', TO='C', LENGTH=10.0),
+                 Shot(FROM='C', TO='A', LENGTH=10.0, FLAGS='C'), Shot(FROM='C', TO='A', LENGTH=10.0, FLAGS='X'),
+                 Shot(FROM='C', TO='C', LENGTH=0.0)]
+        self.assertEqual(len(LoopBasis([Survey(name='S', shots=shots)])), 0)
+        shots.append(Shot(FROM='A', TO='B', LENGTH=10.2))  # a repeated shot is a loop of its own
+        loops = LoopBasis([Survey(name='S', shots=shots)])
+        self.assertEqual(len(loops), 1)
+        self.assertEqual(loops.loops[0].stations, ['A', 'B'])
+
+    def assertBasis(self, loops, source):
+        shots = set()
+        for datfile in source:
+            for survey in datfile:
+                for shot in survey.shots:
+                    shots.add((shot['FROM'], shot['TO']))
+                    shots.add((shot['TO'], shot['FROM']))
+        for loop in loops:
+            self.assertEqual((loop.stations[0], loop.stations[-1]), (loop.shot['FROM'], loop.shot['TO']))
+            self.assertEqual(len(set(loop.stations)), len(loop.stations))
+            self.assertTrue(loop.common in loop.stations)
+            for pair in zip(loop.stations, loop.stations[1:]):
+                self.assertTrue(pair in shots)
+
+    def test_project(self):
+        project = Project.read(TESTFILE)
+        loops = LoopBasis(project)
+        # one independent loop per shot beyond a spanning tree of each connected part
+        self.assertEqual(len(loops), loops.shots - loops.stations + loops.components)
+        self.assertEqual(loops.components, 1)  # the surface survey ties into the cave
+        self.assertTrue(len(loops) > 0)
+        self.assertBasis(loops, project)
+
+        columnar = Project.read(TESTFILE, columnar=True)
+        self.assertEqual([loop.stations for loop in LoopBasis(columnar)], [loop.stations for loop in loops])
+
+
+class CompassReductionFallbackTest(CompassReductionTest):
+    """Run the reduction tests against the pure-Python fallback, even if `numpy` is installed"""
+
+    def setUp(self):
+        import davies.compass.reduction, davies.survey_math
+        CompassReductionTest.setUp(self)
+        self.modules = davies.compass.reduction, davies.survey_math
+        self.np = davies.survey_math.np
+        for module in self.modules:
+            module.np = None
+
+    def tearDown(self):
+        for module in self.modules:
+            module.np = self.np
+
+
 class CompassShotFlags(unittest.TestCase):
 
     def setUp(self):
@@ -121,6 +822,31 @@ class CompassShotFlags(unittest.TestCase):
         self.assertTrue(total_shot.is_excluded)
         self.assertFalse(total_shot.is_included)
 
+    def test_flag_bits(self):
+        shot = Shot(FROM='a', TO='b', LENGTH=5.0, FLAGS='LP')
+        self.assertEqual(shot.flag_bits, FLAG_BITS[Exclude.LENGTH] | FLAG_BITS[Exclude.PLOT])
+        shot['FLAGS'] = 'X'
+        self.assertTrue(shot.is_excluded)
+        del shot['FLAGS']
+        self.assertTrue(shot.is_included)
+        shot['FLAGS'] = 'C'
+        shot.pop('FLAGS')
+        self.assertEqual(shot.flag_bits, 0)
+
+    def test_pickle(self):
+        shot = pickle.loads(pickle.dumps(self.survey.shots[8], pickle.HIGHEST_PROTOCOL))
+        self.assertTrue(type(shot) is Shot)
+        self.assertEqual(shot, self.survey.shots[8])
+        self.assertEqual(shot.flag_bits, self.survey.shots[8].flag_bits)
+        shot['FLAGS'] = 'X'
+        self.assertEqual(shot.flag_bits, FLAG_BITS[Exclude.TOTAL])
+
+    def test_included_mask(self):
+        mask = self.survey.included_mask()
+        self.assertEqual(mask, [shot.is_included for shot in self.survey])
+        self.assertFalse(mask[8])
+        self.assertFalse(mask[13])
+
     def test_length_calculations(self):
         survey_len, included_len, excluded_len = 0.0, 0.0, 0.0
         for shot in self.survey:
@@ -134,12 +860,547 @@ class CompassShotFlags(unittest.TestCase):
         self.assertEqual(self.survey.excluded_length, excluded_len)
 
 
+class CompassStreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = os.path.join(DATA_DIR, 'FULFORD.DAT')
+        self.dat = DatFile.read(self.fname)
+
+    def test_iter_surveys(self):
+        surveys = list(DatFile.iter_surveys(self.fname))
+        self.assertEqual([s.name for s in surveys], [s.name for s in self.dat])
+        self.assertEqual([len(s) for s in surveys], [len(s) for s in self.dat])
+
+    def test_small_chunks(self):
+        # force surveys to span many chunk boundaries
+        surveys = list(CompassDatParser(self.fname).iter_surveys(chunk_size=7))
+        self.assertEqual([s.name for s in surveys], [s.name for s in self.dat])
+        self.assertEqual(surveys[-1].shots[-1], self.dat.surveys[-1].shots[-1])
+
+
+class CompassLazyParsingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = os.path.join(DATA_DIR, 'FLAGS.DAT')
+        self.dat = DatFile.read(self.fname)
+        self.lazy_dat = DatFile.read(self.fname, lazy=True)
+
+    def test_header(self):
+        survey, lazy_survey = self.dat['toc'], self.lazy_dat['toc']
+        self.assertTrue(lazy_survey._shot_block)
+        self.assertEqual(lazy_survey.name, survey.name)
+        self.assertEqual(lazy_survey.date, survey.date)
+        self.assertEqual(lazy_survey.team, survey.team)
+        self.assertEqual(lazy_survey.declination, survey.declination)
+
+    def test_shots(self):
+        for survey, lazy_survey in zip(self.dat, self.lazy_dat):
+            self.assertEqual(lazy_survey.shots, survey.shots)
+            self.assertEqual(lazy_survey.shots[0].declination, survey.declination)
+            self.assertEqual(lazy_survey.length, survey.length)
+        self.assertTrue(self.lazy_dat['toc']._shot_block is None)
+
+    def test_project(self):
+        project = Project.read(TESTFILE, lazy=True)
+        self.assertEqual(len(project.linked_files[0]['BS']), 15)
+
+
+class CompassDatIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = os.path.join(DATA_DIR, 'FULFORD.DAT')
+        self.dat = DatFile.read(self.fname)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index(self):
+        with DatIndex(self.fname) as index:
+            self.assertEqual(list(index), [survey.name for survey in self.dat])
+            self.assertTrue('BS' in index)
+            self.assertFalse('NOPE' in index)
+            self.assertEqual(index['BS'].shots, self.dat['BS'].shots)
+            self.assertRaises(KeyError, lambda: index['NOPE'])
+
+    def test_closed(self):
+        with DatIndex(self.fname) as index:
+            pass
+        self.assertRaises(ValueError, lambda: index['BS'])
+        self.assertRaises(ValueError, iter, index)
+
+    def test_cache(self):
+        cache_fname = os.path.join(self.tmpdir, 'FULFORD.idx')
+        with DatIndex(self.fname, cache_filename=cache_fname) as index:
+            offsets = index.offsets
+        self.assertTrue(os.path.exists(cache_fname))
+        with DatIndex(self.fname, cache_filename=cache_fname) as index:
+            self.assertEqual(index.offsets, offsets)
+            self.assertEqual(index['XS'].shots, self.dat['XS'].shots)
+
+
 class OldData(unittest.TestCase):
 
     def test_old(self):
         fname = os.path.join(DATA_DIR, '1998.DAT')
         dat = DatFile.read(fname)
 
+    def test_old_lazy(self):
+        fname = os.path.join(DATA_DIR, '1998.DAT')
+        dat, lazy_dat = DatFile.read(fname), DatFile.read(fname, lazy=True)
+        self.assertEqual([s.shots for s in lazy_dat], [s.shots for s in dat])
+
+
+class CompassWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_bytes(self, fname):
+        with open(fname, 'rb') as f:
+            return f.read()
+
+    def test_round_trip(self):
+        for name in ('FULFORD.DAT', 'FLAGS.DAT', 'unicode.dat'):
+            fname, fname2 = os.path.join(self.tmpdir, name), os.path.join(self.tmpdir, '2' + name)
+            DatFile.read(os.path.join(DATA_DIR, name)).write(fname)
+            dat = DatFile.read(fname)
+            dat.write(fname2)
+            self.assertEqual(self.read_bytes(fname2), self.read_bytes(fname))
+            dat.write(fname2)  # writing again mustn't depend on consumed state
+            self.assertEqual(self.read_bytes(fname2), self.read_bytes(fname))
+            DatFile.read(fname, columnar=True).write(fname2)
+            self.assertEqual(self.read_bytes(fname2), self.read_bytes(fname))
+
+    def test_format(self):
+        fname = os.path.join(self.tmpdir, 'TEST.DAT')
+        dat = DatFile('TEST')
+        survey = Survey(name='A', date=datetime.date(2015, 6, 22), declination=1.5, cave_name='Test Cave')
+        survey.add_shot(Shot(FROM='A1', TO='A2', LENGTH=12.5, BEARING=7.0, INC=None, LEFT=float('inf'), UP=1.0, DOWN=2.0, RIGHT=None, FLAGS='LP', COMMENTS='tight'))
+        survey.add_shot(Shot(FROM='A2', TO='A3', LENGTH=3.0, BEARING=359.5, INC=-2.25, LEFT=1.0, UP=1.0, DOWN=2.0, RIGHT=3.0, COMMENTS=u'caf\xe9'))
+        dat.add_survey(survey)
+        dat.write(fname)
+        lines = self.read_bytes(fname).split(b'\r\n')
+        self.assertEqual(lines[9], b'    A1\t    A2\t  12.500\t   7.00\t-999.00\t  -9.90\t   1.00\t   2.00\t  -9.90\t#|LP#  tight')
+        self.assertEqual(lines[10], b'    A2\t    A3\t   3.000\t 359.50\t  -2.25\t   1.00\t   1.00\t   2.00\t   3.00\tcaf\xe9')
+        self.assertEqual(lines[11:], [b'\x0c', b'\x1a'])
+
+
+class CompassIncrementalWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'FULFORD.DAT')
+        shutil.copy(os.path.join(DATA_DIR, 'FULFORD.DAT'), self.fname)
+        with open(self.fname, 'rb') as f:
+            self.original = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def blocks(self, fname=None):
+        with open(fname or self.fname, 'rb') as f:
+            return f.read().split(b'\x0C')
+
+    def test_unmodified(self):
+        for kwargs in ({}, {'lazy': True}, {'columnar': True}):
+            dat = DatFile.read(self.fname, **kwargs)
+            self.assertFalse(any(survey.is_dirty for survey in dat))
+            dat.write(self.fname)
+            with open(self.fname, 'rb') as f:
+                self.assertEqual(f.read(), self.original)
+
+    def test_modified_survey(self):
+        original = self.blocks()
+        dat = DatFile.read(self.fname)
+        survey = dat.surveys[3]
+        survey.shots[0]['LENGTH'] = 99.5
+        self.assertTrue(survey.is_dirty)
+        self.assertFalse(dat.surveys[2].is_dirty)
+        dat.write(self.fname)
+
+        blocks = self.blocks()
+        self.assertEqual(blocks[:3] + blocks[4:], original[:3] + original[4:])
+        self.assertNotEqual(blocks[3], original[3])
+        self.assertEqual(DatFile.read(self.fname).surveys[3].shots[0]['LENGTH'], 99.5)
+        self.assertFalse(survey.is_dirty)  # clean with respect to the file just written
+
+    def test_dirty_tracking(self):
+        dat = DatFile.read(self.fname, lazy=True)
+        surveys = dat.surveys
+        surveys[0].shots  # loading shots isn't a modification
+        self.assertFalse(surveys[0].is_dirty)
+        surveys[0].comment = 'edited'
+        surveys[1].add_shot(Shot(FROM='A1', TO='NEW', LENGTH=1.0))
+        surveys[2].shots.pop()
+        surveys[3].team.append('Someone')
+        surveys[3].mark_dirty()
+        self.assertEqual([survey.is_dirty for survey in surveys[:5]], [True, True, True, True, False])
+
+        dat.add_survey(Survey(name='NEW', date=datetime.date(2015, 6, 22), cave_name='Fulford Cave',
+                              shots=[Shot(FROM='NEW1', TO='NEW2', LENGTH=1.0, BEARING=0.0, INC=0.0)]))
+        dat.write(self.fname)
+        reread = DatFile.read(self.fname)
+        self.assertEqual(reread.surveys[0].comment, 'edited')
+        self.assertEqual(len(reread.surveys[2].shots), len(surveys[2].shots))
+        self.assertEqual(reread.surveys[-1].name, 'NEW')
+        self.assertEqual(self.blocks()[4:-2], self.original.split(b'\x0C')[4:-1])
+
+    def test_soft_eof(self):
+        with open(self.fname, 'wb') as f:
+            f.write(self.original[:self.original.rindex(b'\x0C')] + b'\x1A')  # last survey runs to ^Z
+        dat = DatFile.read(self.fname)
+        self.assertFalse(any(survey.is_dirty for survey in dat))
+        dat.write(self.fname)
+        self.assertEqual(self.blocks(), self.original.split(b'\x0C')[:-1] + [b'\x1A'])
+
+    def test_assigned_shots(self):
+        dat = DatFile.read(self.fname)
+        survey = dat.surveys[3]
+        edited = [Shot(shot) for shot in survey.shots]
+        edited[0]['LENGTH'] = 123.456
+        survey.shots = edited
+        self.assertTrue(survey.is_dirty)
+        dat.write(self.fname)
+        self.assertEqual(DatFile.read(self.fname).surveys[3].shots[0]['LENGTH'], 123.456)
+
+    def test_no_filename(self):
+        dat = DatFile('NONAME')
+        self.assertRaises(ValueError, dat.write)
+
+    def test_unwritable(self):
+        dat = DatFile.read(self.fname)
+        outfname = os.path.join(self.tmpdir, 'missing', 'OUT.DAT')
+        with self.assertRaises(IOError) as cm:
+            dat.write(outfname)
+        self.assertTrue(getattr(cm.exception, '__context__', None) is None)  # the open() error, not a failed cleanup
+
+    def test_header_edits(self):
+        surveys = DatFile.read(self.fname).surveys
+        surveys[0].name = surveys[0].name  # unchanged
+        surveys[1].team.append('Someone')
+        surveys[2].file_format = 'DDDDLRUDLADN'
+        self.assertEqual([survey.is_dirty for survey in surveys[:3]], [False, True, True])
+
+    def test_pickle(self):
+        dat = DatFile.read(self.fname)
+        dat.surveys[1].shots.pop()
+        dat.surveys[2].shots[0].declination = 1.5
+        dat = pickle.loads(pickle.dumps(dat, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual([survey.is_dirty for survey in dat.surveys[:3]], [False, True, False])
+        self.assertEqual(dat.surveys[2].shots[0].declination, 1.5)
+        self.assertEqual(dat.surveys[2].shots[1].declination, dat.surveys[2].declination)
+
+    def test_changed_source(self):
+        dat = DatFile.read(self.fname)
+        with open(self.fname, 'ab') as f:
+            f.write(b'\r\n')  # the source no longer matches the parsed surveys
+        outfname, expected = os.path.join(self.tmpdir, 'OUT.DAT'), os.path.join(self.tmpdir, 'EXPECTED.DAT')
+        dat.write(outfname)
+
+        dat = DatFile.read(os.path.join(DATA_DIR, 'FULFORD.DAT'))
+        for survey in dat:
+            survey.mark_dirty()
+        dat.write(expected)
+        self.assertEqual(self.blocks(outfname), self.blocks(expected))
+
+    def test_file_mode(self):
+        os.chmod(self.fname, 0o640)
+        DatFile.read(self.fname).write()
+        self.assertEqual(os.stat(self.fname).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.tmpdir), ['FULFORD.DAT'])
+
+
+class CompassSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'FULFORDS.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSameProject(self, loaded, project):
+        self.assertEqual((loaded.name, loaded.filename), (project.name, project.filename))
+        self.assertEqual(str(loaded.base_location), str(project.base_location))
+        self.assertEqual(loaded._utm_zone, project._utm_zone)
+        self.assertEqual([datfile.name for datfile in loaded], [datfile.name for datfile in project])
+        for loaded_dat, datfile in zip(loaded, project):
+            self.assertEqual(loaded_dat.filename, datfile.filename)
+            self.assertEqual([survey.name for survey in loaded_dat], [survey.name for survey in datfile])
+            for loaded_survey, survey in zip(loaded_dat, datfile):
+                for attr in ('date', 'comment', 'team', 'declination', 'file_format', 'corrections', 'corrections2',
+                             'cave_name', 'shot_header'):
+                    self.assertEqual(getattr(loaded_survey, attr), getattr(survey, attr))
+                self.assertEqual([dict(shot) for shot in loaded_survey.shots], [dict(shot) for shot in survey.shots])
+                self.assertEqual([shot.declination for shot in loaded_survey.shots], [shot.declination for shot in survey.shots])
+                self.assertEqual(loaded_survey.included_mask(), survey.included_mask())
+        self.assertAlmostEqual(loaded.length, project.length)
+        self.assertAlmostEqual(loaded.included_length, project.included_length)
+
+    def test_round_trip(self):
+        for kwargs in ({}, {'lazy': True}, {'columnar': True}):
+            project = Project.read(TESTFILE, **kwargs)
+            project.save_snapshot(self.fname)
+            self.assertSameProject(Project.load_snapshot(self.fname), project)
+        self.assertEqual(os.listdir(self.tmpdir), ['FULFORDS.snapshot'])
+
+    def test_fixed_stations(self):
+        project = Project.read(TESTFILE)
+        project.add_linked_station(project.linked_files[0], 'A1', UTMLocation(357715.7, 4372837.5, 3048.0, 13, UTMDatum.NAD83))
+        project.add_linked_station(project.linked_files[1], 'FS1')
+        project.save_snapshot(self.fname)
+        loaded = Project.load_snapshot(self.fname)
+        self.assertEqual(str(loaded.fixed_stations[loaded.linked_files[0]]['A1']), str(project.fixed_stations[project.linked_files[0]]['A1']))
+        self.assertEqual(loaded.fixed_stations[loaded.linked_files[1]], {'FS1': None})
+
+    def test_modify(self):
+        Project.read(TESTFILE).save_snapshot(self.fname)
+        loaded = Project.load_snapshot(self.fname)
+        survey = loaded.linked_files[0].surveys[0]
+        length, n = survey.shots[0]['LENGTH'], len(survey.shots)
+        survey.shots[0]['LENGTH'] = 99.5
+        survey.add_shot(Shot(FROM='A1', TO='NEW', LENGTH=1.0, COMMENTS='new'))
+        self.assertEqual(survey.shots[0]['LENGTH'], 99.5)
+        self.assertEqual(dict(survey.shots[-1]), {'FROM': 'A1', 'TO': 'NEW', 'LENGTH': 1.0, 'COMMENTS': 'new'})
+        self.assertTrue('NEW' in survey)
+        self.assertTrue(survey.is_dirty)
+        self.assertFalse(loaded.linked_files[0].surveys[1].is_dirty)
+
+        reloaded = Project.load_snapshot(self.fname).linked_files[0].surveys[0]  # the snapshot itself is unchanged
+        self.assertEqual((reloaded.shots[0]['LENGTH'], len(reloaded.shots)), (length, n))
+
+    def test_write(self):
+        dat_fname = os.path.join(self.tmpdir, 'FULFORD.DAT')
+        shutil.copy(os.path.join(DATA_DIR, 'FULFORD.DAT'), dat_fname)
+        project = Project('TEST')
+        project.add_linked_file(DatFile.read(dat_fname))
+        project.save_snapshot(self.fname)
+
+        datfile = Project.load_snapshot(self.fname).linked_files[0]
+        outfname = os.path.join(self.tmpdir, 'OUT.DAT')
+        datfile.write(outfname)  # unmodified surveys are copied from their source .DAT
+        with open(outfname, 'rb') as f, open(dat_fname, 'rb') as original:
+            self.assertEqual(f.read(), original.read())
+
+    def test_pickle(self):
+        project = Project.read(TESTFILE)
+        project.save_snapshot(self.fname)
+        self.assertSameProject(pickle.loads(pickle.dumps(Project.load_snapshot(self.fname))), project)
+
+    def test_unwritable(self):
+        with self.assertRaises(IOError) as cm:
+            Project.read(TESTFILE).save_snapshot(os.path.join(self.tmpdir, 'missing', 'TEST.snapshot'))
+        self.assertTrue(getattr(cm.exception, '__context__', None) is None)  # the open() error, not a failed cleanup
+
+    def test_not_a_snapshot(self):
+        self.assertRaises(SnapshotError, Project.load_snapshot, os.path.join(DATA_DIR, 'FULFORD.DAT'))
+        Project.read(TESTFILE).save_snapshot(self.fname)
+        with open(self.fname, 'r+b') as f:
+            f.seek(8)
+            f.write(b'\xff')  # unknown format version
+        self.assertRaises(SnapshotError, Project.load_snapshot, self.fname)
+
+
+class CompassSnapshotFallbackTest(CompassSnapshotTest):
+    """Run the snapshot tests with shot data copied into arrays, as where it can't be memory-mapped"""
+
+    def setUp(self):
+        import davies.compass.snapshot
+        CompassSnapshotTest.setUp(self)
+        self.module = davies.compass.snapshot
+        self.mappable = self.module._MAPPABLE
+        self.module._MAPPABLE = False
+
+    def tearDown(self):
+        self.module._MAPPABLE = self.mappable
+        CompassSnapshotTest.tearDown(self)
+
+
+class CompassExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Project.read(TESTFILE)
+        self.shots = [(datfile, survey, shot) for datfile in self.project for survey in datfile for shot in survey]
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def rows(self, batches):
+        return [row for batch in batches for row in zip(*[batch[name] for name in export.COLUMNS])]
+
+    def test_batches(self):
+        batches = list(export.iter_shot_batches(self.project, batch_size=100))
+        self.assertEqual([len(batch['file']) for batch in batches[:-1]], [100] * (len(batches) - 1))
+        self.assertTrue(0 < len(batches[-1]['file']) <= 100)
+
+        rows = self.rows(batches)
+        self.assertEqual(len(rows), len(self.shots))
+        for row, (datfile, survey, shot) in zip(rows, self.shots):
+            self.assertEqual(row, (datfile.name, survey.name, survey.date, shot['FROM'], shot['TO'], shot.length,
+                                   shot.azm, shot.inc, shot.get('FLAGS', None) or ''))
+
+    def test_sources(self):
+        rows = self.rows(export.iter_shot_batches(self.project))
+        fnames = [datfile.filename for datfile in self.project]
+        self.assertEqual(self.rows(export.iter_shot_batches(fnames, batch_size=7)), rows)
+        self.assertEqual(self.rows(export.iter_shot_batches(Project.read(TESTFILE, columnar=True))), rows)
+        self.assertEqual(self.rows(export.iter_shot_batches(self.project.linked_files[0])),
+                         [row for row in rows if row[0] == self.project.linked_files[0].name])
+        surveys = self.project.linked_files[0].surveys[:2]
+        self.assertEqual(self.rows(export.iter_shot_batches(surveys)), rows[:len(surveys[0]) + len(surveys[1])])
+        self.assertRaises(ValueError, lambda: list(export.iter_shot_batches(self.project, batch_size=0)))
+
+    def test_csv(self):
+        fname = os.path.join(self.tmpdir, 'shots.csv')
+        self.assertEqual(export.write_csv(self.project, fname, batch_size=50), len(self.shots))
+        with open(fname) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), len(self.shots))
+        datfile, survey, shot = self.shots[0]
+        self.assertEqual((rows[0]['file'], rows[0]['survey'], rows[0]['date']), (datfile.name, survey.name, survey.date.isoformat()))
+        self.assertEqual((rows[0]['from'], rows[0]['to'], float(rows[0]['azm'])), (shot['FROM'], shot['TO'], shot.azm))
+        self.assertEqual([row['flags'] for row in rows], [shot.get('FLAGS', None) or '' for (_, _, shot) in self.shots])
+
+    @unittest.skipUnless(pa is not None, 'requires pyarrow')
+    def test_parquet(self):
+        import pyarrow.parquet as pq
+        fname = os.path.join(self.tmpdir, 'shots.parquet')
+        self.assertEqual(export.write_parquet(self.project, fname, batch_size=100), len(self.shots))
+        parquet = pq.ParquetFile(fname)
+        self.assertEqual(parquet.num_row_groups, (len(self.shots) + 99) // 100)
+        table = parquet.read()
+        self.assertEqual(table.column_names, list(export.COLUMNS))
+        self.assertEqual(table.column('azm').to_pylist(), [shot.azm for (_, _, shot) in self.shots])
+
+    @unittest.skipUnless(pa is not None, 'requires pyarrow')
+    def test_arrow(self):
+        fname = os.path.join(self.tmpdir, 'shots.arrow')
+        self.assertEqual(export.write_arrow(self.project, fname, batch_size=100), len(self.shots))
+        with pa.memory_map(fname) as source:
+            reader = pa.ipc.open_file(source)
+            self.assertEqual(reader.num_record_batches, (len(self.shots) + 99) // 100)
+            table = reader.read_all()
+        self.assertEqual(table.column('date').to_pylist(), [survey.date for (_, survey, _) in self.shots])
+
+    @unittest.skipUnless(pa is None, 'requires pyarrow to be missing')
+    def test_requires_pyarrow(self):
+        self.assertRaises(ImportError, export.write_parquet, self.project, os.path.join(self.tmpdir, 'shots.parquet'))
+        self.assertRaises(ImportError, export.write_arrow, self.project, os.path.join(self.tmpdir, 'shots.arrow'))
+
+
+class CompassShotDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name in ('FULFORDS.MAK', 'FULFORD.DAT', 'FULSURF.DAT'):
+            shutil.copy(os.path.join(DATA_DIR, name), self.tmpdir)
+        self.makfname = os.path.join(self.tmpdir, 'FULFORDS.MAK')
+        self.project = Project.read(self.makfname)
+        self.db = ShotDatabase(os.path.join(self.tmpdir, 'shots.sqlite'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def count(self, table):
+        return self.db.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+
+    def survey_lengths(self):
+        return dict(self.db.execute('SELECT name, length FROM surveys'))
+
+    def test_store(self):
+        self.assertEqual(self.db.store(self.project), 2)
+        self.assertEqual(self.count('projects'), 1)
+        self.assertEqual(self.count('files'), 2)
+        self.assertEqual(self.count('surveys'), sum(len(datfile) for datfile in self.project))
+        shots = [shot for datfile in self.project for survey in datfile for shot in survey]
+        self.assertEqual(self.count('shots'), len(shots))
+        self.assertAlmostEqual(self.db.execute('SELECT SUM(length) FROM shots').fetchone()[0], self.project.length)
+
+        survey = self.project.linked_files[0]['BS']
+        self.assertEqual(self.db.execute('SELECT date, comment FROM surveys WHERE name = ?', ('BS',)).fetchone(),
+                         (survey.date.isoformat(), survey.comment))
+        self.assertEqual([name for (name,) in self.db.execute('SELECT team.name FROM team JOIN surveys ON surveys.id = team.survey_id '
+                                                              'WHERE surveys.name = ? ORDER BY team.position', ('BS',))],
+                         [member for member in survey.team if member])  # without the empty member of a trailing comma
+        self.assertEqual([row for row in self.db.execute('SELECT from_station, to_station, corrected_azm, corrected_inc, left '
+                                                         'FROM shots JOIN surveys ON surveys.id = shots.survey_id '
+                                                         'WHERE surveys.name = ? ORDER BY shots.position', ('BS',))],
+                         [(shot['FROM'], shot['TO'], shot.azm, shot.inc, shot['LEFT']) for shot in survey])
+
+        longest = max(shots, key=lambda shot: shot.length)
+        self.assertEqual(self.db.execute('SELECT from_station, to_station FROM shots ORDER BY length DESC LIMIT 1').fetchone(),
+                         (longest['FROM'], longest['TO']))
+        excluded = self.db.execute('SELECT COUNT(*) FROM shots WHERE flag_bits != 0 AND flag_bits & ?', (FLAG_BITS[Exclude.LENGTH],))
+        self.assertEqual(excluded.fetchone()[0], len([shot for shot in shots if Exclude.LENGTH in shot.flags]))
+
+    def test_columnar(self):
+        self.db.store(self.project)
+        rows = self.db.execute('SELECT * FROM shots ORDER BY id').fetchall()
+        db = ShotDatabase()
+        db.store(Project.read(self.makfname, columnar=True))
+        self.assertEqual(db.execute('SELECT * FROM shots ORDER BY id').fetchall(), rows)
+        db.close()
+
+    def test_incremental(self):
+        self.db.store(self.project)
+        surface_ids = self.db.execute('SELECT id FROM surveys WHERE file_id = 2').fetchall()
+        self.assertEqual(self.db.store(self.project), 0)  # unchanged
+
+        survey = self.project.linked_files[0]['BS']
+        survey.shots[0]['LENGTH'] += 100.0
+        self.assertEqual(self.db.store(Project.read(self.makfname)), 0)  # unchanged on disk
+        self.assertEqual(self.db.store(self.project), 1)
+        self.assertEqual(self.survey_lengths()['BS'], survey.length)
+        self.assertEqual(self.count('shots'), sum(len(survey) for datfile in self.project for survey in datfile))
+        self.assertEqual(self.db.execute('SELECT id FROM surveys WHERE file_id = 2').fetchall(), surface_ids)
+
+        self.project.linked_files.pop()
+        self.project.reindex()
+        self.db.store(self.project)  # no longer linked
+        self.assertEqual([name for (name,) in self.db.execute('SELECT name FROM files')], ['FULFORD'])
+        self.assertEqual(self.count('surveys'), len(self.project.linked_files[0]))
+
+    def test_refresh(self):
+        self.db.store(self.project)
+        self.assertEqual(self.db.refresh(), 0)
+
+        datfile = DatFile.read(os.path.join(self.tmpdir, 'FULFORD.DAT'))
+        datfile['BS'].shots[0]['LENGTH'] += 100.0
+        datfile.write()
+        self.assertEqual(self.db.refresh(), 1)
+        self.assertAlmostEqual(self.survey_lengths()['BS'], datfile['BS'].length)
+        self.assertEqual([name for (name,) in self.db.execute('SELECT name FROM files ORDER BY id')], ['FULFORD', 'FULSURF'])
+
+        os.remove(os.path.join(self.tmpdir, 'FULSURF.DAT'))
+        self.db.refresh()
+        self.assertEqual(self.count('files'), 1)
+        self.assertEqual(self.count('surveys'), len(datfile))
+
+    def test_soft_eof(self):
+        fname = os.path.join(self.tmpdir, 'FULSURF.DAT')
+        with open(fname, 'rb') as f:
+            data = f.read()
+        with open(fname, 'wb') as f:
+            f.write(data[:data.rindex(b'\x0C')] + b'\x1A')  # last survey runs to ^Z, without a ^L separator
+        self.assertEqual(self.db.store(Project.read(self.makfname)), 2)
+        self.assertEqual(self.db.store(Project.read(self.makfname)), 0)  # unchanged
+
+    def test_reopen(self):
+        self.db.store(self.project)
+        self.db.close()
+        self.db = ShotDatabase(os.path.join(self.tmpdir, 'shots.sqlite'))
+        self.assertEqual(self.count('shots'), sum(len(survey) for datfile in self.project for survey in datfile))
+        self.assertEqual(self.db.store(self.project), 0)
+
+        self.db.execute('PRAGMA user_version = 99')
+        self.assertRaises(ValueError, ShotDatabase, os.path.join(self.tmpdir, 'shots.sqlite'))
+
 
 class DateFormatTest(unittest.TestCase):
 
@@ -0,0 +1,190 @@
+import unittest
+import os.path
+import datetime
+
+from davies.compass.plt import *
+from davies.compass.plt import _tokenize_commands, _split_records
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+DATA_DIR = 'tests/data/compass'
+
+# Example Compass plot file with:
+# - Two segments, one with a hidden splay
+# - One fixed point and one loop
+TESTFILE = os.path.join(DATA_DIR, 'TEST.PLT')
+
+
+class PltParsingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plot = CompassPltParser(TESTFILE).parse()
+
+    def test_header(self):
+        self.assertEqual(self.plot.name, 'TEST')
+        self.assertEqual(self.plot.utm_zone, 13)
+        self.assertEqual(self.plot.datum, 'North American 1983')
+        self.assertEqual((self.plot.ymin, self.plot.ymax), (-20.0, 35.5))
+        self.assertEqual(self.plot.fixed_points['A1'], (0.0, 0.0, 0.0))
+        self.assertEqual(self.plot.loop_count, 1)
+        self.assertEqual(self.plot.loops[0], (3, 'A2', 'A3', 'B1', ['A2', 'B1', 'A3']))
+
+    def test_segments(self):
+        self.assertEqual(len(self.plot), 2)
+        segment = self.plot['A']
+        self.assertEqual(segment.date, datetime.date(2015, 6, 22))
+        self.assertEqual(segment.comment, 'entrance series')
+        self.assertEqual(segment.xmax, 20.0)
+        self.assertEqual([cmd.cmd for cmd in segment], ['M', 'D', 'D', 'd'])
+        self.assertEqual(self.plot['B'].comment, '')
+
+    def test_commands(self):
+        cmd = self.plot['A'].commands[1]
+        self.assertTrue(isinstance(cmd, DrawCommand))
+        self.assertEqual((cmd.name, cmd.y, cmd.x, cmd.z), ('A2', 10.0, 5.0, -2.0))
+        self.assertEqual((cmd.l, cmd.u, cmd.d, cmd.r), (1.5, 2.5, 3.5, 4.5))
+        self.assertEqual(cmd.edist, 11.36)
+        self.assertEqual(self.plot['A'].commands[3].flags, 'FP')
+
+
+@unittest.skipUnless(np is not None, 'requires numpy')
+class PltArraysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plot = CompassPltParser(TESTFILE).parse()
+        self.arrays = self.plot.to_arrays()
+
+    def test_stations(self):
+        stations = self.arrays.stations
+        self.assertEqual(len(stations), sum(len(segment) for segment in self.plot))
+        self.assertEqual(list(stations['cmd']), ['M', 'D', 'D', 'd', 'M', 'D', 'D'])
+        self.assertEqual(list(stations['hidden']), [False, False, False, True, False, False, False])
+        self.assertEqual(stations['y'].max(), self.plot.ymax)
+        self.assertEqual(stations[1]['edist'], 11.36)
+        self.assertEqual((stations[1]['l'], stations[1]['r']), (1.5, 4.5))
+
+    def test_names(self):
+        stations, names = self.arrays.stations, self.arrays.names
+        self.assertEqual([names[i] for i in stations['name']], ['A1', 'A2', 'A3', 'A2SPLAY', 'A2', 'B1', 'A3'])
+        self.assertEqual(len(names), 5)
+
+    def test_offsets(self):
+        offsets = self.arrays.offsets
+        self.assertEqual(list(offsets), [0, 4, 7])
+        for i, segment in enumerate(self.plot):
+            names = [self.arrays.names[j] for j in self.arrays.stations['name'][offsets[i]:offsets[i+1]]]
+            self.assertEqual(names, [cmd.name for cmd in segment])
+
+    def test_parse_arrays(self):
+        parser = CompassPltParser(TESTFILE)
+        arrays = parser.parse_arrays()
+        self.assertTrue((arrays.stations == self.arrays.stations).all())
+        self.assertEqual(list(arrays.offsets), list(self.arrays.offsets))
+        self.assertEqual(arrays.names, self.arrays.names)
+        self.assertEqual([segment.name for segment in parser.plot], ['A', 'B'])
+
+    def test_empty(self):
+        arrays = Plot('EMPTY').to_arrays()
+        self.assertEqual(len(arrays.stations), 0)
+        self.assertEqual(list(arrays.offsets), [0])
+
+
+class PltTokenizerTest(unittest.TestCase):
+
+    LINES = [b'M\t0.00\t0.00\t0.00\tSA1\tP\t1.00\t2.00\t3.00\t4.00\tI\t0.00\r\n',
+             b'D\t10.00\t5.00\t-2.00\tSA2\tP\t1.50\t2.50\t3.50\t4.50\tI\t11.36\r\n',
+             b'd  12.00  4.00  -2.50  SA\xe92  P  0.00  0.00  0.00  0.00  I  44.10  FP\r\n']
+
+    def test_uniform(self):
+        block = _tokenize_commands(b''.join(self.LINES[:2]))
+        self.assertEqual(block.codes, [b'M', b'D'])
+        self.assertEqual(block.names, ['A1', 'A2'])
+        self.assertEqual(block.columns[0], [0.0, 10.0])  # Y
+        self.assertEqual(block.columns[3], [1.0, 1.5])   # L
+        self.assertEqual(block.columns[4], [4.0, 4.5])   # R
+        self.assertEqual(block.flags, [None, None])
+
+    def test_mixed_flags(self):
+        block = _tokenize_commands(b''.join(self.LINES + self.LINES[1:2]))
+        self.assertEqual(block.codes, [b'M', b'D', b'd', b'D'])
+        self.assertEqual(block.names, ['A1', 'A2', u'A\xe92', 'A2'])
+        self.assertEqual(block.columns[7], [0.0, 11.36, 44.1, 11.36])  # EDIST
+        self.assertEqual(block.flags, [None, None, 'FP', None])
+
+    def test_per_line_fallback(self):
+        block = _tokenize_commands(b'M1.0 2.0 3.0 SA1 P 1.0 2.0 3.0 4.0 I 0.0\r\n\r\n' + self.LINES[1])
+        self.assertEqual(block.codes, [b'M', b'D'])
+        self.assertEqual(block.columns[0], [1.0, 10.0])
+
+    @unittest.skipUnless(np is not None, 'requires numpy')
+    def test_arrays(self):
+        for data in (b''.join(self.LINES[:2]), b''.join(self.LINES + self.LINES[1:2]),
+                     b'M1.0 2.0 3.0 SA1 P 1.0 2.0 3.0 4.0 I 0.0\r\n\r\n' + self.LINES[1]):
+            block, arrays_block = _tokenize_commands(data), _tokenize_commands(data, arrays=True)
+            self.assertEqual((arrays_block.codes, arrays_block.names, arrays_block.flags),
+                             (block.codes, block.names, block.flags))
+            for column, array in zip(block.columns, arrays_block.columns):
+                self.assertEqual(array.dtype, float)
+                self.assertEqual(list(array), column)
+
+    def test_split_records_chunks(self):
+        with open(TESTFILE, 'rb') as f:
+            expected = list(_split_records(f))
+        for chunk_size in (1, 7, 64):
+            with open(TESTFILE, 'rb') as f:
+                records = list(_split_records(f, chunk_size))
+            self.assertEqual(b''.join(data for (_, data) in records).split(), b''.join(data for (_, data) in expected).split())
+            self.assertEqual([data for (is_commands, data) in records if not is_commands],
+                             [data for (is_commands, data) in expected if not is_commands])
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, _tokenize_commands, b'D 1.0 2.0 3.0 SA1\r\n')
+
+
+class PltStreamingTest(unittest.TestCase):
+
+    def test_iter_commands(self):
+        parser = CompassPltParser(TESTFILE)
+        commands = parser.iter_commands()
+        first = next(commands)
+        self.assertTrue(isinstance(first, MoveCommand))
+        self.assertEqual(parser.plot.utm_zone, 13)
+        names = [first.name] + [cmd.name for cmd in commands]
+        self.assertEqual(names, ['A1', 'A2', 'A3', 'A2SPLAY', 'A2', 'B1', 'A3'])
+        self.assertEqual(len(parser.plot), 0)
+        self.assertEqual(parser.plot.loop_count, 1)
+
+    def test_iter_segments(self):
+        parser = CompassPltParser(TESTFILE)
+        plot = CompassPltParser(TESTFILE).parse()
+        segments = list(parser.iter_segments())
+        self.assertEqual([segment.name for segment in segments], [segment.name for segment in plot])
+        self.assertEqual([len(segment) for segment in segments], [len(segment) for segment in plot])
+        self.assertEqual(len(parser.plot), 0)
+
+
+class PlotLookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plot = Plot('TEST')
+        for name in ('A', 'B', 'A'):
+            self.plot.add_segment(Segment(name))
+
+    def test_getitem(self):
+        self.assertTrue(self.plot['A'] is self.plot.segments[0])
+        self.assertTrue(self.plot['B'] is self.plot.segments[1])
+        self.assertRaises(KeyError, lambda: self.plot['C'])
+
+    def test_contains(self):
+        self.assertTrue('B' in self.plot)
+        self.assertFalse('C' in self.plot)
+
+    def test_add_after_lookup(self):
+        self.assertFalse('C' in self.plot)
+        segment = Segment('C')
+        self.plot.add_segment(segment)
+        self.assertTrue(self.plot['C'] is segment)
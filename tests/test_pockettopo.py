@@ -1,5 +1,7 @@
 import unittest
+import os
 import os.path
+import tempfile
 from datetime import date
 
 from davies.pockettopo import *
@@ -33,6 +35,18 @@ class PocketTopoTxtParseTestCase(unittest.TestCase):
     def test_txt_getitem(self):
         self.assertTrue(self.txtfile['1'])
 
+    def test_txt_getitem_survey(self):
+        survey = self.txtfile.surveys[1]
+        self.assertTrue(self.txtfile[survey.name] is survey)
+        self.assertTrue(self.txtfile[survey] is survey)
+        self.assertRaises(KeyError, lambda: self.txtfile['nope'])
+
+    def test_txt_add_survey(self):
+        self.assertFalse('new' in self.txtfile)
+        survey = Survey('new')
+        self.txtfile.add_survey(survey)
+        self.assertTrue(self.txtfile['new'] is survey)
+
     def test_reference_point(self):
         self.assertEqual(len(self.txtfile.reference_points), 1)
         self.assertTrue('1.0' in self.txtfile.reference_points)
@@ -43,9 +57,92 @@ class PocketTopoTxtParseTestCase(unittest.TestCase):
     def test_survey_getitem(self):
         survey = self.txtfile['1']
         self.assertTrue('1.0' in survey)
+        self.assertFalse('NOPE' in survey)
+
+    def test_survey_contains_added(self):
+        survey = self.txtfile['1']
+        self.assertFalse('NEW' in survey)
+        survey.add_shot(Shot([('FROM', '1.0'), ('TO', 'NEW'), ('LENGTH', 1.0), ('AZM', 0.0), ('INC', 0.0)]))
+        self.assertTrue('NEW' in survey)
 
     def test_survey_date(self):
         survey = self.txtfile['1']
         self.assertEqual(survey.date, date(2015, 6, 22))
 
     # TODO: ...
+
+
+class PocketTopoTripRoutingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def write(self, trips, shots):
+        with open(self.fname, 'w') as f:
+            f.write('Routing Cave  (m, 360)\n\n')
+            for trip in trips:
+                f.write('[%s]: 2015/06/22     0.00  "trip %s"\n' % (trip, trip))
+            f.write('\n')
+            for from_, to, trip in shots:
+                f.write('     %s     %s     1.00  90.00  0.00  [%s]\n' % (from_, to, trip))
+
+    def test_many_trips(self):
+        trips = [str(i) for i in range(1, 3001)]
+        self.write(trips, [('%s.0' % trip, '%s.1' % trip, trip) for trip in reversed(trips)])
+        txtfile = TxtFile.read(self.fname)
+        self.assertEqual(len(txtfile), 3000)
+        for trip in ('1', '1500', '3000'):
+            self.assertEqual(len(txtfile[trip]), 1)
+            self.assertTrue('%s.1' % trip in txtfile[trip])
+
+    def test_unknown_trip(self):
+        self.write(['1'], [('1.0', '1.1', '1'), ('1.1', '1.2', '2')])
+        self.assertRaises(ParseException, TxtFile.read, self.fname)
+
+
+class PocketTopoTxtLinesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def read(self, text):
+        with open(self.fname, 'wb') as f:
+            f.write(text.encode('windows-1252'))
+        return TxtFile.read(self.fname)
+
+    def test_quoted_comments(self):
+        txtfile = self.read('Quoted Cave  (m, 360)\r\n\r\n'
+                            '[1]: 2015/06/22     0.00  "first trip"   \r\n'
+                            '[2]: 2015/06/23     0.00\r\n\r\n'
+                            '     1.0     1.1     1.00  90.00  0.00  [1]  "shot comment"\r\n'
+                            '     1.1     1.2     1.00  90.00  0.00  [1]\r\n')
+        self.assertEqual([survey.comment for survey in txtfile], ['first trip', ''])
+        self.assertEqual([shot['COMMENT'] for shot in txtfile['1']], ['shot comment', None])
+
+    def test_whitespace_lines(self):
+        txtfile = self.read('Blank Cave  (m, 360)\r\n   \r\n'
+                            '[1]: 2015/06/22     0.00  "trip"\r\n \t \r\n'
+                            '     1.0     1.1     1.00  90.00  0.00  [1]\r\n    \r\n'
+                            '     1.1     1.2     1.00  90.00  0.00  [1]\r\n\r\n')
+        self.assertEqual(len(txtfile), 1)
+        self.assertEqual([(shot['FROM'], shot['TO']) for shot in txtfile['1']], [('1.0', '1.1'), ('1.1', '1.2')])
+
+    def test_no_trailing_newline(self):
+        txtfile = self.read('Last Cave  (m, 360)\n\n'
+                            '[1]: 2015/06/22     0.00  "trip"\n'
+                            '[2]: 2015/06/23     0.00  "last trip"\n\n'
+                            '     1.0     1.1     1.00  90.00  0.00  [1]\n'
+                            '     2.0     2.1     2.00  90.00  0.00  [2]')
+        self.assertEqual([len(survey) for survey in txtfile], [1, 1])
+        self.assertEqual(txtfile['2'].shots[0]['LENGTH'], 2.0)
+
+        txtfile = self.read('Trips Only Cave  (m, 360)\n\n[1]: 2015/06/22     0.00  "only trip"')
+        self.assertEqual([survey.comment for survey in txtfile], ['only trip'])
@@ -0,0 +1,83 @@
+import unittest
+import os.path
+import math
+import random
+
+from davies.spatial import *
+from davies.compass.plt import CompassPltParser
+
+
+DATA_DIR = 'tests/data/compass'
+
+TESTFILE = os.path.join(DATA_DIR, 'TEST.PLT')
+
+
+class KDTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(17)
+        self.points = [(rand.uniform(-500, 500), rand.uniform(-500, 500), rand.uniform(-50, 50)) for _ in range(2000)]
+        self.tree = KDTree(self.points)
+
+    def brute_distances(self, point):
+        return sorted((math.sqrt(sum((a - b) ** 2 for (a, b) in zip(p, point))), i) for (i, p) in enumerate(self.points))
+
+    def test_nearest(self):
+        for point in ((0.0, 0.0, 0.0), (499.0, -499.0, 10.0), self.points[42]):
+            expected = self.brute_distances(point)[:5]
+            result = self.tree.nearest(point, k=5)
+            self.assertEqual([i for (_, i) in result], [i for (_, i) in expected])
+            self.assertAlmostEqual(result[0][0], expected[0][0])
+        self.assertEqual(self.tree.nearest(self.points[42])[0], (0.0, 42))
+
+    def test_within(self):
+        point = (100.0, 100.0, 0.0)
+        expected = [i for (d, i) in self.brute_distances(point) if d <= 75.0]
+        self.assertTrue(expected)
+        self.assertEqual([i for (_, i) in self.tree.within(point, 75.0)], expected)
+
+    def test_in_box(self):
+        lo, hi = (-100.0, 0.0, -10.0), (50.0, 200.0, 10.0)
+        expected = [i for (i, p) in enumerate(self.points) if all(lo[a] <= p[a] <= hi[a] for a in range(3))]
+        self.assertTrue(expected)
+        self.assertEqual(self.tree.in_box(lo, hi), expected)
+
+    def test_duplicates(self):
+        tree = KDTree([(1.0, 1.0, 1.0)] * 50 + [(2.0, 2.0, 2.0)], items=['a'] * 50 + ['b'])
+        self.assertEqual(len(tree.within((1.0, 1.0, 1.0), 0.0)), 50)
+        self.assertEqual(tree.nearest((2.1, 2.0, 2.0))[0][1], 'b')
+
+    def test_empty(self):
+        tree = KDTree([])
+        self.assertEqual(tree.nearest((0.0, 0.0, 0.0)), [])
+        self.assertEqual(tree.within((0.0, 0.0, 0.0), 10.0), [])
+        self.assertEqual(tree.in_box((0.0, 0.0, 0.0), (1.0, 1.0, 1.0)), [])
+
+
+class PlotIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plot = CompassPltParser(TESTFILE).parse()
+        self.index = PlotIndex(self.plot)
+
+    def test_stations(self):
+        self.assertEqual(len(self.index.stations), 4)  # A1, A2, A3, B1; hidden A2SPLAY excluded
+        self.assertEqual(len(PlotIndex(self.plot, hidden=True).stations), 5)
+
+    def test_nearest(self):
+        distance, cmd = self.index.nearest((9.0, 5.0, -2.0))[0]
+        self.assertEqual(cmd.name, 'A2')
+        self.assertAlmostEqual(distance, 1.0)
+
+    def test_within(self):
+        self.assertEqual([cmd.name for (_, cmd) in self.index.within((0.0, 0.0, 0.0), 12.0)], ['A1', 'A2'])
+
+    def test_stations_in_box(self):
+        names = [cmd.name for cmd in self.index.stations_in_box((-25.0, 30.0, -40.0), (0.0, 50.0, 0.0))]
+        self.assertEqual(names, ['B1'])
+
+    def test_segments_in_box(self):
+        names = lambda segments: sorted(segment.name for segment in segments)
+        self.assertEqual(names(self.index.segments_in_box((-25.0, 35.0, -40.0), (-10.0, 45.0, 0.0))), ['B'])
+        self.assertEqual(names(self.index.segments_in_box((20.0, 10.0, -10.0), (30.0, 15.0, -5.0))), ['A', 'B'])
+        self.assertEqual(names(self.index.segments_in_box((100.0, 100.0, 100.0), (200.0, 200.0, 200.0))), [])
@@ -88,3 +88,42 @@ class UnitConversionTest(MathTestCase):
 
     def test_ft2m(self):
         self.assertEqual(ft2m(100), 30.48)
+
+
+class ArrayTest(MathTestCase):
+    inc = [0, 90, -90, 45]
+    azm = [0, 90, 180, 270]
+    sd = [100, 100, 100, 100]
+
+    def test_hd(self):
+        self.assertSequenceAlmostEqual(list(hd_array(self.inc, self.sd)), [hd(i, d) for (i, d) in zip(self.inc, self.sd)])
+
+    def test_vd(self):
+        self.assertSequenceAlmostEqual(list(vd_array(self.inc, self.sd)), [vd(i, d) for (i, d) in zip(self.inc, self.sd)])
+
+    def test_scalar_broadcast(self):
+        self.assertSequenceAlmostEqual(list(hd_array(self.inc, 100)), list(hd_array(self.inc, self.sd)))
+
+    def test_cartesian_offset(self):
+        x, y = cartesian_offset_array(self.azm, self.inc, self.sd, origin=(10, 20))
+        for i, (a, inc, d) in enumerate(zip(self.azm, self.inc, self.sd)):
+            self.assertSequenceAlmostEqual((x[i], y[i]), cartesian_offset(a, inc, d, origin=(10, 20)))
+
+    def test_angle_delta(self):
+        self.assertSequenceAlmostEqual(list(angle_delta_array([359, 0, 90], [0, 359, 270])), [1, 1, 180])
+
+    def test_units(self):
+        self.assertSequenceAlmostEqual(list(m2ft_array([100, 0])), [328.084, 0])
+        self.assertSequenceAlmostEqual(list(ft2m_array([100, 0])), [30.48, 0])
+
+
+class ArrayFallbackTest(ArrayTest):
+    """Run the array tests against the pure-Python fallback, even if `numpy` is installed"""
+
+    def setUp(self):
+        import davies.survey_math
+        self.module, self.np = davies.survey_math, davies.survey_math.np
+        self.module.np = None
+
+    def tearDown(self):
+        self.module.np = self.np